@@ -0,0 +1,55 @@
+# This File is part of the ltsp-manager.
+#
+# Copyright 2012-2018 by it's authors.
+#
+# Licensed under GNU General Public License 3.0 or later.
+# Some rights reserved. See COPYING, AUTHORS.
+
+"""
+Synthetic account databases for the benchmarks.
+"""
+import csv
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+# Users per synthetic class group, like school classes
+CLASS_SIZE = 30
+FIRST_CLASS_GID = 100000
+
+
+def write_accounts(directory, count):
+    """Write passwd, shadow and group files in directory, with count users,
+    each with a private group, and a group per CLASS_SIZE users."""
+    with open(os.path.join(directory, 'passwd'), 'w') as passwd, \
+            open(os.path.join(directory, 'shadow'), 'w') as shadow, \
+            open(os.path.join(directory, 'group'), 'w') as group:
+        passwd.write('root:x:0:0:root:/root:/bin/bash\n')
+        shadow.write('root:*:17000:0:99999:7:::\n')
+        group.write('root:x:0:\n')
+        for i in range(count):
+            name, uid = 'user%05d' % i, 1000 + i
+            passwd.write('%s:x:%d:%d:User %d,,,:/home/%s:/bin/bash\n' % (name, uid, uid, i, name))
+            shadow.write('%s:$6$salt$hash:17000:0:99999:7:::\n' % name)
+            group.write('%s:x:%d:\n' % (name, uid))
+        for i in range(0, count, CLASS_SIZE):
+            members = ','.join('user%05d' % j for j in range(i, min(i + CLASS_SIZE, count)))
+            group.write('class%05d:x:%d:%s\n' % (i // CLASS_SIZE, FIRST_CLASS_GID + i // CLASS_SIZE, members))
+    with open(os.path.join(directory, 'shells'), 'w') as shells:
+        shells.write('/bin/sh\n/bin/bash\n')
+
+
+def write_csv(fname, count, prefix='new', first_uid=1000):
+    """Write an import CSV with count users. With the default prefix and
+    first_uid, their UIDs conflict with the write_accounts() users."""
+    import libuser
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(libuser.CSV_USER_FIELDS)
+        for i in range(count):
+            name, uid = '%s%05d' % (prefix, i), first_uid + i
+            writer.writerow([name, uid, uid, name, 'New user %d' % i, '', '', '', '',
+                             '/home/%s' % name, '/bin/bash',
+                             'class%05d:%d' % (i // CLASS_SIZE, FIRST_CLASS_GID + i // CLASS_SIZE),
+                             17000, 0, 99999, 7, -1, -1, '!', ''])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# This File is part of the ltsp-manager.
+#
+# Copyright 2012-2018 by it's authors.
+#
+# Licensed under GNU General Public License 3.0 or later.
+# Some rights reserved. See COPYING, AUTHORS.
+
+"""
+Compare the 'nss' and 'files' backends of libuser.System.load with synthetic
+account files of 1k, 10k and 50k users.
+
+The 'nss' backend is measured through nss_wrapper (https://cwrap.org), which
+makes getpwall() and getgrall() read the synthetic files. It is skipped when
+libnss_wrapper.so isn't installed. nss_wrapper doesn't handle shadow, so the
+'nss' numbers don't include the shadow entries of the synthetic users.
+"""
+import argparse
+import ctypes.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fixtures import write_accounts
+
+SIZES = [1000, 10000, 50000]
+NSS_WRAPPER_PATHS = ['/usr/lib/x86_64-linux-gnu/libnss_wrapper.so',
+                     '/usr/lib64/libnss_wrapper.so', '/usr/lib/libnss_wrapper.so']
+
+
+def find_nss_wrapper():
+    path = ctypes.util.find_library('nss_wrapper')
+    if path:
+        return path
+    for path in NSS_WRAPPER_PATHS:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def time_load(directory, backend, repeat):
+    """Return the best load time of repeat runs, in seconds."""
+    import libuser
+    import paths
+    paths.sysconfdir = directory + '/'
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        system = libuser.System(backend=backend, watch=False)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(system.users)
+
+
+def time_load_subprocess(directory, backend, repeat, env=None):
+    out = subprocess.check_output(
+        [sys.executable, __file__, '--child', directory, '--backend', backend,
+         '--repeat', str(repeat)], env=env, universal_newlines=True)
+    best, users = out.split()
+    return float(best), int(users)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--backend', default='files')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print('%f %d' % time_load(args.child, args.backend, args.repeat))
+        return
+
+    nss_wrapper = find_nss_wrapper()
+    if not nss_wrapper:
+        print("libnss_wrapper.so wasn't found, skipping the 'nss' backend")
+    print('%8s %8s %12s %12s' % ('accounts', 'backend', 'users', 'seconds'))
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            write_accounts(directory, size)
+            # Run each backend in a new process so that they don't share caches
+            best, users = time_load_subprocess(directory, 'files', args.repeat)
+            print('%8d %8s %12d %12.3f' % (size, 'files', users, best))
+            if nss_wrapper:
+                env = dict(os.environ, LD_PRELOAD=nss_wrapper,
+                           NSS_WRAPPER_PASSWD=os.path.join(directory, 'passwd'),
+                           NSS_WRAPPER_GROUP=os.path.join(directory, 'group'))
+                best, users = time_load_subprocess(directory, 'nss', args.repeat, env)
+                print('%8d %8s %12d %12.3f' % (size, 'nss', users, best))
+
+
+if __name__ == '__main__':
+    main()
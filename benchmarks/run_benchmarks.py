@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# This File is part of the ltsp-manager.
+#
+# Copyright 2012-2018 by it's authors.
+#
+# Licensed under GNU General Public License 3.0 or later.
+# Some rights reserved. See COPYING, AUTHORS.
+
+"""
+Time the libuser and parsers hot paths with synthetic account databases.
+
+Each benchmark runs on fixtures of 100, 1k, 10k and 50k accounts in a
+temporary sysconfdir. The best time of --repeat runs is reported, along with
+the peak memory of a separate run under tracemalloc. The results can be saved
+as JSON with --output, and compared to a previous run with --compare.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fixtures
+
+SIZES = [100, 1000, 10000, 50000]
+# Slowdowns bigger than this ratio are reported as regressions by --compare,
+# unless they're below MIN_DIFFERENCE seconds, which is mostly noise
+THRESHOLD = 0.2
+MIN_DIFFERENCE = 0.001
+
+
+class Fixture:
+    """The synthetic sysconfdir and CSV files of a benchmark size."""
+    def __init__(self, directory, size):
+        import libuser
+        import paths
+        self.directory, self.size = directory, size
+        paths.sysconfdir = directory + '/'
+        paths.cachedir = os.path.join(directory, 'cache')
+        fixtures.write_accounts(directory, size)
+        self.csv = os.path.join(directory, 'import.csv')
+        fixtures.write_csv(self.csv, size)
+        self.export = os.path.join(directory, 'export.csv')
+        # Functions like get_system() or DetectConflicts use the global System
+        libuser._system_ = libuser.System(backend='files', watch=False)
+        self.system = libuser._system_
+
+
+def bench_system_load(fixture):
+    import libuser
+    return lambda: libuser.System(backend='files', watch=False)
+
+
+def bench_system_load_cached(fixture):
+    import libuser
+    # Write the cache synchronously, the thread would race with the timing
+    system = libuser.System(backend='files', watch=False)
+    user_rows, group_rows = system.account_rows()
+    system._write_cache({'key': system.cache_key(), 'signatures': system.signatures,
+                         'users': user_rows, 'groups': group_rows})
+    return lambda: libuser.System(backend='files', watch=False, cache=True)
+
+
+def bench_get_free_uid(fixture):
+    # The UIDs from 1000 up are used, so this needs to skip all of them
+    return lambda: fixture.system.get_free_uid()
+
+
+def bench_allocate_uids(fixture):
+    def allocate():
+        uids = fixture.system.allocate_uids(100)
+        fixture.system.release_uids(uids)
+    return allocate
+
+
+def bench_csv_parse(fixture):
+    import parsers
+    return lambda: parsers.CSV().parse(fixture.csv)
+
+
+def bench_csv_write(fixture):
+    import parsers
+    users = list(fixture.system.users.values())
+    return lambda: parsers.CSV().write(fixture.export, fixture.system, users)
+
+
+def bench_passwd_parse(fixture):
+    import parsers
+    return lambda: parsers.passwd().parse(*[os.path.join(fixture.directory, f)
+                                            for f in ('passwd', 'shadow', 'group')])
+
+
+def bench_detect_conflicts(fixture):
+    """ImportDialog.DetectConflicts on an imported CSV; needs GTK."""
+    try:
+        import gi
+        gi.require_version('Gtk', '3.0')
+        from gi.repository import Gtk
+        import builtins
+        builtins.__dict__.setdefault('_', lambda s: s)
+        import import_dialog
+        import parsers
+    except (ImportError, ValueError):
+        return None
+    # Only set up what DetectConflicts needs, the UI isn't loaded
+    dialog = import_dialog.ImportDialog.__new__(import_dialog.ImportDialog)
+    dialog.set = parsers.CSV().parse(fixture.csv)
+    dialog.chunks = None
+    dialog.apply = Gtk.Button()
+    dialog.states = {'ok' : Gtk.STOCK_OK, 'error' : Gtk.STOCK_DIALOG_WARNING}
+    types = [str, int, int, str, str, str, str, str, str, str, str, str,
+             int, int, int, int, int, int, str, str]
+    types.extend([str]*41)
+    dialog.list = Gtk.ListStore(*types)
+    for u in dialog.set.users.values():
+        data = [u.name, u.uid, u.gid, u.primary_group, u.rname, u.office,
+                u.wphone, u.hphone, u.other, u.directory, u.shell,
+                ",".join(u.groups), u.lstchg, u.min, u.max, u.warn,
+                u.inact, u.expire, u.password, u.plainpw or '']
+        dialog.list.append(data + ['black']*20 + ['']*20 + [dialog.states['ok']])
+    return dialog.DetectConflicts
+
+
+def bench_users_refilter(fixture):
+    """Refilter the main window users view with 3 class groups selected;
+    needs GTK."""
+    try:
+        import gi
+        gi.require_version('Gtk', '3.0')
+        from gi.repository import Gtk
+    except (ImportError, ValueError):
+        return None
+    import account_models
+    store = account_models.LazyAccountsModel('user', account_models.USER_COLUMNS)
+    store.fill(fixture.system.users.values())
+    selected = [g for name, g in sorted(fixture.system.groups.items())
+                if name.startswith('class')][:3]
+    members = account_models.group_members(selected)
+    users_filter = store.filter_new()
+    users_filter.set_visible_func(lambda model, rowiter, data:
+        account_models.user_is_visible(model.get_value(rowiter, 0), members, False))
+    return users_filter.refilter
+
+
+def bench_users_model_fill(fixture):
+    """Fill the main window users model; needs GTK."""
+    try:
+        import gi
+        gi.require_version('Gtk', '3.0')
+        from gi.repository import Gtk
+    except (ImportError, ValueError):
+        return None
+    import account_models
+    store = account_models.LazyAccountsModel('user', account_models.USER_COLUMNS)
+    return lambda: store.fill(fixture.system.users.values())
+
+
+BENCHMARKS = [
+    ('system_load', bench_system_load),
+    ('system_load_cached', bench_system_load_cached),
+    ('get_free_uid', bench_get_free_uid),
+    ('allocate_uids', bench_allocate_uids),
+    ('csv_parse', bench_csv_parse),
+    ('csv_write', bench_csv_write),
+    ('passwd_parse', bench_passwd_parse),
+    ('detect_conflicts', bench_detect_conflicts),
+    ('users_model_fill', bench_users_model_fill),
+    ('users_refilter', bench_users_refilter),
+]
+
+
+def measure(func, repeat):
+    """Return the best time of repeat calls of func, in seconds, and the
+    peak memory of another call, in bytes."""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def compare(results, baseline, threshold):
+    """Print the benchmarks that got slower than baseline by more than
+    threshold, and return their count."""
+    old = {(r['benchmark'], r['size']): r['seconds'] for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        key = (r['benchmark'], r['size'])
+        if key not in old or r['seconds'] - old[key] < MIN_DIFFERENCE:
+            continue
+        if r['seconds'] > old[key] * (1 + threshold):
+            print('REGRESSION %s[%d]: %.4fs -> %.4fs' % (key + (old[key], r['seconds'])))
+            regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', metavar='BENCHMARK',
+                        choices=[name for name, func in BENCHMARKS])
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='exit with an error if the results are slower than this previous output')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    results = []
+    print('%-18s %8s %12s %12s' % ('benchmark', 'accounts', 'seconds', 'peak KiB'))
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            fixture = Fixture(directory, size)
+            for name, setup in BENCHMARKS:
+                if args.only and name not in args.only:
+                    continue
+                func = setup(fixture)
+                if func is None:
+                    print('%-18s %8d %12s' % (name, size, 'skipped'))
+                    continue
+                seconds, peak = measure(func, args.repeat)
+                print('%-18s %8d %12.4f %12d' % (name, size, seconds, peak // 1024))
+                results.append({'benchmark': name, 'size': size,
+                                'seconds': seconds, 'peak_bytes': peak})
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'time': time.time(),
+                       'repeat': args.repeat, 'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# This File is part of the ltsp-manager.
+#
+# Copyright 2012-2018 by it's authors.
+#
+# Licensed under GNU General Public License 3.0 or later.
+# Some rights reserved. See COPYING, AUTHORS.
+
+"""
+Load test the signup server with many concurrent clients.
+
+A signup_daemon.RegistrationsFactory listens on a free local port in a
+reactor thread, with a synthetic account database and a temporary request
+store, and a stub window collects the requests like the signup server window.
+Each client session connects, identifies, asks for the roles and groups,
+checks a few usernames like a student typing, sends a request and says BYE.
+For each number of --clients, the throughput, the p50/p99 latency of each
+command and the memory growth of the process are reported.
+
+All the clients connect from 127.0.0.1, but each session identifies with
+its own hostname, so the per client rate limit of the server applies to each
+session; it's disabled unless --rate-limit is given.
+"""
+import argparse
+import collections
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import fixtures
+
+CLIENTS = [1, 10, 50, 100, 200]
+ACCOUNTS = 1000
+ROLES = ['student', 'teacher']
+
+
+class StubWindow:
+    """Collect the requests, instead of SignupServerWindow."""
+    def __init__(self):
+        self.requests = []
+
+    def add_request(self, request):
+        self.requests.append(request)
+
+
+def start_server(directory):
+    """Run the reactor in a thread, listen on a free port, and return the
+    factory, the stub window and the port."""
+    from twisted.internet import reactor
+    from twisted.internet.threads import blockingCallFromThread
+    import libuser
+    import signup_daemon
+
+    threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False},
+                     daemon=True).start()
+
+    def listen():
+        # The store is created here, as sqlite objects belong to their thread
+        system = libuser.System(backend='files', watch=False)
+        store = signup_daemon.RequestStore(os.path.join(directory, 'signup.sqlite'))
+        groups = sorted(name for name in system.groups if name.startswith('class'))[:5]
+        factory = signup_daemon.RegistrationsFactory(system, store, groups, ROLES)
+        window = StubWindow()
+        factory.listeners.append(window.add_request)
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        return factory, window, port.getHost().port
+
+    return blockingCallFromThread(reactor, listen)
+
+
+def rss():
+    """Return the resident memory of this process, in bytes."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class Client:
+    """A signup client that times each command, like signup.Connection."""
+    def __init__(self, port, version, latencies):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.reader = self.sock.makefile('rb')
+        self.version = version
+        self.next_id = 0
+        self.latencies = latencies
+
+    def query(self, command, name):
+        """Send command and return its reply, timing it as name."""
+        if self.version >= 2 and not command.startswith('HELLO'):
+            self.next_id += 1
+            command = '%d %s' % (self.next_id, command)
+        start = time.perf_counter()
+        self.sock.sendall((command + '\r\n').encode('utf-8'))
+        reply = self.reader.readline()
+        self.latencies[name].append(time.perf_counter() - start)
+        if not reply.endswith(b'\n'):
+            raise ConnectionError("The server closed the connection")
+        reply = reply.rstrip(b'\r\n').decode('utf-8')
+        if self.version >= 2 and not command.startswith('HELLO'):
+            reply = reply.partition(' ')[2]
+        return reply
+
+    def close(self):
+        self.sock.sendall(b'BYE\r\n' if self.version < 2 else
+                          ('%d BYE\r\n' % (self.next_id + 1)).encode('utf-8'))
+        # Wait until the server closes the connection
+        self.reader.read()
+        self.sock.close()
+
+
+def session(port, version, name, checks, latencies):
+    """Sign up as name, and return True if the request was accepted."""
+    client = Client(port, version, latencies)
+    try:
+        if version >= 2:
+            client.query('HELLO 2 %s' % name, 'HELLO')
+        else:
+            client.query('ID %s' % name, 'ID')
+            client.query('GET_ROLES', 'GET_ROLES')
+            client.query('GET_GROUPS', 'GET_GROUPS')
+        # Check the username while it's typed
+        for i in range(1, checks + 1):
+            client.query('USER_EXISTS %s' % name[:max(1, len(name) * i // checks)],
+                         'USER_EXISTS')
+        reply = client.query('SEND_DATA %s' % '\t'.join(
+            ['Load Test', name, '$6$salt$hash', ROLES[0], '']), 'SEND_DATA')
+    finally:
+        client.close()
+    return reply == 'YES'
+
+
+def run_level(port, clients, sessions, version, checks, level):
+    """Run clients threads of sessions each, and return the elapsed time,
+    the latencies by command and the failed sessions."""
+    results = []
+    barrier = threading.Barrier(clients + 1)
+
+    def client_thread(c):
+        latencies = collections.defaultdict(list)
+        failed = 0
+        barrier.wait()
+        for s in range(sessions):
+            try:
+                if not session(port, version, 'load%d-%d-%d' % (level, c, s),
+                               checks, latencies):
+                    failed += 1
+            except OSError as e:
+                print('Client %d: %s' % (c, e), file=sys.stderr)
+                failed += 1
+        results.append((latencies, failed))
+
+    threads = [threading.Thread(target=client_thread, args=(c,)) for c in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = collections.defaultdict(list)
+    for thread_latencies, failed in results:
+        for command, values in thread_latencies.items():
+            latencies[command].extend(values)
+    return elapsed, latencies, sum(failed for l, failed in results)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--clients', type=int, nargs='+', default=CLIENTS,
+                        help='the concurrent clients of each level, default: %(default)s')
+    parser.add_argument('--sessions', type=int, default=5,
+                        help='the signups of each client, default: %(default)s')
+    parser.add_argument('--checks', type=int, default=5,
+                        help='the USER_EXISTS of each signup, default: %(default)s')
+    parser.add_argument('--protocol', type=int, choices=[1, 2], default=1)
+    parser.add_argument('--accounts', type=int, default=ACCOUNTS,
+                        help='the existing accounts, default: %(default)s')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep the per client rate limit of the server')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    import paths
+    import signup_daemon
+    if not args.rate_limit:
+        signup_daemon.RATE_LIMIT = signup_daemon.RATE_BURST = 10 ** 9
+    # All the requests stay pending, they shouldn't be refused
+    signup_daemon.MAX_PENDING_REQUESTS = 10 ** 9
+    # The server may see the next connection of a client before it sees
+    # that its previous one was closed
+    signup_daemon.MAX_CONNECTIONS = max(signup_daemon.MAX_CONNECTIONS, 2 * max(args.clients))
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths.sysconfdir = directory + '/'
+        fixtures.write_accounts(directory, args.accounts)
+        # Silence the connection messages of the server
+        sys.stdout, stdout = open(os.devnull, 'w'), sys.stdout
+        try:
+            factory, window, port = start_server(directory)
+            start_rss = rss()
+            for level, clients in enumerate(args.clients):
+                throttled, dropped = factory.throttled, factory.dropped
+                elapsed, latencies, failed = run_level(
+                    port, clients, args.sessions, args.protocol, args.checks, level)
+                commands = sum(len(values) for values in latencies.values())
+                results.append({
+                    'clients': clients, 'seconds': elapsed,
+                    'sessions_per_second': clients * args.sessions / elapsed,
+                    'commands_per_second': commands / elapsed,
+                    'failed': failed, 'throttled': factory.throttled - throttled,
+                    'dropped': factory.dropped - dropped,
+                    'rss_growth_bytes': rss() - start_rss,
+                    'latency': {command: {'p50': percentile(values, 0.5),
+                                          'p99': percentile(values, 0.99)}
+                                for command, values in latencies.items()}})
+        finally:
+            sys.stdout = stdout
+
+    print('%8s %12s %12s %8s %10s %16s' % ('clients', 'sessions/s', 'commands/s',
+                                           'failed', 'throttled', 'RSS growth KiB'))
+    for r in results:
+        print('%8d %12.1f %12.1f %8d %10d %16d' % (
+            r['clients'], r['sessions_per_second'], r['commands_per_second'],
+            r['failed'], r['throttled'], r['rss_growth_bytes'] // 1024))
+        for command, latency in sorted(r['latency'].items()):
+            print('%21s  p50 %8.2f ms  p99 %8.2f ms' % (
+                command, latency['p50'] * 1000, latency['p99'] * 1000))
+    print('%d requests were stored' % len(window.requests))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'time': time.time(),
+                       'protocol': args.protocol, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
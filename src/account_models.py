@@ -0,0 +1,271 @@
+# This File is part of the ltsp-manager.
+#
+# Copyright 2012-2018 by it's authors.
+#
+# Licensed under GNU General Public License 3.0 or later.
+# Some rights reserved. See COPYING, AUTHORS.
+
+"""
+Tree models of the users and groups of the main window.
+"""
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import GObject, Gtk
+
+import libuser
+
+
+def user_row(user):
+    """The users_store columns of user."""
+    return [user, user.uid, user.name, user.primary_group, user.rname,
+            user.office, user.wphone, user.hphone, user.other, user.directory,
+            user.shell, user.lstchg, user.min, user.max, user.warn, user.inact,
+            user.expire]
+
+
+def group_row(group):
+    """The groups_store columns of group."""
+    return [group, group.gid, group.name]
+
+
+def _int(attr):
+    """A column getter of an integer attribute, which may be unset."""
+    def getter(obj):
+        value = getattr(obj, attr)
+        return -1 if value is None else value
+    return getter
+
+
+# The (type, getter) of the users view columns, like user_row()
+USER_COLUMNS = [
+    (GObject.TYPE_PYOBJECT, lambda user: user),
+    (GObject.TYPE_INT, _int('uid')),
+    (GObject.TYPE_STRING, lambda user: user.name),
+    (GObject.TYPE_STRING, lambda user: user.primary_group),
+    (GObject.TYPE_STRING, lambda user: user.rname),
+    (GObject.TYPE_STRING, lambda user: user.office),
+    (GObject.TYPE_STRING, lambda user: user.wphone),
+    (GObject.TYPE_STRING, lambda user: user.hphone),
+    (GObject.TYPE_STRING, lambda user: user.other),
+    (GObject.TYPE_STRING, lambda user: user.directory),
+    (GObject.TYPE_STRING, lambda user: user.shell),
+    (GObject.TYPE_INT, _int('lstchg')),
+    (GObject.TYPE_INT, _int('min')),
+    (GObject.TYPE_INT, _int('max')),
+    (GObject.TYPE_INT, _int('warn')),
+    (GObject.TYPE_INT, _int('inact')),
+    (GObject.TYPE_INT, _int('expire')),
+]
+
+
+def group_members(groups):
+    """Return the set of the member names of groups, or None if there are
+    no groups, for user_is_visible()."""
+    if not groups:
+        return None
+    return set().union(*(group.members for group in groups))
+
+
+def user_is_visible(user, members, show_system):
+    """Return True if the users view should show user, where members is
+    the group_members() of the selected groups."""
+    if members is None:
+        return show_system or not user.is_system_user()
+    return user.name in members
+
+
+class ListStoreSync:
+    """Keep a Gtk.ListStore of users or groups in sync with the System.
+
+    The libuser.Change lists of the System are applied to the affected rows
+    only, found by name, so that the selection and the scroll position of
+    the views are preserved. ListStore iters stay valid until their rows
+    are removed, so they can be kept in self.iters.
+    """
+    def __init__(self, store, kind, row_func):
+        self.store = store
+        # Either 'user' or 'group', like libuser.Change.kind
+        self.kind = kind
+        self.row_func = row_func
+        self.columns = list(range(store.get_n_columns()))
+        self.iters = {}
+
+    def get_name_path(self, name):
+        """Return the Gtk.TreePath of the object name, or None."""
+        if name not in self.iters:
+            return None
+        return self.store.get_path(self.iters[name])
+
+    def fill(self, objects):
+        """Replace all the rows with the objects."""
+        self.store.clear()
+        self.iters = {}
+        for obj in objects:
+            self.iters[obj.name] = self.store.append(self.row_func(obj))
+
+    def apply(self, changes):
+        """Apply the changes of self.kind, and return the names of the
+        objects that were changed."""
+        changed = set()
+        for change in changes:
+            if change.kind != self.kind:
+                continue
+            changed.add(change.name)
+            treeiter = self.iters.get(change.name)
+            if change.action == libuser.Change.REMOVED:
+                if treeiter is not None:
+                    self.store.remove(treeiter)
+                    del self.iters[change.name]
+            elif treeiter is None:
+                self.iters[change.name] = self.store.append(self.row_func(change.obj))
+            else:
+                # A single row-changed signal for all the columns
+                self.store.set(treeiter, self.columns, self.row_func(change.obj))
+        return changed
+
+
+class LazyAccountsModel(GObject.Object, Gtk.TreeModel):
+    """A flat Gtk.TreeModel of users or groups, that only keeps the names of
+    its rows and computes the column values when a view asks for them.
+
+    It has the same fill(), apply() and get_name_path() methods as
+    ListStoreSync, so it's also kept in sync with libuser.Change lists.
+    The iters hold the row index, so they're only valid until the next
+    change, which is what Gtk expects without the ITERS_PERSIST flag.
+    """
+    def __init__(self, kind, columns):
+        GObject.Object.__init__(self)
+        self.kind = kind
+        self.types = [column[0] for column in columns]
+        self.getters = [column[1] for column in columns]
+        self.names = []
+        self.objects = {}
+        # The row index of each name
+        self.rows = {}
+
+    def fill(self, objects):
+        """Replace all the rows with the objects. Attach the model to its
+        views after filling it, as they process each inserted row."""
+        for i in reversed(range(len(self.names))):
+            del self.objects[self.names.pop()]
+            self.row_deleted(Gtk.TreePath(i))
+        self.rows = {}
+        for obj in objects:
+            self.append(obj)
+
+    def append(self, obj):
+        index = len(self.names)
+        self.names.append(obj.name)
+        self.objects[obj.name] = obj
+        self.rows[obj.name] = index
+        self.row_inserted(Gtk.TreePath(index), self.create_iter(index))
+
+    def remove(self, names):
+        """Remove the rows of names, re-indexing the rest of the rows once,
+        so that removing many of them doesn't take quadratic time."""
+        # One row at a time, from the last one, so that each row_deleted
+        # follows its removal and the paths of the rest stay valid
+        for index in sorted((self.rows[name] for name in names), reverse=True):
+            del self.objects[self.names[index]]
+            del self.names[index]
+            self.row_deleted(Gtk.TreePath(index))
+        self.rows = {name: i for i, name in enumerate(self.names)}
+
+    def apply(self, changes):
+        """Apply the changes of self.kind, and return the names of the
+        objects that were changed."""
+        changed = set()
+        # The removals are done together, before any change of those names
+        removed = set()
+        for change in changes:
+            if change.kind != self.kind:
+                continue
+            changed.add(change.name)
+            if change.name in removed:
+                self.remove(removed)
+                removed = set()
+            if change.action == libuser.Change.REMOVED:
+                if change.name in self.rows:
+                    removed.add(change.name)
+            elif change.name not in self.rows:
+                self.append(change.obj)
+            else:
+                self.objects[change.name] = change.obj
+                index = self.rows[change.name]
+                self.row_changed(Gtk.TreePath(index), self.create_iter(index))
+        if removed:
+            self.remove(removed)
+        return changed
+
+    def get_name_path(self, name):
+        """Return the Gtk.TreePath of the object name, or None."""
+        if name not in self.rows:
+            return None
+        return Gtk.TreePath(self.rows[name])
+
+    def create_iter(self, index):
+        treeiter = Gtk.TreeIter()
+        # Offset by one, as a zero user_data is a NULL pointer
+        treeiter.user_data = index + 1
+        return treeiter
+
+    def get_index(self, treeiter):
+        return treeiter.user_data - 1
+
+    # The Gtk.TreeModel virtual methods
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_get_n_columns(self):
+        return len(self.types)
+
+    def do_get_column_type(self, column):
+        return self.types[column]
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        if len(indices) == 1 and 0 <= indices[0] < len(self.names):
+            return True, self.create_iter(indices[0])
+        return False, None
+
+    def do_get_path(self, treeiter):
+        return Gtk.TreePath(self.get_index(treeiter))
+
+    def do_get_value(self, treeiter, column):
+        obj = self.objects[self.names[self.get_index(treeiter)]]
+        return GObject.Value(self.types[column], self.getters[column](obj))
+
+    def do_iter_next(self, treeiter):
+        index = self.get_index(treeiter) + 1
+        if index < len(self.names):
+            treeiter.user_data = index + 1
+            return True
+        return False
+
+    def do_iter_previous(self, treeiter):
+        index = self.get_index(treeiter) - 1
+        if index >= 0:
+            treeiter.user_data = index + 1
+            return True
+        return False
+
+    def do_iter_children(self, parent):
+        if parent is None and self.names:
+            return True, self.create_iter(0)
+        return False, None
+
+    def do_iter_has_child(self, treeiter):
+        return False
+
+    def do_iter_n_children(self, treeiter):
+        if treeiter is None:
+            return len(self.names)
+        return 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and 0 <= n < len(self.names):
+            return True, self.create_iter(n)
+        return False, None
+
+    def do_iter_parent(self, child):
+        return False, None
@@ -5,10 +5,13 @@
 # Licensed under GNU General Public License 3.0 or later.
 # Some rights reserved. See COPYING, AUTHORS.
 
+import codecs
 import datetime
 import gettext
 import locale
+import os
 import re
+import shutil
 import subprocess
 import sys
 
@@ -29,20 +32,84 @@ def run_command(cmd, poll=False):
     
     p = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if not poll:
-        res = p.wait()
-        if res == 0:
-            return True, p.stdout.read().decode('utf-8')
-        else:
-            sys.stderr.write("Error while executing command:\n" +
-                " $ %s" % ' '.join(cmdline) + "\n")
-            sys.stderr.write(p.stdout.read().decode('utf-8'))
-            err = p.stderr.read().decode('utf-8')
-            sys.stderr.write(err)
-            if err == '':
-                err = "\n"
-            return False, err
+        # Read both pipes while waiting, a full one would block the command
+        out, err = p.communicate()
+        return command_result(cmdline, p.returncode, out.decode('utf-8'), err.decode('utf-8'))
     else:
         return p
+
+def command_result(cmdline, returncode, out, err):
+    """Return the (success, output) pair of run_command for a finished
+    command, logging its output on errors."""
+    if returncode == 0:
+        return True, out
+    sys.stderr.write("Error while executing command:\n" +
+        " $ %s" % ' '.join(cmdline) + "\n")
+    sys.stderr.write(out)
+    sys.stderr.write(err)
+    if err == '':
+        err = "\n"
+    return False, err
+
+def run_command_async(cmd, timeout=None):
+    """Run a command on the Twisted reactor, without blocking.
+
+    Return a Deferred that fires with the same (success, output) pair as
+    run_command.
+    Cancelling the Deferred kills the command. If timeout seconds pass, it's
+    killed and the Deferred fails with twisted.internet.defer.TimeoutError.
+    """
+    from twisted.internet import defer, error, protocol, reactor
+
+    cmdline = [str(s) for s in cmd]
+
+    class CommandProtocol(protocol.ProcessProtocol):
+        def __init__(self):
+            self.output = {1: [], 2: []}
+            self.decoders = {fd: codecs.getincrementaldecoder('utf-8')('replace')
+                             for fd in self.output}
+
+        def childDataReceived(self, fd, data):
+            self.output[fd].append(self.decoders[fd].decode(data))
+
+        def processEnded(self, reason):
+            if d.called:
+                # It was cancelled
+                return
+            out, err = [''.join(self.output[fd]) + self.decoders[fd].decode(b'', True)
+                        for fd in (1, 2)]
+            d.callback(command_result(cmdline, reason.value.exitCode, out, err))
+
+    def kill(deferred):
+        try:
+            proto.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+    proto = CommandProtocol()
+    d = defer.Deferred(canceller=kill)
+    # spawnProcess doesn't search the PATH
+    executable = shutil.which(cmdline[0]) or cmdline[0]
+    try:
+        reactor.spawnProcess(proto, executable, cmdline, env=os.environ)
+    except OSError as e:
+        return defer.succeed((False, str(e)))
+    if timeout is not None:
+        d.addTimeout(timeout, reactor)
+    return d
+
+
+class CommandRunner:
+    """Run commands with run_command_async, but at most concurrency of them
+    at the same time; the rest wait in a queue."""
+    def __init__(self, concurrency=4):
+        from twisted.internet import defer
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+
+    def run(self, cmd, timeout=None):
+        """Queue a command, see run_command_async. The timeout starts when the
+        command starts."""
+        return self.semaphore.run(run_command_async, cmd, timeout)
     
 def days_since_epoch():
     epoch = datetime.datetime.utcfromtimestamp(0)
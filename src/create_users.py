@@ -5,7 +5,6 @@
 # Licensed under GNU General Public License 3.0 or later.
 # Some rights reserved. See COPYING, AUTHORS.
 
-import datetime
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
@@ -14,6 +13,7 @@ import config
 import libuser
 import ltsp_shared_folders
 import dialogs
+import jobs
 import os
 
 class NewUsersDialog:
@@ -97,10 +97,9 @@ class NewUsersDialog:
             for compn in range(1, self.computers+1):
                 if len(self.user_store) == 300:
                     break
-                ev = lambda x: x.replace('{c}', classn.strip()).replace('{i}', 
-                    str(compn)).replace('{0i}', '%02d' %compn)
+                ev = lambda x: libuser.expand_template(x, classn, compn)
                 self.user_store.append([ev(self.username_tmpl), ev(self.name_tmpl),
-                    self.home + ev(self.username_tmpl),ev(self.password_tmpl)])
+                    os.path.join(self.home, ev(self.username_tmpl)), ev(self.password_tmpl)])
 
         users_number = self.computers * len(self.classes)
         self.glade.get_object('users_number_label').set_text(
@@ -111,89 +110,72 @@ class NewUsersDialog:
             get_value_as_int()
         self.groups_tmpl = self.glade.get_object('groups_template_entry').\
             get_text()
-        button_close = self.glade.get_object('button_close')
 
         total_users = self.computers * len(self.classes)
-        total_groups = len(self.classes)
-
-        progress = dialogs.ProgressDialog(_("Creating all users"), total_users + total_groups, self.dialog, on_close=self.on_button_cancel_clicked)
-
-        users_created = 0
-        groups_created = 0
-        set_gids = []
-        set_uids = []
-
-        # Create groups for all the listed classes
-        if self.classes != ['']:
-            for classn in self.classes:
-                dialogs.wait_gtk()
-                if classn not in self.system.groups:
-                    tmp_gid = self.system.get_free_gid(exclude=set_gids)
-                    set_gids.append(tmp_gid)
-                    cmd_error = self.system.add_group(libuser.Group(classn, tmp_gid, {}))
-                    progress.set_message(_("Creating group %(current)d of %(total)d...")
-                        % {"current":groups_created+1, "total":total_groups})
-                    if cmd_error[0] and cmd_error[1] != "":
-                        self.glade.get_object('error_label').set_text(cmd_error[1])
-                        self.glade.get_object('error_hbox').show() 
-                        button_close.set_sensitive(True)
-                        return
-                    groups_created += 1
-                    progress.set_progress(groups_created)
-                else:
-                    tmp_gid=self.system.groups[classn].gid
-                    groups_created += 1
-                
-                # Add teachers to group
-                if self.glade.get_object('teachers_checkbutton').get_active():
-                    progress.set_message(_("Adding teachers to group {group}").format(group=classn))
-                    for user in self.system.users.values():
-                        dialogs.wait_gtk()
-                        if 'teachers' in user.groups and classn not in user.groups:
-                            user.groups.append(classn)
-                            self.system.update_user(user.name, user)
-            
-            # Create shared folders
-            if self.glade.get_object('shared_checkbutton').get_active():
-                for classn in self.classes:
-                    progress.set_message(_("Adding shares for {group}").format(group=classn))
-                    dialogs.wait_gtk()
-                    self.sf.add([classn])
-                
-
-        # And finally, create the users
-        cmd_error = (False, '')
-        for classn in self.classes:
-            for compn in range(1, self.computers+1):
-                dialogs.wait_gtk()
-                progress.set_message(_("Creating user %(current)d of %(total)d...")
-                    % {"current":users_created+1, "total":total_users})
-
-                ev = lambda x: x.replace('{c}', classn.strip()).replace('{i}', 
-                                str(compn)).replace('{0i}', '%02d'%compn)
-                epoch = datetime.datetime.utcfromtimestamp(0)
-                uname = ev(self.username_tmpl)
-                tmp_uid = self.system.get_free_uid(exclude=set_uids)
-                set_uids.append(tmp_uid)
-                tmp_gid = self.system.get_free_gid(exclude=set_gids)
-                tmp_password=ev(self.password_tmpl)
-                # Create the UPG
-                g = libuser.Group(uname, tmp_gid)
-                self.system.add_group(g)
-                u=libuser.User(name=uname, uid=tmp_uid,
-                    gid=tmp_gid, rname=ev(self.name_tmpl),
-                    directory=(self.home + ev(self.username_tmpl)),
-                    lstchg = (datetime.datetime.today() - epoch).days,
-                    groups=[classn],
-                    password=self.system.encrypt(tmp_password))
-                cmd_error = self.system.add_user(u)
-                self.system.load()
-                users_created += 1
-                progress.set_progress(groups_created + users_created)
-
-        if cmd_error[0] and cmd_error[1] != "":
-            self.progress.set_error(cmd_error.strip())
+
+        # The accounts are written at once, after the passwords are encrypted.
+        # Then the homes are created, and finally the shared folders.
+        progress = dialogs.ProgressDialog(_("Creating all users"), total_users + 3, self.dialog, on_close=self.on_button_cancel_clicked)
+
+        try:
+            new_users, new_groups, passwords = self.system.prepare_batch(
+                self.classes, self.computers, self.username_tmpl,
+                self.name_tmpl, self.password_tmpl, self.home,
+                self.glade.get_object('teachers_checkbutton').get_active())
+        except ValueError as e:
+            progress.set_error(str(e))
             return
+        set_uids = [u.uid for u in new_users]
+        set_gids = [g.gid for g in new_groups]
+        # Hash the passwords in the background, while the job starts
+        hash_futures = self.system.hasher.submit(passwords)
+
+        def collect_passwords(step):
+            # Collect the password hashes, in the same order as the users
+            hashes = []
+            # Without the hashes the accounts would be saved locked
+            try:
+                for future in hash_futures:
+                    hashes.extend(future.result())
+            except Exception as e:
+                raise jobs.Abort(str(e) or e.__class__.__name__)
+            for user, password in zip(new_users, hashes):
+                user.password = password
+
+        def save_accounts(step):
+            success, error = self.system.apply_batch(new_users, new_groups, create_home=False)
+            if not success:
+                raise jobs.Abort(error.strip())
+
+        steps = [(_("Encrypting the passwords..."), collect_passwords),
+                 (_("Saving all the accounts..."), save_accounts)]
+        for user in new_users:
+            steps.append((_("Creating the home directory of {user}").format(user=user.name),
+                          lambda step, user=user: self.system.create_home(user)))
+        job = jobs.Job(steps, lambda step: step[1](step), describe=lambda step: step[0],
+                       on_done=lambda job: self.on_users_created(job, set_uids, set_gids))
+        job.start(progress)
+
+    def on_users_created(self, job, set_uids, set_gids):
+        # Process the new accounts now, instead of waiting for the notification
+        self.system.update()
+        self.system.release_uids(set_uids)
+        self.system.release_gids(set_gids)
+        if job.cancelled:
+            return
+
+        # Create shared folders, now that the class groups exist
+        if self.classes != [''] and self.glade.get_object('shared_checkbutton').get_active():
+            job.progress.set_message(_("Adding shares for {group}").format(
+                group=', '.join(self.classes)))
+            dialogs.wait_gtk()
+            # All the classes in one plan, which mounts them in parallel
+            results = self.sf.add(self.classes)
+            failed = [action for action in results if action.error]
+            if failed:
+                job.progress.set_error('\n'.join(str(action) for action in failed))
+        if not job.errors:
+            job.progress.set_progress(len(job.items) + 1)
 
     def on_button_cancel_clicked(self, widget=None):
         self.dialog.destroy()
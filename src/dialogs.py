@@ -84,13 +84,39 @@ class ProgressDialog():
         self.progress_dialog.show()
         self.progressbar = self.glade.get_object('users_progressbar')
         self.num = 1
+        self.job = None
+        self.failed = False
 
         self.on_close = on_close
 
+    def set_job(self, job):
+        """Show the pause and stop buttons for a jobs.Job."""
+        self.job = job
+        self.glade.get_object('button_pause').show()
+        self.glade.get_object('button_stop').show()
+
+    def job_finished(self):
+        self.glade.get_object('button_pause').hide()
+        self.glade.get_object('button_stop').hide()
+
+    def on_progress_button_pause_toggled(self, widget):
+        if widget.get_active():
+            self.job.pause()
+            self.set_message(_("Paused"))
+        else:
+            self.job.resume()
+
+    def on_progress_button_stop_clicked(self, widget):
+        widget.set_sensitive(False)
+        self.glade.get_object('button_pause').set_sensitive(False)
+        self.set_message(_("Stopping..."))
+        self.job.cancel()
+
     def set_message(self, message):
         self.progressbar.set_text(message)
 
     def set_error(self, message):
+        self.failed = True
         self.glade.get_object('error_label').set_text(message)
         self.glade.get_object('error_hbox').show()
         button_close = self.glade.get_object('button_close')
@@ -99,7 +125,7 @@ class ProgressDialog():
     def set_progress(self, num):
         self.num = num
         self.progressbar.set_fraction(float(num) / float(self.total))
-        if num == self.total:
+        if num == self.total and not self.failed:
             self.progressbar.set_text("done")
             self.glade.get_object('success_hbox').show()
             button_close = self.glade.get_object('button_close')
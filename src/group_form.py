@@ -163,12 +163,13 @@ class EditGroupDialog(GroupForm):
         self.group.gid = int(self.gid_entry.get_text())
         self.group.members = {u[0].name : u[0] for u in self.users_store if u[1]}
         
-        self.system.edit_group(old_name, self.group)
-        
-        # Remove the group from users that are no more members of this group
-        for user in old_members.values():
-            if user not in self.group.members.values():
-                self.system.remove_user_from_groups(user, [self.group])
+        with self.system.batch():
+            self.system.edit_group(old_name, self.group)
+            
+            # Remove the group from users that are no more members of this group
+            for user in old_members.values():
+                if user.name not in self.group.members:
+                    self.system.remove_user_from_groups(user, [self.group])
         if self.shared_state and not self.has_shared.get_active():
             # Shared folders were active but now they are not
             self.sf.remove([self.group.name])
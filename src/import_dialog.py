@@ -8,25 +8,27 @@
 import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('Gdk', '3.0')
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
 import os
 import re
 import sys
 
-import common
 import dialogs
+import jobs
 import libuser
 import user_form
 
 # NOTE: User.plainpw overrides the User.password if it's set
 class ImportDialog:
-    def __init__(self, new_set, parent=None):
+    def __init__(self, new_set, parent=None, chunks=None):
+        """If chunks is given, it's an iterator (like parsers.CSV.iter_parse)
+        that adds more users to new_set and yields them in lists. They're
+        appended to the list while idle, so that big files can be reviewed
+        before they're fully parsed."""
         self.set = new_set
         self.parent = parent
-        # Remove the system users from the set
-        for u in list(self.set.users.values()):
-            if u.uid is not None and u.is_system_user():
-                self.set.remove_user(u)
+        self.chunks = chunks
+        users = self.RemoveSystemUsers(self.set.users.values())
         
         gladefile = "import_dialog.ui"
         self.builder = Gtk.Builder()
@@ -48,9 +50,38 @@ class ImportDialog:
         self.menu = self.builder.get_object("menu")
         
         self.states = {'ok' : Gtk.STOCK_OK, 'error' : Gtk.STOCK_DIALOG_WARNING}
+        # The IDs of the new users are reserved until the dialog is closed,
+        # so that the automatically assigned ones don't collide with them
+        self.reserved_uids = []
+        self.reserved_gids = []
+        self.ReserveIds(users)
         self.dialog.show_all()
         self.TreeView()
-        self.FillTree(self.set)
+        if self.chunks is None:
+            self.FillTree(self.set)
+        else:
+            self.apply.set_sensitive(False)
+            self.resolve.set_sensitive(False)
+            self.AddRows(users)
+            GLib.idle_add(self.FillChunk)
+
+    def RemoveSystemUsers(self, users):
+        """Remove the system users from the set, return the rest."""
+        rest = []
+        for u in list(users):
+            if u.uid is not None and u.is_system_user():
+                self.set.remove_user(u)
+            else:
+                rest.append(u)
+        return rest
+
+    def ReserveIds(self, users):
+        uids = [u.uid for u in users if u.uid is not None]
+        gids = [u.gid for u in users if u.gid is not None]
+        libuser.get_system().reserve_uids(uids)
+        libuser.get_system().reserve_gids(gids)
+        self.reserved_uids.extend(uids)
+        self.reserved_gids.extend(gids)
     
     def TreeView(self):        
         """Make the liststore, the first 20 cells refers to users values,
@@ -90,7 +121,33 @@ class ImportDialog:
     
     def FillTree(self, new_set):
         """Fill the preview popup dialog with new users."""
-        for u in new_set.users.values():
+        self.AddRows(new_set.users.values())
+        self.DetectConflicts()
+        self.CheckIdenticalUsers()
+
+    def FillChunk(self):
+        """Append the next chunk of users, called while idle."""
+        if self.chunks is None:
+            return False
+        users = next(self.chunks, None)
+        if users is None:
+            self.chunks = None
+            self.resolve.set_sensitive(True)
+            self.DetectConflicts()
+            self.CheckIdenticalUsers()
+            return False
+        users = self.RemoveSystemUsers(users)
+        self.ReserveIds(users)
+        self.AddRows(users)
+        return True
+
+    def StopFilling(self):
+        if self.chunks is not None:
+            self.chunks.close()
+            self.chunks = None
+
+    def AddRows(self, users):
+        for u in users:
             self.AutoComplete(u)
             data = [u.name, u.uid, u.gid, u.primary_group, u.rname, u.office, 
                     u.wphone, u.hphone, u.other, u.directory, u.shell, 
@@ -101,10 +158,9 @@ class ImportDialog:
             data.extend(["black"]*numitems)   # cell's foreground color
             data.extend(['']*numitems)        # cell's problem or ''
             data.append(self.states['ok'])    # row's status
+            self.set.index_user(u)
             row = self.list[self.list.append(data)]
             self.SetRowFromObject(row)
-        self.DetectConflicts()
-        self.CheckIdenticalUsers()
     
     def SetRowFromObject(self, row):
         u = self.set.users[row[0]]
@@ -131,7 +187,7 @@ class ImportDialog:
                 u_old = other.users[name]
                 same = True
                 for attr in attrs:
-                    if u_new.__dict__[attr] != u_old.__dict__[attr]:
+                    if getattr(u_new, attr) != getattr(u_old, attr):
                         same = False
                         break
                 if set(u_new.groups+[u_new.primary_group]) != set(u_old.groups):
@@ -151,62 +207,26 @@ class ImportDialog:
             self.DetectConflicts()
         
     
-    def AutoComplete(self, user): # TODO: Maybe move me to libuser?
+    def AutoComplete(self, user):
         """Fills the missing information of user, where possible."""
-        #TODO: Complete the username from real name, this can't be done now
-        # since we are using a dict to store users with username as a key
-        #  - Needs design change -
-        
-        if user.directory in [None, '']:
-            user.directory = os.path.join(libuser.HOME_PREFIX, user.name)
-        if user.uid in [None, '']:
-            set_uids = [user.uid for u in self.set.users.values()]
-            user.uid = libuser.get_system().get_free_uid(exclude=set_uids)
-        
-        set_gids = [u.gid for u in self.set.users.values()]
-        sys_gids = {g.gid : g for g in libuser.get_system().groups.values()}
-        if user.gid in [None, '']:
-            # print("user has no gid", user.name)
-            if user.primary_group in [None, '']:
-                user.primary_group = user.name
-            if user.name in libuser.get_system().groups:
-                user.gid = libuser.get_system().groups[user.name].gid
-            else:
-                user.gid = libuser.get_system().get_free_gid(exclude=set_gids)
-            # print("gid found : ", user.gid)
-        else:
-            #print("User has no primary group but a gid:  ", user.gid)
-            if user.primary_group in [None, '']:
-                if user.gid in sys_gids:
-                    user.primary_group = sys_gids[user.gid].name
-                else:
-                    user.primary_group = user.name
-            #print("primary group found: ", user.primary_group, " for ", user.name)
-        if user.primary_group in [None, '']:
-            allgroups = self.set.groups.values()[:]
-            allgroups.extend(libuser.get_system().groups.values())
-            for gr_obj in allgroups:
-                if gr_obj.gid == user.gid:
-                    user.primary_group = gr_obj.name
-                    break
-        if user.shell in [None, '']:
-            user.shell = '/bin/bash'
-        if user.min in [None, '']:
-            user.min = 0
-        if user.max in [None, '']:
-            user.max = 99999
-        if user.warn in [None, '']:
-            user.warn = 7
-        if user.lstchg in [None, '']:
-            user.lstchg = common.days_since_epoch()
-        if user.inact in [None, '']:
-            user.inact = -1
-        if user.expire in [None, '']:
-            user.expire = -1
-        if user.password in [None, '']:
-            user.password = '!'
-        if user.plainpw is None:
-            user.plainpw = ''
+        libuser.get_system().complete_user(user, self.allocate_uid,
+                                           self.allocate_gid, self.set)
+
+    def allocate_uid(self):
+        uid = libuser.get_system().allocate_uids()[0]
+        self.reserved_uids.append(uid)
+        return uid
+
+    def allocate_gid(self):
+        gid = libuser.get_system().allocate_gids()[0]
+        self.reserved_gids.append(gid)
+        return gid
+
+    def release_ids(self):
+        libuser.get_system().release_uids(self.reserved_uids)
+        libuser.get_system().release_gids(self.reserved_gids)
+        self.reserved_uids = []
+        self.reserved_gids = []
     
     def SetRowProps(self, row, col, prob, color=None, state=None):
         row[col+40] = prob
@@ -240,18 +260,11 @@ class ImportDialog:
         Here we don't check for conflicts with secondary groups as they are
         easily resolvable.
         """
-        # All the system users
-        sys_users = {'uids' : [], 'gids' : [], 'dirs' : []}
-        sys_users['uids'] = [user.uid for user in libuser.get_system().users.values()]
-        sys_users['gids'] = [user.gid for user in libuser.get_system().users.values()]
-        sys_users['dirs'] = [user.directory for user in libuser.get_system().users.values()]
-        # All the users in the new Set
-        new_users = {'uids' : [], 'gids' : [], 'dirs' : []}
-        new_users['uids'] = [user.uid for user in self.set.users.values()]
-        new_users['gids'] = [user.gid for user in self.set.users.values()]
-        new_users['dirs'] = [user.directory for user in self.set.users.values()]
+        # The system users are looked up in the libuser.System indexes
+        system = libuser.get_system()
+        valid_shells = set(system.get_valid_shells())
         
-        passed_users = {'names' : [], 'uids' : [], 'gids' : [], 'dirs' : []}
+        passed_users = {'names' : set(), 'uids' : set(), 'gids' : set(), 'dirs' : set()}
         errors_found = False
         for row in self.list:
             u = self.set.users[row[0]]
@@ -295,7 +308,7 @@ class ImportDialog:
             if not libuser.get_system().gecos_is_valid(u.other):
                 invalidate(8)
             # Not checking homedir validity
-            if not libuser.get_system().shell_is_valid(u.shell):
+            if u.shell not in valid_shells:
                 invalidate(10)
             for group in u.groups:
                 if not libuser.get_system().name_is_valid(group):
@@ -319,7 +332,7 @@ class ImportDialog:
             # Conflict checking (Existing system users)
             if u.name in libuser.get_system().users:
                 self.SetRowProps(row, 0, 'con')
-            if u.uid in sys_users['uids']:
+            if u.uid in system.users_by_uid:
                 self.SetRowProps(row, 1, 'con')
             # Check if the given group matches the gid on the system
             if u.primary_group in libuser.get_system().groups:
@@ -328,22 +341,18 @@ class ImportDialog:
                 if u.gid != should_be:
                     self.SetRowProps(row, 2, 'mismatch %s' % should_be)
             # Check if the given gid matches the groupname
-            if u.gid in sys_users['gids']:
-                should_be = None
-                # iterate through groups to find name
-                for g in libuser.get_system().groups.values():
-                    if u.gid == g.gid:
-                        should_be = g.name
-                        break
+            if u.gid in system.users_by_gid:
+                groups = system.get_groups_by_gid(u.gid)
+                should_be = groups[0].name if groups else None
                 # set the missmatch
                 if should_be != u.primary_group:
                     print("missmatch for ", u, should_be)
                     self.SetRowProps(row, 3, 'mismatch %s' % should_be)
-            if u.directory in sys_users['dirs']:
+            if u.directory in system.users_by_directory:
                 self.SetRowProps(row, 9, 'con')
             else:
                 # Special case, we want to use existing home dirs if they are not already used.
-                if os.path.isdir(u.directory) and u.directory not in sys_users['dirs']: 
+                if os.path.isdir(u.directory):
                     # See if the home and the uid:gid of the user are different
                     #print "Homedir for user %s exists in the FS." % u.name # XXX: Debug
                     dir_stat = os.stat(u.directory)
@@ -356,28 +365,18 @@ class ImportDialog:
                     #print "\tUser: - %s:%s -" % (u.uid, u.gid) # XXX: Debug
                     #print "\tDir : - %s:%s -" % (dir_stat.st_uid, dir_stat.st_gid) # XXX: Debug
             
-            passed_users['names'].append(u.name)
-            passed_users['uids'].append(u.uid)
-            passed_users['gids'].append(u.gid)
-            passed_users['dirs'].append(u.directory)
+            passed_users['names'].add(u.name)
+            passed_users['uids'].add(u.uid)
+            passed_users['gids'].add(u.gid)
+            passed_users['dirs'].add(u.directory)
             
             if row[60] == self.states['error']:
                 errors_found = True
         
-        self.apply.set_sensitive(not errors_found)
+        # Apply only after all the streamed users were added
+        self.apply.set_sensitive(not errors_found and self.chunks is None)
     
     def ResolveConflicts(self, widget=None):
-        # All the system users
-        sys_users = {'uids' : [], 'gids' : [], 'dirs' : []}
-        sys_users['uids'] = [user.uid for user in libuser.get_system().users.values()]
-        sys_users['gids'] = [user.gid for user in libuser.get_system().users.values()]
-        sys_users['dirs'] = [user.directory for user in libuser.get_system().users.values()]
-        # All the users in the new Set
-        new_users = {'uids' : [], 'gids' : [], 'dirs' : []}
-        new_users['uids'] = [user.uid for user in self.set.users.values()]
-        new_users['gids'] = [user.gid for user in self.set.users.values()]
-        new_users['dirs'] = [user.directory for user in self.set.users.values()]
-        
         log = []
         def log_msg(txt):
             log.append(txt)
@@ -398,28 +397,25 @@ class ImportDialog:
             ofs = 40
             
             if row[1+ofs] in ['dup', 'con']:
-                new_uid = libuser.get_system().get_free_uid(exclude=new_users['uids'])
-                new_users['uids'].append(new_uid)
+                new_uid = self.allocate_uid()
                 log_uid(u.name, u.uid, new_uid)
                 u.uid = new_uid
                 self.SetRowProps(row, 1, '')
                 
             elif row[1+ofs] == 'hijack':
                 dir_uid = os.stat(u.directory).st_uid
-                new_users['uids'].append(dir_uid)
                 log_uid(u.name, u.uid, dir_uid)
                 u.uid = dir_uid
                 self.SetRowProps(row, 1, '')
                 
             #if row[2+ofs] in ['dup', 'con']:
-            #    new_gid = libuser.get_system().get_free_gid(exclude=new_users['gids'])
-            #    new_users['gids'].append(new_gid)
+            #    new_gid = self.allocate_gid()
             #    log_gid(u.name, u.gid, new_gid)
             #    u.uid = new_uid
             #    self.SetRowProps(row, 2, '')
             
             if 'missmatch' in row[2+ofs] and 'missmatch' in row[3+ofs]:
-                new_gid = libuser.get_system().get_free_gid(exclude=new_users['gids'])
+                new_gid = self.allocate_gid()
                 new_gname = row[3+ofs].split()[1] + '_imported'
                 log_gid(u.name, u.gid, new_gid)
                 log_group(u.name, u.group, new_gname)
@@ -429,16 +425,15 @@ class ImportDialog:
             if 'mismatch' in row[2+ofs]:
                 # conflict in gid
                 new_gid = int(row[2+ofs].split()[1])
-                new_users['gids'].append(new_gid)
                 log_gid(u.name, u.gid, new_gid)
                 if u.primary_group in self.set.groups:
                     self.set.groups[u.primary_group].gid = new_gid
+                    self.set.index_group(self.set.groups[u.primary_group])
                 u.gid = new_gid
                 self.SetRowProps(row, 2, '')
                 
             if row[2+ofs] == 'hijack':
                 dir_gid = os.stat(u.directory).st_gid
-                new_users['gids'].append(dir_gid)
                 log_gid(u.name, u.gid, dir_gid)
                 u.gid = dir_gid
                 self.SetRowProps(row, 2, '')
@@ -447,19 +442,20 @@ class ImportDialog:
                 # conflict in groupname
                 new_gname = row[3+ofs].split()[1]
                 log_group(u.name, u.primary_group, new_gname)
-                if new_gname in self.set.groups:
-                    if u.name not in self.set.groups[new_gname].members:
-                        self.set.groups[new_gname].members[u.name] = u
-                else:
+                if new_gname not in self.set.groups:
                     self.set.groups[new_gname] = libuser.Group(new_gname, u.gid)
-                    self.set.groups[new_gname].members[u.name] = u
+                    self.set.index_group(self.set.groups[new_gname])
+                self.set.add_member(self.set.groups[new_gname], u)
                 if u.primary_group in self.set.groups:
-                    if self.set.groups[u.primary_group].members.keys() == [u.name]:
+                    old_group = self.set.groups[u.primary_group]
+                    if list(old_group.members) == [u.name]:
+                        self.set.unindex_group(old_group)
                         del self.set.groups[u.primary_group]
                     else:
-                        del self.set.groups[u.primary_group].members[u.name]
+                        self.set.remove_member(old_group, u.name)
                 u.primary_group = new_gname
                 self.SetRowProps(row, 3, '')
+            self.set.index_user(u)
             self.SetRowFromObject(row)
 
         print(log)
@@ -496,65 +492,65 @@ class ImportDialog:
         text = _("Create the following users?\n\n" + ', '.join([u.name for u in self.set.users.values()]))
         response = dialogs.AskDialog(text, "Confirm", parent=self.dialog).showup()
         if response == Gtk.ResponseType.YES:
-            new_groups = {}
-            new_gids = [u.gid for u in self.set.users.values()]
-            sys_gids = [g.gid for g in libuser.get_system().groups.values()]
-            for u in self.set.users.values():
-                if u.primary_group not in libuser.get_system().groups:
-                   if u.primary_group not in new_groups:
-                        g_obj = libuser.Group(u.primary_group, u.gid)
-                        new_groups[u.primary_group] = g_obj
-                   new_groups[u.primary_group].members[u.name] = u
-            
-            for u in self.set.users.values():
-                for g in u.groups:
-                    if g not in libuser.get_system().groups:
-                        if g not in new_groups:
-                            g_obj = libuser.Group(g)
-                            if g in self.set.groups:
-                                g_obj.gid = self.set.groups[g].gid
-                            if g_obj.gid in new_gids+sys_gids or g_obj.gid is None:
-                                g_obj.gid = libuser.get_system().get_free_gid(exclude=new_gids)
-                                new_gids.append(g_obj.gid)
-                            new_groups[g] = g_obj
-                        new_groups[g].members[u.name] = u
-            operations = len(new_groups) + len(self.set.users)
-            for gr in new_groups.values():
-                operations += len(gr.members)
-            progress = dialogs.ProgressDialog(_("Creating all users"), operations, self.dialog)
-            def wait_gtk():
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-            for gr in new_groups.values():
-                wait_gtk()
-                progress.set_message(_("Adding group {group}").format(group=gr.name))
-                gr_tmp = libuser.Group(gr.name, gr.gid)
-                libuser.get_system().add_group(gr_tmp)
-                progress.inc()
-            for u in self.set.users.values():
-                wait_gtk()
-                progress.set_message(_("Adding user {user}").format(user=u.name))
-                libuser.get_system().add_user(u)
-                progress.inc()
-            for gr in new_groups.values():
-                for u in gr.members.values():
-                    wait_gtk()
-                    progress.set_message(_("Adding user {user} to group {group}").format(user=u.name, group=gr.name))
-                    libuser.get_system().add_user_to_groups(u, [gr])
-                    progress.inc()
-            
+            # The passwords are encrypted only now and in parallel, as it's
+            # slow for many users
+            users = [u for u in self.set.users.values() if u.plainpw]
+            hash_futures = libuser.get_system().hasher.submit(u.plainpw for u in users)
+            all_users = list(self.set.users.values())
+            new_groups = libuser.get_system().import_groups(
+                all_users, self.set, self.allocate_gid)
+
+            def collect_passwords(step):
+                hashes = []
+                # Without the hashes the accounts would be saved locked
+                try:
+                    for future in hash_futures:
+                        hashes.extend(future.result())
+                except Exception as e:
+                    raise jobs.Abort(str(e) or e.__class__.__name__)
+                for user, password in zip(users, hashes):
+                    user.password = password
+
+            def save_accounts(step):
+                success, error = libuser.get_system().apply_batch(
+                    all_users, new_groups, create_home=False)
+                if not success:
+                    raise jobs.Abort(error.strip())
+
+            steps = [(_("Encrypting the passwords..."), collect_passwords),
+                     (_("Adding {users} users and {groups} groups").format(
+                         users=len(all_users), groups=len(new_groups)), save_accounts)]
+            for user in all_users:
+                steps.append((_("Creating the home directory of {user}").format(user=user.name),
+                              lambda step, user=user: libuser.get_system().create_home(user)))
+            progress = dialogs.ProgressDialog(_("Creating all users"), len(steps), self.dialog)
+            job = jobs.Job(steps, lambda step: step[1](step), describe=lambda step: step[0],
+                           on_done=self.on_accounts_created)
+            job.start(progress)
         else:
             return False
-            
-        
-        self.dialog.destroy()
 
+    def on_accounts_created(self, job):
+        # Keep the dialog and the reserved IDs if the accounts weren't saved
+        if job.done < 2:
+            return
+        libuser.get_system().update()
+        self.release_ids()
+        # Keep the dialog while the progress dialog shows the errors
+        if job.errors:
+            self.apply.set_sensitive(False)
+        else:
+            self.dialog.destroy()
 
     def Cancel(self, widget):
+        self.StopFilling()
+        self.release_ids()
         widget.destroy()
         self.dialog.destroy()
 
     def Exit(self, widget, event):
+        self.StopFilling()
+        self.release_ids()
         self.dialog.destroy()
     
     def Tooltip(self, widget, x, y, keyboard_tip, tooltip):
@@ -626,16 +622,15 @@ class ImportDialog:
                  'plainpw']
         if col in int_columns:
             try:
-                u.__dict__[attrs[col]] = int(new_text)
+                setattr(u, attrs[col], int(new_text))
             except ValueError:
                 return
         else:
             if col == 0:
                 if new_text in self.set.users:
                     return
-                u.name = new_text
+                self.set.rename_user(u, new_text)
                 u.directory = '/home/%s' % new_text
-                self.set.users[new_text] = self.set.users.pop(username)
                 model[path][0] = u.name
             elif col == 11:
                 u.groups = new_text.strip().split(',')
@@ -644,7 +639,8 @@ class ImportDialog:
                 u.plainpw = new_text
                 u.password = libuser.get_system().encrypt(u.plainpw)
             else:
-                u.__dict__[attrs[col]] = new_text
+                setattr(u, attrs[col], new_text)
+        self.set.index_user(u)
         self.SetRowFromObject(model[path])
         self.DetectConflicts()
         
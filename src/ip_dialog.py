@@ -14,6 +14,7 @@ from binascii import unhexlify, hexlify
 import re
 import uuid
 import struct, socket
+import sys
 import dialogs
 import dbus
 import common
@@ -46,6 +47,11 @@ TITLE_SUCCESS = _("Success")
 
 ## Define global functions
 
+def log_failure(failure, description):
+    """A Deferred errback that logs the failure, and returns None so that
+    e.g. gatherResults() still fires with the rest of the results."""
+    sys.stderr.write("%s failed: %s\n" % (description, failure.getErrorMessage()))
+
 def string_to_int32(address):
     """
     Convert ip to int32
@@ -300,6 +306,7 @@ class Interface:
         self.dhcp_request_info = None
         self.has_active_connection = False
         self._set_ips()
+        self.dhcp_request_info = Info()
 
     def __getattr__(self, item):
         # Return first dhcp values and then existing values
@@ -327,12 +334,19 @@ class Interface:
             })
             self.has_active_connection = True
 
-        self.dhcp_request_info = Info()
-        p = common.run_command(['/usr/lib/klibc/bin/ipconfig', '-n', '-t2', self.interface], True)
-        while p.poll() is None:
-            while Gtk.events_pending():
-                Gtk.main_iteration()
-        if p.returncode == 0:
+    def request_dhcp(self, runner):
+        """
+        Send a DHCP request with the common.CommandRunner, return a Deferred
+        """
+        d = runner.run(['/usr/lib/klibc/bin/ipconfig', '-n', '-t2', self.interface])
+        d.addCallback(self._on_dhcp_reply)
+        # Without a reply, the interface is shown with its existing settings
+        d.addErrback(log_failure, "DHCP request on %s" % self.interface)
+        return d
+
+    def _on_dhcp_reply(self, result):
+        success, output = result
+        if success:
             dhcp_parser = parsers.DHCP()
             dhcp_dict = dhcp_parser.parse(self.interface)
             self.has_active_connection = True
@@ -421,6 +435,8 @@ class Ip_Dialog:
         self.interfaces_diff_subnet = []
         self.timeout = 0
         self.settings = None
+        # Limits the DHCP requests and arpings that run at the same time
+        self.runner = common.CommandRunner()
         # TODO: don't use Greek school DNS servers
         self.ts_dns = ['127.0.0.1', '194.63.238.4', '8.8.8.8']
         self.ltsp_ips = dict(ip='192.168.67.1', mask='255.255.255.0', route='0.0.0.0')
@@ -471,6 +487,13 @@ class Ip_Dialog:
             return
         self.interfaces.sort(key=lambda interface: interface.interface)
 
+        # Send the DHCP requests of the interfaces in parallel, through the runner
+        from twisted.internet import defer
+        d = defer.gatherResults([interface.request_dhcp(self.runner) for interface in self.interfaces],
+                                consumeErrors=True)
+        d.addCallback(self.populate_interfaces)
+
+    def populate_interfaces(self, result=None):
         # Populate GUI
         for interface in self.interfaces:
             if interface.dhcp_request_info.subnet and interface.existing_info.subnet and \
@@ -546,27 +569,8 @@ class Ip_Dialog:
                 break_bool = False
         
         if break_bool:
-            p = common.run_command(['sh', '-c', 'ltsp-config dnsmasq  --enable-dns --overwrite'], True)
-            while p.poll() is None:
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-
-            if p.returncode == 0:
-                msg = MSG_DNSMASQ_RESTART_SUCCESS
-                if prefered_hostname:
-                    msg = MSG_SUGGEST_HOSTNAME.format(prefered_hostname) + msg
-
-                success_dialog = dialogs.InfoDialog(MSG_TITLE_CONNECTIONS_CREATE, TITLE_SUCCESS)
-                success_dialog.format_secondary_markup(msg)
-                success_dialog.set_transient_for(self.main_dlg)
-                success_dialog.showup()
-                self.main_dlg.destroy()
-            else:
-                error_dialog = dialogs.ErrorDialog(MSG_TITLE_DNSMASQ_RESTART_FAIL, TITLE_ERROR)
-                error_dialog.format_secondary_markup(MSG_DNSMASQ_RESTART_FAIL)
-                error_dialog.set_transient_for(self.main_dlg)
-                error_dialog.showup()
-                self.main_dlg.destroy()
+            d = common.run_command_async(['sh', '-c', 'ltsp-config dnsmasq  --enable-dns --overwrite'])
+            d.addCallback(self.on_dnsmasq_configured, prefered_hostname)
             return False
         elif not break_bool and self.timeout == 30000:
             msg = MSG_DNSMASQ_RESTART_FAIL_ENABLE
@@ -581,31 +585,66 @@ class Ip_Dialog:
             return False
         return True
 
+    def on_dnsmasq_configured(self, result, prefered_hostname):
+        success, output = result
+        if success:
+            msg = MSG_DNSMASQ_RESTART_SUCCESS
+            if prefered_hostname:
+                msg = MSG_SUGGEST_HOSTNAME.format(prefered_hostname) + msg
+
+            success_dialog = dialogs.InfoDialog(MSG_TITLE_CONNECTIONS_CREATE, TITLE_SUCCESS)
+            success_dialog.format_secondary_markup(msg)
+            success_dialog.set_transient_for(self.main_dlg)
+            success_dialog.showup()
+            self.main_dlg.destroy()
+        else:
+            error_dialog = dialogs.ErrorDialog(MSG_TITLE_DNSMASQ_RESTART_FAIL, TITLE_ERROR)
+            error_dialog.format_secondary_markup(MSG_DNSMASQ_RESTART_FAIL)
+            error_dialog.set_transient_for(self.main_dlg)
+            error_dialog.showup()
+            self.main_dlg.destroy()
+
     def create_update_connections(self, interest_interfaces, prefered_hostname, dnsmasq_via_carrier,
                                   dnsmasq_via_autoconnect):
+        # Test if the static ips exist in the network, with all the arpings in parallel.
+        # Case which doesn't work: User had set .10 manual and .10 is owned by another pc,
+        # arping always fail so we can't catch the conflict.
+        from twisted.internet import defer
+        checks = []
         for interface in interest_interfaces:
-            # Test if static ip exists in network
-            # Case which doesn't work: User had set .10 manual and .10 is owned by another pc,
-            # arping always fail so we can't catch the conflict.
             if interface.page.method_entry.get_active() == 2 and \
                             interface.carrier == 1 and self.nm.get_active_connections():
                 test_ip = interface.page.ip_entry.get_text()
                 if test_ip != interface.existing_info.ip:
-                    p = common.run_command(['arping', '-f', '-w1', '-I', interface.interface, test_ip], True)
-                    while p.poll() is None:
-                        while Gtk.events_pending():
-                            Gtk.main_iteration()
-                    if p.returncode == 0:
-                        interface.page.ip_entry.set_icon_from_stock(1, Gtk.STOCK_DIALOG_WARNING)
-                        interface.page.ip_entry.set_icon_tooltip_text(1, MSG_PC_CONFLICT_IP.format(test_ip))
-                        title = MSG_PC_CONFLICT_IP.format(test_ip)
-                        err_dialog = dialogs.ErrorDialog(title, TITLE_ERROR)
-                        err_dialog.set_transient_for(self.main_dlg)
-                        if err_dialog.showup() != Gtk.ResponseType.OK:
-                            self.main_dlg.set_sensitive(True)
-                            self.main_dlg.show()
-                            return
+                    d = self.runner.run(['arping', '-f', '-w1', '-I', interface.interface, test_ip])
+                    d.addCallback(lambda result, interface=interface, test_ip=test_ip:
+                                  (interface, test_ip, result[0]))
+                    # Like an arping without replies, don't block the address
+                    d.addErrback(lambda failure, interface=interface, test_ip=test_ip:
+                                 log_failure(failure, "arping %s" % test_ip) or
+                                 (interface, test_ip, False))
+                    checks.append(d)
+        d = defer.gatherResults(checks, consumeErrors=True)
+        d.addCallback(self.on_ips_checked, interest_interfaces, prefered_hostname,
+                      dnsmasq_via_carrier, dnsmasq_via_autoconnect)
+        # Don't repeat the idle callback
+        return False
+
+    def on_ips_checked(self, checks, interest_interfaces, prefered_hostname, dnsmasq_via_carrier,
+                       dnsmasq_via_autoconnect):
+        for interface, test_ip, in_use in checks:
+            if in_use:
+                interface.page.ip_entry.set_icon_from_stock(1, Gtk.STOCK_DIALOG_WARNING)
+                interface.page.ip_entry.set_icon_tooltip_text(1, MSG_PC_CONFLICT_IP.format(test_ip))
+                title = MSG_PC_CONFLICT_IP.format(test_ip)
+                err_dialog = dialogs.ErrorDialog(title, TITLE_ERROR)
+                err_dialog.set_transient_for(self.main_dlg)
+                if err_dialog.showup() != Gtk.ResponseType.OK:
+                    self.main_dlg.set_sensitive(True)
+                    self.main_dlg.show()
+                    return
 
+        for interface in interest_interfaces:
             if interface.conflict is not None:
                 interface.conflict.interface.Update(interface.connection)
                 if interface.carrier == 1 and interface.page.auto_checkbutton.get_active():
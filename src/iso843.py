@@ -66,9 +66,9 @@ def transcript(string, accents=True):
     letters = []
     for letter in string:
         if letter in _mapping_letters:
-            letters.append(_mapping_letters[letter].decode("utf-8"))
+            letters.append(_mapping_letters[letter])
         elif letter.lower() in _mapping_letters:
-            letters.append((_mapping_letters[letter.lower()].decode("utf-8")).upper())
+            letters.append(_mapping_letters[letter.lower()].upper())
         else:
             letters.append(letter)
 
@@ -96,9 +96,9 @@ def transliterate(string, accents=True):
     letters = []
     for letter in string:
         if letter in _mapping_letters:
-            letters.append(_mapping_letters[letter].decode("utf-8"))
+            letters.append(_mapping_letters[letter])
         elif letter.lower() in _mapping_letters:
-            letters.append((_mapping_letters[letter.lower()].decode("utf-8")).upper())
+            letters.append(_mapping_letters[letter.lower()].upper())
         else:
             letters.append(letter)
 
@@ -0,0 +1,133 @@
+# This File is part of the ltsp-manager.
+#
+# Copyright 2012-2018 by it's authors.
+#
+# Licensed under GNU General Public License 3.0 or later.
+# Some rights reserved. See COPYING, AUTHORS.
+
+"""
+Background jobs, for long batches of account operations.
+"""
+import threading
+import traceback
+
+from gi.repository import GLib
+
+# How many failed items to list in the progress dialog
+MAX_LISTED_ERRORS = 10
+
+
+class Abort(Exception):
+    """Raised by a job function to stop the whole job, e.g. when a step
+    failed that the next steps depend on."""
+
+
+class Job:
+    """Call func(item) for each item in a worker thread.
+
+    func may return a (success, error) pair, like common.run_command, or raise
+    an exception; either way the error is collected in self.errors and the
+    job continues with the next item, unless it was an Abort.
+    The GUI is only updated from the main thread, with idle callbacks.
+    If system is set, the job runs in a system.batch(), so that the account
+    changes are processed once, after the job.
+    """
+    def __init__(self, items, func, describe=str, system=None, on_done=None):
+        self.items = list(items)
+        self.func = func
+        self.describe = describe
+        self.system = system
+        self.on_done = on_done
+        self.errors = []
+        self.done = 0
+        self.cancelled = False
+        self.finished = False
+        self.progress = None
+        self.thread = None
+        self._unpaused = threading.Event()
+        self._unpaused.set()
+
+    def start(self, progress=None):
+        """Start the worker thread. If progress is a dialogs.ProgressDialog,
+        it shows the job progress and allows pausing or cancelling it."""
+        self.progress = progress
+        if progress:
+            progress.set_job(self)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def pause(self):
+        self._unpaused.clear()
+
+    def resume(self):
+        self._unpaused.set()
+
+    def is_paused(self):
+        return not self._unpaused.is_set()
+
+    def cancel(self):
+        """Stop after the current item."""
+        self.cancelled = True
+        self._unpaused.set()
+
+    def _run(self):
+        if self.system:
+            self.system.suspend()
+        try:
+            for item in self.items:
+                self._unpaused.wait()
+                if self.cancelled:
+                    break
+                GLib.idle_add(self._on_item_started, item)
+                try:
+                    result = self.func(item)
+                except Abort as e:
+                    self.errors.append((item, str(e)))
+                    self.cancelled = True
+                    break
+                except Exception as e:
+                    traceback.print_exc()
+                    self.errors.append((item, str(e)))
+                else:
+                    if isinstance(result, tuple) and len(result) == 2 and result[0] is False:
+                        self.errors.append((item, str(result[1]).strip()))
+                self.done += 1
+                GLib.idle_add(self._on_item_done, self.done)
+        finally:
+            if self.system:
+                self.system.resume()
+            GLib.idle_add(self._on_finished)
+
+    def _on_item_started(self, item):
+        if self.progress and not self.is_paused():
+            self.progress.set_message(self.describe(item))
+        return False
+
+    def _on_item_done(self, done):
+        # The final progress is set by _on_finished, after the errors
+        if self.progress and done < len(self.items):
+            self.progress.set_progress(done)
+        return False
+
+    def _on_finished(self):
+        self.finished = True
+        if self.progress:
+            self.progress.job_finished()
+            if self.errors or self.cancelled:
+                self.progress.set_error(self.error_summary())
+                self.progress.set_progress(self.done)
+            else:
+                self.progress.set_progress(len(self.items))
+        if self.on_done:
+            self.on_done(self)
+        return False
+
+    def error_summary(self):
+        lines = ['%s: %s' % (self.describe(item), error)
+                 for item, error in self.errors[:MAX_LISTED_ERRORS]]
+        if len(self.errors) > MAX_LISTED_ERRORS:
+            lines.append(_("and %d more errors") % (len(self.errors) - MAX_LISTED_ERRORS))
+        if self.cancelled:
+            lines.append(_("Stopped after %(done)d of %(total)d steps.")
+                         % {"done": self.done, "total": len(self.items)})
+        return '\n'.join(lines)
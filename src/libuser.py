@@ -10,8 +10,6 @@
 """
 User handling classes and functions.
 """
-from twisted.internet import inotify
-from twisted.python import filepath
 import pwd
 import spwd
 import grp
@@ -19,11 +17,22 @@ import operator
 import subprocess
 import re
 import crypt
-import random
 import common
 import iso843
 import paths
+import concurrent.futures
+import contextlib
+import errno
+import fcntl
+import gc
+import multiprocessing
 import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
 FIRST_SYSTEM_UID=0
 LAST_SYSTEM_UID=999
@@ -38,11 +47,49 @@ FIRST_GID=1000
 LAST_GID=29999
 NAME_REGEX = "^[a-z][-a-z0-9_]*$"
 HOME_PREFIX = "/home"
+HOME_MODE = 0o755
+
+# The lock file and timeout that lckpwdf(3) and the shadow utilities use
+PASSWD_LOCK = ".pwd.lock"
+LOCK_TIMEOUT = 15
+
+# The account files that System watches and incrementally reloads, in the
+# order they need to be processed
+WATCHED_FILES = ['passwd', 'shadow', 'group']
+
+# How System.load enumerates the accounts: 'nss' uses the pwd, spwd and grp
+# modules, so it includes e.g. LDAP accounts; 'files' parses the local account
+# files directly, which is much faster with large or networked directories
+LOAD_BACKENDS = ['nss', 'files']
+DEFAULT_BACKEND = 'nss'
+
+# The account snapshot cache of get_system(), which contains password hashes,
+# so it's only readable by its owner. Bump CACHE_VERSION when its rows change.
+CACHE_FILE = "accounts.cache"
+CACHE_VERSION = 1
+# The nsswitch.conf sources of accounts that are all in the local files, so
+# that the cache is valid when the files didn't change. The systemd dynamic
+# users are not managed here.
+LOCAL_NSS_SOURCES = {'files', 'compat', 'systemd'}
+
+# The SHA-512 crypt rounds for new passwords, None for the crypt default of
+# 5000, and the number of PasswordHasher processes, None for one per CPU
+PASSWORD_ROUNDS = None
+PASSWORD_WORKERS = None
 
 USER_FIELDS = ['Username', 'UID', 'Primary group', 'Real name', 'Office', 'Office phone', 'Home phone', 'Other', 'Directory', 'Shell', 'Groups', 'Last password change', 'Minimum password age', 'Maximum password age', 'Warning period', 'Inactivity period', 'Expiration']
 CSV_USER_FIELDS = ['Username', 'UID', 'GID', 'Primary group', 'Real name', 'Office', 'Office phone', 'Home phone', 'Other', 'Directory', 'Shell', 'Groups', 'Last password change', 'Minimum password age', 'Maximum password age', 'Warning period', 'Inactivity period', 'Expiration', 'Encrypted password', 'Password']
 
+# Marks a User.primary_group that wasn't resolved yet
+_UNRESOLVED = object()
+
 class User:
+    __slots__ = ('name', 'uid', 'gid', 'rname', 'office', 'wphone', 'hphone',
+                 'other', 'directory', 'shell', 'groups', 'lstchg', 'min', 'max',
+                 'warn', 'inact', 'expire', 'password', 'plainpw', '_primary_group')
+    # The public attributes, in the order that the constructor accepts them
+    FIELDS = __slots__[:-1]
+
     def __init__(self, name=None, uid=None, gid=None, rname="", office="", wphone="",
                  hphone="", other="", directory=None, shell="/bin/bash", groups=None, lstchg=None,
                  min=0, max=99999, warn=7, inact=-1, expire=-1, password="*", plainpw=None):
@@ -59,16 +106,21 @@ class User:
         if self.groups is None:
             self.groups = []
             
-        if self.gid is not None:
-            try:
-                self.primary_group = grp.getgrgid(self.gid).gr_name
-            except:
-                self.primary_group = ''
-        else:
-            self.primary_group = None
+        # The primary group name is looked up when it's first needed
+        self._primary_group = None if self.gid is None else _UNRESOLVED
+
+    @property
+    def primary_group(self):
+        if self._primary_group is _UNRESOLVED:
+            self._primary_group = group_name(self.gid)
+        return self._primary_group
+
+    @primary_group.setter
+    def primary_group(self, value):
+        self._primary_group = value
     
     def __str__(self):
-        return str(self.__dict__)
+        return str({attr: getattr(self, attr) for attr in self.FIELDS + ('primary_group',)})
             
     def is_system_user(self):
         return not (self.uid >= FIRST_UID and self.uid <= LAST_UID)
@@ -85,6 +137,8 @@ class User:
 
 
 class Group:
+    __slots__ = ('name', 'gid', 'members', 'password')
+
     def __init__(self, name=None, gid=None, members=None, password=""):
         self.name, self.gid, self.members, self.password = \
             name, gid, members, password
@@ -101,6 +155,226 @@ class Group:
         return self.is_user_group() and self.name in self.members and len(self.members) == 1
 
 
+def encrypt_password(plainpw, rounds=None):
+    """Convert a plain text password to a SHA-512 crypt hash."""
+    salt = crypt.mksalt(crypt.METHOD_SHA512)
+    if rounds is not None:
+        # mksalt(rounds=) needs Python 3.7
+        salt = '$6$rounds=%d$%s' % (rounds, salt[len('$6$'):])
+    return crypt.crypt(plainpw, salt)
+
+
+def _encrypt_passwords(passwords, rounds):
+    # Runs in the PasswordHasher worker processes
+    return [encrypt_password(plainpw, rounds) for plainpw in passwords]
+
+
+class PasswordHasher:
+    """Hash many passwords in parallel, in a pool of worker processes.
+
+    SHA-512 crypt takes a few milliseconds per password, which adds up to
+    many seconds when creating or importing hundreds of accounts.
+    """
+    def __init__(self, workers=None, rounds=None, chunksize=50):
+        self.workers = workers or PASSWORD_WORKERS or os.cpu_count() or 1
+        self.rounds = PASSWORD_ROUNDS if rounds is None else rounds
+        self.chunksize = chunksize
+        self.pool = None
+        self.thread = None
+
+    def submit(self, passwords):
+        """Start hashing passwords in the background. Return a list of
+        futures, one per chunk of passwords, with the lists of their hashes."""
+        passwords = list(passwords)
+        chunks = [passwords[i:i+self.chunksize]
+                  for i in range(0, len(passwords), self.chunksize)]
+        if self.workers == 1 or len(chunks) <= 1:
+            # Not worth starting processes for, but still not in the
+            # caller's thread, which may be the GUI one
+            if self.thread is None:
+                self.thread = concurrent.futures.ThreadPoolExecutor(1)
+            executor = self.thread
+        else:
+            if self.pool is None:
+                self.pool = self.create_pool()
+            executor = self.pool
+        return [executor.submit(_encrypt_passwords, chunk, self.rounds)
+                for chunk in chunks]
+
+    def create_pool(self):
+        """Start the worker processes from a forkserver, as forking the GTK
+        process, which already runs other threads, could deadlock them."""
+        context = multiprocessing.get_context('forkserver')
+        try:
+            return concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=context)
+        except TypeError:
+            # Python 3.6 has no mp_context, so change the default instead
+            multiprocessing.set_start_method('forkserver', force=True)
+            return concurrent.futures.ProcessPoolExecutor(self.workers)
+
+    def encrypt_many(self, passwords):
+        """Return the hashes of passwords, in the same order."""
+        hashes = []
+        for future in self.submit(passwords):
+            hashes.extend(future.result())
+        return hashes
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.thread is not None:
+            self.thread.shutdown()
+            self.thread = None
+
+
+def expand_template(template, classn, i):
+    """Replace {c} with the class name, and {i} or {0i} with the number i,
+    in the account templates of batch user creation."""
+    return template.replace('{c}', classn.strip()).replace(
+        '{i}', str(i)).replace('{0i}', '%02d' % i)
+
+
+def nss_is_local():
+    """Return True if NSS only reads the accounts from the local files."""
+    try:
+        with open(os.path.join(paths.sysconfdir, 'nsswitch.conf')) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        # The glibc defaults are the files
+        return True
+    for line in lines:
+        database, _, sources = line.split('#', 1)[0].partition(':')
+        if database.strip() not in ('passwd', 'shadow', 'group'):
+            continue
+        # Skip the [NOTFOUND=return] actions
+        if any(source not in LOCAL_NSS_SOURCES for source in sources.split()
+               if not source.startswith('[')):
+            return False
+    return True
+
+
+def _valid_fields(fields, count, numeric):
+    """Return True if the account file fields have at least count fields,
+    with integers in the numeric ones, like enumerate_files() requires."""
+    try:
+        for i in numeric:
+            int(fields[i])
+    except (IndexError, ValueError):
+        return False
+    return len(fields) >= count
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """Pause the cyclic garbage collector, which would otherwise run many
+    times while building thousands of objects, none of which are garbage."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def group_name(gid):
+    """Return the name of the group with this GID, or '' if there's none.
+    The loaded System groups are used if available, to avoid NSS lookups."""
+    if _system_ is not None:
+        return _system_.gid_name(gid)
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ''
+
+
+class IdAllocator:
+    """An index of the used IDs, to find free UIDs or GIDs without scanning
+    all the users or groups.
+
+    A byte per ID in [first, last] tells if it's used or reserved, so the
+    free ones can be found with bytearray.find() in C speed. IDs may be
+    used more than once; they become free when they're released as many
+    times. IDs can also be reserved, e.g. while preparing a batch of new
+    accounts, until they're used or unreserved.
+    """
+    def __init__(self, first, last):
+        self.first, self.last = first, last
+        self.bitmap = bytearray(last - first + 1)
+        self.refs = {}
+        self.reserved = set()
+
+    def _mark(self, id_, used):
+        if self.first <= id_ <= self.last:
+            self.bitmap[id_ - self.first] = used
+
+    def use(self, id_):
+        if id_ is None:
+            return
+        self.refs[id_] = self.refs.get(id_, 0) + 1
+        self.reserved.discard(id_)
+        self._mark(id_, 1)
+
+    def release(self, id_):
+        if id_ not in self.refs:
+            return
+        self.refs[id_] -= 1
+        if self.refs[id_] == 0:
+            del self.refs[id_]
+            if id_ not in self.reserved:
+                self._mark(id_, 0)
+
+    def reserve(self, id_):
+        self.reserved.add(id_)
+        self._mark(id_, 1)
+
+    def unreserve(self, id_):
+        if id_ in self.reserved:
+            self.reserved.remove(id_)
+            if id_ not in self.refs:
+                self._mark(id_, 0)
+
+    def is_free(self, id_):
+        return id_ not in self.refs and id_ not in self.reserved
+
+    def find(self, start, end, reverse=False):
+        """Return the first (or with reverse, the last) free ID in
+        [start, end], or None. IDs above self.last are checked one by one."""
+        start = max(start, self.first)
+        above = range(max(start, self.last + 1), end + 1)
+        if reverse:
+            for i in reversed(above):
+                if self.is_free(i):
+                    return i
+        lo, hi = start - self.first, min(end, self.last) - self.first
+        if lo <= hi:
+            find = self.bitmap.rfind if reverse else self.bitmap.find
+            i = find(0, lo, hi + 1)
+            if i != -1:
+                return i + self.first
+        if not reverse:
+            for i in above:
+                if self.is_free(i):
+                    return i
+        return None
+
+    def allocate(self, count, start, end):
+        """Reserve and return count free IDs in [start, end]."""
+        ids = []
+        while len(ids) < count:
+            id_ = self.find(start, end)
+            if id_ is None:
+                for i in ids:
+                    self.unreserve(i)
+                raise ValueError("There are no %d free IDs left" % count)
+            self.reserve(id_)
+            ids.append(id_)
+            start = id_ + 1
+        return ids
+
+
 # TODO: Change implementation, don't use dicts since they have to be updated
 #       when the user/group_object.name changes. python sets would be good.
 class Set(object):
@@ -108,12 +382,124 @@ class Set(object):
     def __init__(self, users=None, groups=None):
         self.users = {} if users is None else users 
         self.groups = {} if groups is None else groups
+        self.reindex()
+
+    def reindex(self):
+        """Rebuild the indexes, after self.users or self.groups were replaced.
+        The UID and GID reservations are kept."""
+        old_uids, old_gids = getattr(self, 'uids', None), getattr(self, 'gids', None)
+        self.uids = IdAllocator(FIRST_SYSTEM_UID, LAST_UID)
+        self.gids = IdAllocator(FIRST_SYSTEM_GID, LAST_GID)
+        if old_uids is not None:
+            self.reserve_uids(old_uids.reserved)
+            self.reserve_gids(old_gids.reserved)
+        self.indexed_users = {}
+        self.indexed_groups = {}
+        self.users_by_uid = {}
+        self.users_by_gid = {}
+        self.users_by_directory = {}
+        self.groups_by_gid = {}
+        self.memberships = {}
+        for user in self.users.values():
+            self.index_user(user)
+        for group in self.groups.values():
+            self.index_group(group)
+
+    # The indexes remember the values they were updated with, so that they
+    # can be updated even if the objects were modified in the meantime.
+    # Call index_user() or index_group() after modifying an object.
+    def _index_add(self, index, key, name):
+        index.setdefault(key, set()).add(name)
+
+    def _index_discard(self, index, key, name):
+        names = index.get(key)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del index[key]
+
+    def index_user(self, user):
+        self.unindex_user(user.name)
+        self.indexed_users[user.name] = (user.uid, user.gid, user.directory)
+        self.uids.use(user.uid)
+        self._index_add(self.users_by_uid, user.uid, user.name)
+        self._index_add(self.users_by_gid, user.gid, user.name)
+        self._index_add(self.users_by_directory, user.directory, user.name)
+
+    def unindex_user(self, name):
+        if name not in self.indexed_users:
+            return
+        uid, gid, directory = self.indexed_users.pop(name)
+        self.uids.release(uid)
+        self._index_discard(self.users_by_uid, uid, name)
+        self._index_discard(self.users_by_gid, gid, name)
+        self._index_discard(self.users_by_directory, directory, name)
+
+    def index_group(self, group):
+        self.unindex_group(group)
+        self.indexed_groups[group.name] = (group.gid, set(group.members))
+        self.gids.use(group.gid)
+        self._index_add(self.groups_by_gid, group.gid, group.name)
+        for name in group.members:
+            self._index_add(self.memberships, name, group.name)
+
+    def unindex_group(self, group):
+        if group.name not in self.indexed_groups:
+            return
+        gid, members = self.indexed_groups.pop(group.name)
+        self.gids.release(gid)
+        self._index_discard(self.groups_by_gid, gid, group.name)
+        for name in members:
+            self._index_discard(self.memberships, name, group.name)
+
+    def add_member(self, group, user):
+        """Add user to the members of group, updating the indexes."""
+        group.members[user.name] = user
+        if group.name in self.indexed_groups:
+            self.indexed_groups[group.name][1].add(user.name)
+        self._index_add(self.memberships, user.name, group.name)
+
+    def remove_member(self, group, name):
+        """Remove the user name from the members of group, updating the indexes."""
+        group.members.pop(name, None)
+        if group.name in self.indexed_groups:
+            self.indexed_groups[group.name][1].discard(name)
+        self._index_discard(self.memberships, name, group.name)
+
+    def get_users_by_uid(self, uid):
+        return [self.users[n] for n in self.users_by_uid.get(uid, ()) if n in self.users]
+
+    def get_users_by_gid(self, gid):
+        """Return the users that have gid as their primary GID."""
+        return [self.users[n] for n in self.users_by_gid.get(gid, ()) if n in self.users]
+
+    def get_users_by_directory(self, directory):
+        return [self.users[n] for n in self.users_by_directory.get(directory, ()) if n in self.users]
+
+    def get_groups_by_gid(self, gid):
+        return [self.groups[n] for n in self.groups_by_gid.get(gid, ()) if n in self.groups]
+
+    def gid_name(self, gid):
+        """Return the name of the first group with gid, in the order of the
+        group file like getgrgid(), or '' if there's none."""
+        names = self.groups_by_gid.get(gid, ())
+        if len(names) > 1:
+            return next(name for name in self.groups if name in names)
+        for name in names:
+            return name
+        return ''
+
+    def get_member_groups(self, username):
+        """Return the groups that have username in their members."""
+        return [self.groups[n] for n in self.memberships.get(username, ())
+                if n in self.groups and username in self.groups[n].members]
     
     def add_user(self, user):
         """Adds a new User object in the Set."""
         if user.name in self.users:
             raise ValueError("User '%s' exists" % user.name)
         self.users[user.name] = user
+        self.index_user(user)
     
     def remove_user(self, user):
         """Removes a User object from the Set.
@@ -125,10 +511,40 @@ class Set(object):
             if group in self.groups:
                 g = self.groups[group]
                 if g.is_private() and g.name == user.name:
+                    self.unindex_group(g)
                     del self.groups[g.name]
                 else:
-                    del g.members[user.name]
+                    self.remove_member(g, user.name)
+        del self.users[user.name]
+        self.unindex_user(user.name)
+
+    def rename_user(self, user, name):
+        """Rename user, updating the Set dicts and indexes."""
+        if name in self.users:
+            raise ValueError("User '%s' exists" % name)
+        groups = self.get_member_groups(user.name)
+        for group in groups:
+            self.remove_member(group, user.name)
+        self.unindex_user(user.name)
         del self.users[user.name]
+        user.name = name
+        self.users[name] = user
+        self.index_user(user)
+        for group in groups:
+            self.add_member(group, user)
+
+    def rename_group(self, group, name):
+        """Rename group, updating the Set dicts and indexes and the
+        User.groups lists of its members."""
+        if name in self.groups:
+            raise ValueError("Group '%s' exists" % name)
+        self.unindex_group(group)
+        del self.groups[group.name]
+        for user in group.members.values():
+            user.groups = [name if g == group.name else g for g in user.groups]
+        group.name = name
+        self.groups[name] = group
+        self.index_group(group)
     
     def add_group(self, group):
         """Adds a new Group object in the Set.
@@ -142,6 +558,7 @@ class Set(object):
         if group.name in self.groups:
             raise ValueError("Group '%s' exists" % group.name)
         self.groups[group.name] = group
+        self.index_group(group)
         
         for user_obj in group.members.values():
             if user_obj.name not in self.users:
@@ -155,51 +572,242 @@ class Set(object):
         This will also remove the group from the User objects and remove from
         the Set all the Users which have this group as primary.
         """
-        for user_obj in self.users.values():
+        users = dict(group.members)
+        users.update((u.name, u) for u in self.get_users_by_gid(group.gid))
+        for user_obj in users.values():
             if group.name in user_obj.groups:
                 if len(user_obj.groups) == 1:
                     del self.users[user_obj.name]
+                    self.unindex_user(user_obj.name)
                 else:
                     user_obj.groups.remove(group.name)
+        self.unindex_group(group)
         del self.groups[group.name]
     
     def uid_is_free(self, uid):
-        return uid not in [user.uid for user in self.users.values()]
+        return self.uids.is_free(uid)
     
     def gid_is_free(self, gid):
-        return gid not in [group.gid for group in self.groups.values()]
+        return self.gids.is_free(gid)
+
+    def _get_free_id(self, ids, start, end, reverse, ignore, exclude):
+        exclude = set(exclude or [])
+        found = None
+        lo, hi = start, end
+        while lo <= hi:
+            id_ = ids.find(lo, hi, reverse)
+            if id_ is None or id_ not in exclude:
+                found = id_
+                break
+            if reverse:
+                hi = id_ - 1
+            else:
+                lo = id_ + 1
+        # The ignored ID, e.g. the current UID of a user, also counts as free
+        if ignore is not None and start <= ignore <= end:
+            if found is None or (ignore > found if reverse else ignore < found):
+                return ignore
+        return found
         
     def get_free_uid(self, start=FIRST_UID, end=LAST_UID, reverse=False, ignore=None, exclude=None):
-        used_uids = [user.uid for user in self.users.values()]
-        if exclude is not None:
-            used_uids.extend(exclude)
-        xr = range(start, end+1)
-        if reverse:
-            xr = reversed(xr)
-        
-        uid = None
-        
-        for i in xr:
-            if i == ignore or i not in used_uids:
-                uid = i
-                break
-        return uid
+        return self._get_free_id(self.uids, start, end, reverse, ignore, exclude)
     
     def get_free_gid(self, start=FIRST_UID, end=LAST_UID, reverse=False, ignore=None, exclude=None):
-        used_gids = [group.gid for group in self.groups.values()]
-        if exclude is not None:
-            used_gids.extend(exclude)
-        xr = range(start, end+1)
-        if reverse:
-            xr = reversed(xr)
-        
-        gid = None
-        
-        for i in xr:
-            if i == ignore or i not in used_gids:
-                gid = i
+        return self._get_free_id(self.gids, start, end, reverse, ignore, exclude)
+
+    def allocate_uids(self, count=1, start=FIRST_UID, end=LAST_UID):
+        """Reserve count free UIDs, e.g. for a batch of new users.
+        They stay reserved until they're used or released."""
+        return self.uids.allocate(count, start, end)
+
+    def allocate_gids(self, count=1, start=FIRST_GID, end=LAST_GID):
+        """Reserve count free GIDs, e.g. for a batch of new groups.
+        They stay reserved until they're used or released."""
+        return self.gids.allocate(count, start, end)
+
+    def reserve_uids(self, uids):
+        for uid in uids:
+            self.uids.reserve(uid)
+
+    def reserve_gids(self, gids):
+        for gid in gids:
+            self.gids.reserve(gid)
+
+    def release_uids(self, uids):
+        """Release UID reservations; the UIDs that got used stay used."""
+        for uid in uids:
+            self.uids.unreserve(uid)
+
+    def release_gids(self, gids):
+        """Release GID reservations; the GIDs that got used stay used."""
+        for gid in gids:
+            self.gids.unreserve(gid)
+
+
+class AccountDB:
+    """Locked read-modify-write access to the local account files.
+
+    It follows the conventions of lckpwdf(3) and of the shadow utilities:
+    the database is locked through <sysconfdir>/.pwd.lock, the previous
+    contents are kept in <file>-, and the new contents are written to <file>+
+    and then atomically renamed over the original file.
+    Use it as a context manager; nothing is written unless commit() is called.
+    """
+    FILES = ['passwd', 'shadow', 'group', 'gshadow']
+    # The fields of the complete entries of each file
+    FIELDS = {'passwd': 7, 'shadow': 9, 'group': 4, 'gshadow': 4}
+
+    def __init__(self, sysconfdir=None):
+        self.sysconfdir = paths.sysconfdir if sysconfdir is None else sysconfdir
+        self.lock_fd = None
+        self.entries = {}
+        self.index = {}
+        self.changed = set()
+
+    def __enter__(self):
+        self.lock()
+        try:
+            for fname in self.FILES:
+                self.entries[fname] = self.read(fname)
+                self.index[fname] = {e[0]: e for e in self.entries[fname] or []
+                                     if self.is_entry(fname, e)}
+            self.gids = set(e[2] for e in self.index['group'].values())
+        except:
+            self.unlock()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlock()
+
+    def path(self, fname):
+        return os.path.join(self.sysconfdir, fname)
+
+    def lock(self, timeout=LOCK_TIMEOUT):
+        """Acquire the password database lock, like lckpwdf(3)."""
+        fd = os.open(self.path(PASSWD_LOCK), os.O_WRONLY | os.O_CREAT, 0o600)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
                 break
-        return gid
+            except OSError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN) or time.time() > deadline:
+                    os.close(fd)
+                    raise
+                time.sleep(0.1)
+        self.lock_fd = fd
+
+    def unlock(self):
+        if self.lock_fd is not None:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_UN)
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def is_entry(self, fname, fields):
+        """Return True if fields are a complete entry of fname. Like in
+        System.read_file(), blank lines, comments and the NIS compat entries
+        aren't; they're only written back as they were."""
+        return fields[0][:1] not in ('', '#', '+', '-') and \
+            len(fields) >= self.FIELDS[fname]
+
+    def read(self, fname):
+        """Return the lines of fname as lists of fields, or None if the
+        file doesn't exist."""
+        try:
+            with open(self.path(fname)) as f:
+                return [line.split(':') for line in f.read().splitlines()]
+        except FileNotFoundError:
+            return None
+
+    def find(self, fname, name):
+        """Return the entry of fname for the user or group name, or None."""
+        return self.index[fname].get(name)
+
+    def append(self, fname, fields):
+        if self.entries[fname] is None:
+            return
+        for field in fields:
+            if ':' in field or '\n' in field:
+                raise ValueError("Invalid character in field '%s'" % field)
+        self.entries[fname].append(fields)
+        self.index[fname][fields[0]] = fields
+        self.changed.add(fname)
+
+    def add_member(self, groupname, username):
+        """Add username to the member list of groupname in group and gshadow."""
+        for fname, col in (('group', 3), ('gshadow', 3)):
+            entry = self.find(fname, groupname)
+            if entry is None:
+                if fname == 'group':
+                    raise ValueError("Group '%s' does not exist" % groupname)
+                continue
+            members = [m for m in entry[col].split(',') if m]
+            if username not in members:
+                members.append(username)
+                entry[col] = ','.join(members)
+                self.changed.add(fname)
+
+    def add_group(self, group):
+        """Add the group, or if it already exists, merge its members."""
+        entry = self.find('group', group.name)
+        if entry is None:
+            if str(group.gid) in self.gids:
+                raise ValueError("GID '%s' already exists" % group.gid)
+            self.append('group', [group.name, 'x', str(group.gid), ''])
+            self.gids.add(str(group.gid))
+            self.append('gshadow', [group.name, '!', '', ''])
+            gid = group.gid
+        else:
+            gid = int(entry[2])
+        for user in group.members.values():
+            # Users don't need to be listed as members of their primary group
+            if user.gid != gid:
+                self.add_member(group.name, user.name)
+
+    def add_user(self, user):
+        """Add the user to passwd and shadow and to the groups in user.groups."""
+        if self.find('passwd', user.name) is not None:
+            raise ValueError("User '%s' exists" % user.name)
+        gecos = ','.join([user.rname, user.office, user.wphone, user.hphone,
+                          user.other]).rstrip(',')
+        password = '!' if user.password is None else user.password
+        if self.entries['shadow'] is None:
+            self.append('passwd', [user.name, password, str(user.uid),
+                str(user.gid), gecos, user.directory, user.shell])
+        else:
+            self.append('passwd', [user.name, 'x', str(user.uid),
+                str(user.gid), gecos, user.directory, user.shell])
+            # Like chage, store -1 as an empty field
+            nums = [user.lstchg, user.min, user.max, user.warn, user.inact, user.expire]
+            nums = ['' if n is None or n == -1 else str(n) for n in nums]
+            self.append('shadow', [user.name, password] + nums + [''])
+        for group in user.groups:
+            entry = self.find('group', group)
+            if entry is None or int(entry[2]) != user.gid:
+                self.add_member(group, user.name)
+
+    def commit(self):
+        """Write the changed files, keeping their ownership and mode."""
+        renames = []
+        for fname in self.FILES:
+            if fname not in self.changed:
+                continue
+            path = self.path(fname)
+            st = os.stat(path)
+            shutil.copy2(path, path + '-')
+            os.chown(path + '-', st.st_uid, st.st_gid)
+            with open(path + '+', 'w') as f:
+                os.fchown(f.fileno(), st.st_uid, st.st_gid)
+                os.fchmod(f.fileno(), st.st_mode & 0o7777)
+                f.write(''.join(':'.join(e) + '\n' for e in self.entries[fname]))
+                f.flush()
+                os.fsync(f.fileno())
+            renames.append(path)
+        # Only replace the files after all of them were written successfully
+        for path in renames:
+            os.rename(path + '+', path)
+        self.changed = set()
 
 
 class Event:
@@ -214,39 +822,102 @@ class Event:
             subscriber(arg)
 
 
+class Change:
+    """A change of a User or Group object of the System.
+
+    System.libuser_event subscribers receive lists of Change objects.
+    A RELOADED change means that all the objects were replaced.
+    """
+    ADDED = 'added'
+    REMOVED = 'removed'
+    MODIFIED = 'modified'
+    RELOADED = 'reloaded'
+
+    def __init__(self, action, kind=None, name=None, obj=None):
+        # kind is either 'user' or 'group'
+        self.action, self.kind, self.name, self.obj = action, kind, name, obj
+
+    def __repr__(self):
+        return 'Change(%s, %s, %s)' % (self.action, self.kind, self.name)
+
+
+def coalesce_changes(changes):
+    """Merge the consecutive changes of each object into a single one."""
+    merged = {}
+    for change in changes:
+        if change.action == Change.RELOADED:
+            return [change]
+        key = (change.kind, change.name)
+        prev = merged.get(key)
+        if prev is None:
+            merged[key] = change
+        elif prev.action == Change.ADDED and change.action == Change.REMOVED:
+            del merged[key]
+        elif prev.action == Change.ADDED:
+            merged[key] = Change(Change.ADDED, change.kind, change.name, change.obj)
+        elif prev.action == Change.REMOVED and change.action == Change.ADDED:
+            merged[key] = Change(Change.MODIFIED, change.kind, change.name, change.obj)
+        else:
+            merged[key] = change
+    return list(merged.values())
+
+
 class System(Set):
-    def __init__(self):
+    def __init__(self, backend=None, watch=True, cache=False):
+        """With cache, the accounts are loaded from the snapshot cache when
+        the account files didn't change, and the cache is updated after
+        loading them. If NSS also has non local accounts, the cache is only
+        used with watch, and it's revalidated in a thread."""
         super(System, self).__init__()
-        self.load()
+        self.backend = backend or DEFAULT_BACKEND
+        if self.backend not in LOAD_BACKENDS:
+            raise ValueError("Unknown account backend '%s'" % self.backend)
+        self.suspended = 0
+        self.cache = cache
+        self.cache_signatures = None
+        self.cached_rows = None
+        complete = self.backend == 'files' or nss_is_local()
+        self.load(use_cache=cache and (complete or watch))
+        # Hashes the passwords of bulk account operations in parallel
+        self.hasher = PasswordHasher()
         # These might be updated from ltsp_shared_folders, if they're used
         self.teachers='teachers'
         self.share_groups=[self.teachers]
 
-        # INotifier for /etc/group and /etc/shadow
+        # INotifier for /etc/passwd, /etc/shadow and /etc/group.
+        # The shadow utilities replace those files by renaming <file>+ over
+        # them, so watch their directory instead of their inodes.
         self.system_event = Event()
         self.libuser_event = Event()
         self.system_event.connect(self.on_system_changed)
-        self.mask = inotify.IN_MODIFY
-        self.group_fp = filepath.FilePath(os.path.join(paths.sysconfdir, 'group'))
-        self.shadow_fp = filepath.FilePath(os.path.join(paths.sysconfdir, 'shadow'))
-        self.notifier = inotify.INotify()
-        self.notifier.startReading()
-        self.notifier._addWatch(self.group_fp, self.mask, False, [self.on_fd_changed])
-        self.notifier._addWatch(self.shadow_fp, self.mask, False, [self.on_fd_changed])
+        if watch:
+            # Imported here, so that e.g. the command line tools that don't
+            # watch the files don't need to load them
+            from twisted.internet import inotify
+            from twisted.python import filepath
+            self.mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+            self.notifier = inotify.INotify()
+            self.notifier.startReading()
+            self.notifier.watch(filepath.FilePath(paths.sysconfdir), self.mask,
+                                callbacks=[self.on_fd_changed])
+        if self.loaded_from_cache and not complete:
+            self.revalidate()
 
     def add_group(self, group):
-        res = common.run_command(['groupadd', '-g', str(group.gid), group.name])
-        for user in group.members.values():
-            if user in self.users.values():
-                common.run_command(['usermod', '-a', '-G', group.name, user.name])
-            else:
-                self.add_user(user)
+        with self.batch():
+            res = common.run_command(['groupadd', '-g', str(group.gid), group.name])
+            for user in group.members.values():
+                if user.name in self.users:
+                    common.run_command(['usermod', '-a', '-G', group.name, user.name])
+                else:
+                    self.add_user(user)
         return res
     
     def edit_group(self, groupname, group):
-        res = common.run_command(['groupmod', '-g', str(group.gid), '-n', group.name, groupname])
-        for user in group.members.values():
-            common.run_command(['usermod', '-a', '-G', group.name, user.name])
+        with self.batch():
+            res = common.run_command(['groupmod', '-g', str(group.gid), '-n', group.name, groupname])
+            for user in group.members.values():
+                common.run_command(['usermod', '-a', '-G', group.name, user.name])
         return res
     
     def delete_group(self, group):
@@ -258,8 +929,9 @@ class System(Set):
             cmd.extend(['-m', '-d', user.directory])
         cmd.extend(['-g', str(user.gid)])
         cmd.append(user.name)
-        res = common.run_command(cmd)
-        self.update_user(user.name, user)
+        with self.batch():
+            res = common.run_command(cmd)
+            self.update_user(user.name, user)
         return res
         
     def _strcnv(self, t):
@@ -280,9 +952,10 @@ class System(Set):
         
         # Execute usermod
         cmd = self._strcnv(cmd)
-        res = common.run_command(cmd)
-        self.user_set_gecos(user)
-        self.user_set_pass_options(user)
+        with self.batch():
+            res = common.run_command(cmd)
+            self.user_set_gecos(user)
+            self.user_set_pass_options(user)
         return res
     
     def user_set_gecos(self, user):
@@ -310,6 +983,213 @@ class System(Set):
         cmd = self._strcnv(cmd)
         return common.run_command(cmd)
     
+    def apply_batch(self, users=None, groups=None, create_home=True):
+        """Create many users and groups in a single locked transaction.
+
+        Groups that already exist only get their members merged.
+        The users are added to the groups in their User.groups lists.
+        Home directories are created after the account files are written.
+        Returns (True, '') on success or (False, error_message) on failure,
+        in which case none of the files were modified, unless the error was
+        in creating the homes, after the accounts were saved.
+        """
+        users = list(users or [])
+        groups = list(groups or [])
+        with self.batch():
+            try:
+                with AccountDB() as db:
+                    # The members may be users of this batch, so add them last
+                    for group in groups:
+                        db.add_group(Group(group.name, group.gid))
+                    for user in users:
+                        db.add_user(user)
+                    for group in groups:
+                        db.add_group(group)
+                    db.commit()
+            except (OSError, ValueError) as e:
+                sys.stderr.write("Error while applying the accounts batch: %s\n" % e)
+                return False, str(e)
+            self.invalidate_caches()
+            if create_home:
+                errors = []
+                for user in users:
+                    try:
+                        self.create_home(user)
+                    except OSError as e:
+                        errors.append("Error while creating the home of %s: %s"
+                                      % (user.name, e))
+                if errors:
+                    sys.stderr.write(''.join(e + '\n' for e in errors))
+                    return False, '\n'.join(errors)
+        return True, ''
+
+    def prepare_batch(self, classes, count, username_tmpl, name_tmpl,
+                      password_tmpl, home=HOME_PREFIX, teachers=False):
+        """Prepare count users for each of the classes, from the templates
+        that expand_template() expands, for apply_batch().
+
+        Existing class groups only get the new members merged. With teachers,
+        the members of the 'teachers' group are also added to the classes.
+        Returns (users, groups, passwords), where passwords are the plain
+        text passwords of the users. The IDs of the new accounts stay
+        reserved until they're passed to release_uids() and release_gids(),
+        after the batch is applied. Raises ValueError if there aren't enough
+        free IDs, or if the usernames aren't unique, or if users or groups
+        with those names exist, as their private groups couldn't be created.
+        """
+        classes = [c for c in classes if c] or ['']
+        new_classes = [c for c in classes if c and c not in self.groups]
+        names = [expand_template(username_tmpl, classn, i)
+                 for classn in classes for i in range(1, count + 1)]
+        existing = [name for name in names if name in self.users
+                    or name in self.groups or name in new_classes]
+        if existing:
+            raise ValueError("Existing users or groups: %s" % ', '.join(existing))
+        if len(set(names)) < len(names):
+            raise ValueError("The username template doesn't create unique names")
+        total = count * len(classes)
+        uids = self.allocate_uids(total)
+        try:
+            gids = self.allocate_gids(len(new_classes) + total)
+        except ValueError:
+            self.release_uids(uids)
+            raise
+        free_uids = iter(uids)
+        free_gids = iter(gids)
+
+        if teachers:
+            teachers = [u for u in self.users.values() if self.teachers in u.groups]
+        else:
+            teachers = []
+        groups = []
+        for classn in classes:
+            if not classn:
+                continue
+            if classn in new_classes:
+                gid = next(free_gids)
+            else:
+                gid = self.groups[classn].gid
+            # Existing groups only get the new members merged
+            group = Group(classn, gid, {})
+            for user in teachers:
+                if classn not in user.groups:
+                    group.members[user.name] = user
+            groups.append(group)
+
+        users = []
+        passwords = []
+        lstchg = common.days_since_epoch()
+        for classn in classes:
+            for i in range(1, count + 1):
+                name = expand_template(username_tmpl, classn, i)
+                gid = next(free_gids)
+                # The user private group
+                groups.append(Group(name, gid))
+                users.append(User(name=name, uid=next(free_uids), gid=gid,
+                    rname=expand_template(name_tmpl, classn, i),
+                    directory=os.path.join(home, name), lstchg=lstchg,
+                    groups=[classn] if classn else []))
+                passwords.append(expand_template(password_tmpl, classn, i))
+        return users, groups, passwords
+
+    def complete_user(self, user, allocate_uid=None, allocate_gid=None, new_set=None):
+        """Fill the missing information of user, e.g. of an imported one.
+
+        The missing IDs are taken from allocate_uid() and allocate_gid(),
+        which by default reserve the next free ones. Primary groups are also
+        looked up in new_set, the Set of the other imported accounts.
+        """
+        allocate_uid = allocate_uid or (lambda: self.allocate_uids()[0])
+        allocate_gid = allocate_gid or (lambda: self.allocate_gids()[0])
+        if user.directory in [None, '']:
+            user.directory = os.path.join(HOME_PREFIX, user.name)
+        if user.uid in [None, '']:
+            user.uid = allocate_uid()
+
+        if user.gid in [None, '']:
+            if user.primary_group in [None, '']:
+                user.primary_group = user.name
+            if user.name in self.groups:
+                user.gid = self.groups[user.name].gid
+            else:
+                user.gid = allocate_gid()
+        elif user.primary_group in [None, '']:
+            groups = self.get_groups_by_gid(user.gid)
+            if groups:
+                user.primary_group = groups[0].name
+            elif new_set and new_set.get_groups_by_gid(user.gid):
+                user.primary_group = new_set.get_groups_by_gid(user.gid)[0].name
+            else:
+                user.primary_group = user.name
+        if user.shell in [None, '']:
+            user.shell = '/bin/bash'
+        if user.min in [None, '']:
+            user.min = 0
+        if user.max in [None, '']:
+            user.max = 99999
+        if user.warn in [None, '']:
+            user.warn = 7
+        if user.lstchg in [None, '']:
+            user.lstchg = common.days_since_epoch()
+        if user.inact in [None, '']:
+            user.inact = -1
+        if user.expire in [None, '']:
+            user.expire = -1
+        if user.password in [None, '']:
+            user.password = '!'
+        if user.plainpw is None:
+            user.plainpw = ''
+
+    def import_groups(self, users, new_set=None, allocate_gid=None):
+        """Return the groups that need to be created for the imported users,
+        i.e. their primary groups and other groups that don't exist yet,
+        with the users as their members. The gids are taken from new_set
+        when possible, otherwise from allocate_gid()."""
+        allocate_gid = allocate_gid or (lambda: self.allocate_gids()[0])
+        new_groups = {}
+        for u in users:
+            if u.primary_group not in self.groups:
+                if u.primary_group not in new_groups:
+                    new_groups[u.primary_group] = Group(u.primary_group, u.gid)
+                new_groups[u.primary_group].members[u.name] = u
+        for u in users:
+            for g in u.groups:
+                if g in self.groups:
+                    continue
+                if g not in new_groups:
+                    g_obj = Group(g)
+                    if new_set and g in new_set.groups:
+                        g_obj.gid = new_set.groups[g].gid
+                    # The gids of the new users are reserved, so not free
+                    if g_obj.gid is None or not self.gid_is_free(g_obj.gid):
+                        g_obj.gid = allocate_gid()
+                    new_groups[g] = g_obj
+                new_groups[g].members[u.name] = u
+        return list(new_groups.values())
+
+    def create_home(self, user, skel=None):
+        """Create the home directory of user from the skeleton directory,
+        unless it already exists."""
+        if not user.directory or os.path.exists(user.directory):
+            return
+        if skel is None:
+            skel = os.path.join(paths.sysconfdir, 'skel')
+        if os.path.isdir(skel):
+            shutil.copytree(skel, user.directory, symlinks=True)
+        else:
+            os.makedirs(user.directory)
+        os.chmod(user.directory, HOME_MODE)
+        for root, dirs, files in os.walk(user.directory):
+            os.lchown(root, user.uid, user.gid)
+            for name in dirs + files:
+                os.lchown(os.path.join(root, name), user.uid, user.gid)
+
+    def invalidate_caches(self):
+        """Tell nscd that the account files changed, like useradd does."""
+        if shutil.which('nscd'):
+            common.run_command(['nscd', '-i', 'passwd'])
+            common.run_command(['nscd', '-i', 'group'])
+
     def delete_user(self, user, remove_home=False):
         cmd = ['userdel']
         if remove_home:
@@ -337,49 +1217,432 @@ class System(Set):
         return user.password is None or user.password[0] in "!*"
         
     # Generic operations
-    def load(self):
-        pwds = pwd.getpwall()
-        spwds = spwd.getspall()
-        sn = {}
-        for s in spwds:
-            sn[s.sp_nam] = s
-
-        for p in pwds:
-            if p.pw_name in sn:
-                s = sn[p.pw_name]
-            else:
-                s = spwd.struct_spwd([None]*9)
-            
-            gecos = p.pw_gecos.split(',', 4)
+    def load(self, use_cache=False):
+        """Load the users and groups with self.backend, or from the cache
+        with use_cache, if the account files didn't change."""
+        # Remember the local files contents, to be able to diff them later.
+        # Stat them first, so that changes while reading aren't missed.
+        self.snapshots = {}
+        self.signatures = {}
+        for fname in WATCHED_FILES:
+            self.signatures[fname] = self.file_signature(fname)
+            self.snapshots[fname] = self.read_file(fname)
+
+        with _gc_paused():
+            rows = self.read_cache() if use_cache else None
+            if rows is not None:
+                try:
+                    self.load_rows(*rows)
+                except Exception as e:
+                    # The cache must never stop the accounts from loading
+                    self.remove_cache(e)
+                    rows = None
+            self.loaded_from_cache = rows is not None
+            if rows is None:
+                rows = self.enumerate()
+                self.load_rows(*rows)
+        if self.cache and not self.loaded_from_cache:
+            self.save_cache(rows)
+
+    def enumerate(self):
+        """Return the (user_rows, group_rows) of self.backend.
+
+        The user rows are (name, uid, gid, gecos, directory, shell, lstchg,
+        min, max, warn, inact, expire, password) tuples, and the group rows
+        are (name, gid, members) tuples. They're plain tuples for the cache.
+        """
+        if self.backend == 'files':
+            return self.enumerate_files()
+        return self.enumerate_nss()
+
+    def enumerate_nss(self):
+        sn = {s.sp_nam: s for s in spwd.getspall()}
+        no_shadow = (None,) * 7
+        user_rows = []
+        for p in pwd.getpwall():
+            s = sn.get(p.pw_name)
+            shadow = no_shadow if s is None else (s.sp_lstchg, s.sp_min,
+                s.sp_max, s.sp_warn, s.sp_inact, s.sp_expire, s.sp_pwd)
+            user_rows.append((p.pw_name, p.pw_uid, p.pw_gid, p.pw_gecos,
+                              p.pw_dir, p.pw_shell) + shadow)
+        group_rows = [(g.gr_name, g.gr_gid, tuple(g.gr_mem)) for g in grp.getgrall()]
+        return user_rows, group_rows
+
+    def enumerate_files(self):
+        """Return the rows of the local account files snapshots, without
+        going through NSS."""
+        shadow = self.snapshots['shadow']
+        no_shadow = (None,) * 7
+        group_rows = []
+        for fields in self.snapshots['group'].values():
+            try:
+                gid = int(fields[2])
+            except (IndexError, ValueError):
+                continue
+            members = fields[3].split(',') if len(fields) > 3 and fields[3] else []
+            group_rows.append((fields[0], gid, tuple(members)))
+
+        user_rows = []
+        for name, fields in self.snapshots['passwd'].items():
+            try:
+                uid, gid = int(fields[2]), int(fields[3])
+                gecos, directory, shell = fields[4:7]
+            except (IndexError, ValueError):
+                continue
+            row_shadow = self.shadow_values(shadow[name]) if name in shadow else no_shadow
+            user_rows.append((name, uid, gid, gecos, directory, shell) + row_shadow)
+        return user_rows, group_rows
+
+    def load_rows(self, user_rows, group_rows):
+        """Build the users and groups from the enumerate() rows."""
+        self.users = {}
+        self.groups = {}
+        # Like getgrgid() and gid_name(), prefer the first group with a gid
+        gid_names = {}
+        for name, gid, members in group_rows:
+            gid_names.setdefault(gid, name)
+
+        for row in user_rows:
+            name, uid, gid, gecos = row[:4]
+            gecos = gecos.split(',', 4)
             gecos += [''] * (5 - len(gecos)) # Pad with empty strings so we have exactly 5 items
-            rname, office, wphone, hphone, other = gecos
-            u = User(p.pw_name, p.pw_uid, p.pw_gid, rname, office, wphone, hphone,
-                other, p.pw_dir, p.pw_shell, [grp.getgrgid(p.pw_gid).gr_name], s.sp_lstchg, s.sp_min, s.sp_max, s.sp_warn, 
-                s.sp_inact, s.sp_expire, s.sp_pwd)
-            self.users[u.name] = u
+            primary_group = gid_names.get(gid, '')
+            u = User(name, uid, gid, *gecos, row[4], row[5],
+                     [primary_group] if primary_group else [], *row[6:])
+            u.primary_group = primary_group
+            self.users[name] = u
+
+        for group in group_rows:
+            self.load_group(*group)
 
-        groups = grp.getgrall()
-        for group in groups:
-            g = Group(group.gr_name, group.gr_gid)
-            for member in group.gr_mem:
-                if member in self.users:
-                    ugroups = self.users[member].groups
-                    if group.gr_name not in ugroups:
-                        self.users[member].groups.append(group.gr_name)
-                    g.members[member] = self.users[member]
-            
-            self.groups[group.gr_name] = g
-        
         for user in self.users.values():
-            primary_group = grp.getgrgid(user.gid).gr_name
-            if primary_group in self.groups:
-                self.groups[primary_group].members[user.name] = user
+            if user.primary_group in self.groups:
+                self.groups[user.primary_group].members[user.name] = user
+        self.reindex()
+
+    def account_rows(self):
+        """Return the enumerate() rows of the current users and groups."""
+        user_rows = [(u.name, u.uid, u.gid,
+                      ','.join((u.rname, u.office, u.wphone, u.hphone, u.other)),
+                      u.directory, u.shell, u.lstchg, u.min, u.max, u.warn,
+                      u.inact, u.expire, u.password) for u in self.users.values()]
+        group_rows = [(g.name, g.gid, tuple(m for m in g.members
+                                            if m in self.users and self.users[m].gid != g.gid))
+                      for g in self.groups.values()]
+        return user_rows, group_rows
+
+    # The snapshot cache
+    def cache_path(self):
+        return os.path.join(paths.cachedir, CACHE_FILE)
+
+    def cache_key(self):
+        return (CACHE_VERSION, self.backend, paths.sysconfdir)
+
+    def read_cache(self):
+        """Return the cached rows if they were saved with the current account
+        files signatures, otherwise None. A corrupt cache is removed."""
+        try:
+            with open(self.cache_path(), 'rb') as f:
+                st = os.fstat(f.fileno())
+                # Only trust a cache that no one else could have written
+                if st.st_uid != os.geteuid() or st.st_mode & 0o077:
+                    return None
+                data = pickle.load(f)
+                if data.get('key') != self.cache_key() \
+                        or data['signatures'] != self.signatures:
+                    return None
+                users, groups = list(data['users']), list(data['groups'])
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # Partial or corrupt pickles raise all kinds of errors
+            self.remove_cache(e)
+            return None
+        self.cache_signatures = data['signatures']
+        self.cached_rows = users, groups
+        return self.cached_rows
+
+    def remove_cache(self, error):
+        """Remove the cache after error, so that it's written again."""
+        sys.stderr.write("Ignoring the invalid accounts cache: %s\n" % error)
+        self.cache_signatures = None
+        self.cached_rows = None
+        try:
+            os.remove(self.cache_path())
+        except OSError:
+            pass
+
+    def save_cache(self, rows=None):
+        """Save rows, by default the account_rows(), to the cache, unless
+        it's up to date. The file is written in a thread."""
+        if rows is None:
+            if self.cache_signatures == self.signatures:
+                return
+            rows = self.account_rows()
+        self.cache_signatures = dict(self.signatures)
+        data = {'key': self.cache_key(), 'signatures': self.cache_signatures,
+                'users': rows[0], 'groups': rows[1]}
+        # Not a daemon thread, so that e.g. the command line tools finish it
+        threading.Thread(target=self._write_cache, args=(data,)).start()
+
+    def _write_cache(self, data):
+        path = self.cache_path()
+        tmp = None
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            # A unique, private temporary file, as the GUI, the command line
+            # tools and the signup daemon may all be saving the cache
+            fd, tmp = tempfile.mkstemp(prefix=CACHE_FILE + '.', dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError as e:
+            sys.stderr.write("Could not save the accounts cache: %s\n" % e)
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def revalidate(self):
+        """Enumerate the accounts in a thread, and reload them if they differ
+        from the cached ones, e.g. because of LDAP changes."""
+        cached = self.cached_rows
+
+        def normalized(rows):
+            user_rows = []
+            for row in rows[0]:
+                gecos = row[3].split(',', 4)
+                gecos += [''] * (5 - len(gecos))
+                user_rows.append(row[:3] + tuple(gecos) + row[4:])
+            user_rows.sort()
+            group_rows = sorted((name, gid, frozenset(members))
+                                for name, gid, members in rows[1])
+            return user_rows, group_rows
+
+        def compare():
+            if normalized(self.enumerate()) != normalized(cached):
+                from twisted.internet import reactor
+                reactor.callFromThread(self.reload)
+
+        threading.Thread(target=compare, daemon=True).start()
+
+    def load_group(self, name, gid, members):
+        g = Group(name, gid)
+        for member in members:
+            if member in self.users:
+                ugroups = self.users[member].groups
+                if name not in ugroups:
+                    ugroups.append(name)
+                g.members[member] = self.users[member]
+        self.groups[name] = g
     
     def reload(self):
         self.users = {}
         self.groups = {}
         self.load()
-        self.libuser_event.notify('event')
+        self.libuser_event.notify([Change(Change.RELOADED)])
+
+    # Incremental loading
+    def file_signature(self, fname):
+        try:
+            st = os.stat(os.path.join(paths.sysconfdir, fname))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def read_file(self, fname):
+        """Return a {name: fields} dict of a local account file."""
+        entries = {}
+        try:
+            with open(os.path.join(paths.sysconfdir, fname)) as f:
+                for line in f.read().splitlines():
+                    # Skip comments and the NIS compat entries
+                    if not line or line[0] in '#+-':
+                        continue
+                    fields = tuple(line.split(':'))
+                    entries[fields[0]] = fields
+        except OSError:
+            pass
+        return entries
+
+    def update(self):
+        """Reload the local account files that changed since the last load
+        or update, by diffing them against their previous contents.
+        Emits a single libuser_event with the resulting changes, if any.
+        While the System is suspended, this does nothing.
+        """
+        if self.suspended:
+            return []
+        changes = []
+        for fname in WATCHED_FILES:
+            signature = self.file_signature(fname)
+            if signature == self.signatures.get(fname):
+                continue
+            self.signatures[fname] = signature
+            old = self.snapshots.get(fname, {})
+            new = self.read_file(fname)
+            self.snapshots[fname] = new
+            changes.extend(getattr(self, 'diff_' + fname)(old, new))
+        changes = coalesce_changes(changes)
+        if changes:
+            self.libuser_event.notify(changes)
+        return changes
+
+    def suspend(self):
+        """Stop processing the account file changes until resume()."""
+        self.suspended += 1
+
+    def resume(self):
+        """Process all the changes that happened while suspended at once."""
+        self.suspended -= 1
+        if not self.suspended:
+            if threading.current_thread() is threading.main_thread():
+                self.update()
+            else:
+                # E.g. at the end of a jobs.Job; the change events are
+                # handled by the GUI, so they must come from the main thread
+                from twisted.internet import reactor
+                reactor.callFromThread(self.update)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Suspend the change processing for the duration of a with block,
+        e.g. while running many useradd commands, so that a single
+        reconciled libuser_event is emitted at its end."""
+        self.suspend()
+        try:
+            yield self
+        finally:
+            self.resume()
+
+    def diff_passwd(self, old, new):
+        changes = []
+        # Malformed lines are skipped like in enumerate_files()
+        new = {name: fields for name, fields in new.items()
+               if _valid_fields(fields, 7, (2, 3))}
+        for name in old.keys() - new.keys():
+            user = self.users.pop(name, None)
+            if user is None:
+                continue
+            for group in self.get_member_groups(name):
+                self.remove_member(group, name)
+                changes.append(Change(Change.MODIFIED, 'group', group.name, group))
+            self.unindex_user(name)
+            changes.append(Change(Change.REMOVED, 'user', name, user))
+        for name, fields in new.items():
+            if old.get(name) == fields:
+                continue
+            user = self.users.get(name)
+            if user is None:
+                user = User(name)
+                self.users[name] = user
+                changes.append(Change(Change.ADDED, 'user', name, user))
+            else:
+                changes.append(Change(Change.MODIFIED, 'user', name, user))
+            user.uid, user.gid = int(fields[2]), int(fields[3])
+            gecos = fields[4].split(',', 4)
+            gecos += [''] * (5 - len(gecos)) # Pad with empty strings so we have exactly 5 items
+            user.rname, user.office, user.wphone, user.hphone, user.other = gecos
+            user.directory, user.shell = fields[5], fields[6]
+            if fields[1] != 'x':
+                user.password = fields[1]
+            if name in self.snapshots.get('shadow', {}):
+                self.set_shadow_fields(user, self.snapshots['shadow'][name])
+            self.index_user(user)
+            changes.extend(self.update_memberships(user))
+        return changes
+
+    def diff_shadow(self, old, new):
+        changes = []
+        for name, fields in new.items():
+            if old.get(name) != fields and name in self.users:
+                self.set_shadow_fields(self.users[name], fields)
+                changes.append(Change(Change.MODIFIED, 'user', name, self.users[name]))
+        return changes
+
+    def diff_group(self, old, new):
+        changes = []
+        new = {name: fields for name, fields in new.items()
+               if _valid_fields(fields, 3, (2,))}
+        for name in old.keys() - new.keys():
+            group = self.groups.pop(name, None)
+            if group is None:
+                continue
+            self.unindex_group(group)
+            for user in group.members.values():
+                if name in user.groups:
+                    user.groups.remove(name)
+            changes.append(Change(Change.REMOVED, 'group', name, group))
+        for name, fields in new.items():
+            if old.get(name) == fields:
+                continue
+            group = self.groups.get(name)
+            if group is None:
+                group = Group(name)
+                self.groups[name] = group
+                changes.append(Change(Change.ADDED, 'group', name, group))
+            else:
+                changes.append(Change(Change.MODIFIED, 'group', name, group))
+            group.gid = int(fields[2])
+            members = fields[3].split(',') if len(fields) > 3 else []
+            members = {m: self.users[m] for m in members if m in self.users}
+            for user in self.get_users_by_gid(group.gid):
+                members[user.name] = user
+            for uname, user in group.members.items():
+                if uname not in members and name in user.groups:
+                    user.groups.remove(name)
+                    changes.append(Change(Change.MODIFIED, 'user', uname, user))
+            for uname, user in members.items():
+                if name in user.groups:
+                    continue
+                if user.gid == group.gid:
+                    user.groups.insert(0, name)
+                    user.primary_group = name
+                else:
+                    user.groups.append(name)
+                changes.append(Change(Change.MODIFIED, 'user', uname, user))
+            group.members = members
+            self.index_group(group)
+        return changes
+
+    def shadow_values(self, fields):
+        """Return the (lstchg, min, max, warn, inact, expire, password) of
+        the shadow file fields, like spwd would return them."""
+        nums = [int(f) if f.lstrip('-').isdigit() else -1 for f in fields[2:8]]
+        nums += [-1] * (6 - len(nums))
+        return tuple(nums) + (fields[1],)
+
+    def set_shadow_fields(self, user, fields):
+        """Set the shadow attributes of user, like spwd would return them."""
+        user.lstchg, user.min, user.max, user.warn, user.inact, user.expire, \
+            user.password = self.shadow_values(fields)
+
+    def update_memberships(self, user):
+        """Recalculate user.groups and the group members after the user was
+        added or its primary group changed, from the group file snapshot.
+        Return the changes of the groups whose members changed."""
+        groups = []
+        user.primary_group = ''
+        for name, fields in self.snapshots.get('group', {}).items():
+            if name not in self.groups or not _valid_fields(fields, 3, (2,)):
+                continue
+            # Like gid_name(), the first group with the gid is the primary
+            if int(fields[2]) == user.gid and not user.primary_group:
+                groups.insert(0, name)
+                user.primary_group = name
+            elif len(fields) > 3 and user.name in fields[3].split(','):
+                groups.append(name)
+        changes = []
+        for name in set(user.groups) - set(groups):
+            group = self.groups.get(name)
+            if group is not None and user.name in group.members:
+                self.remove_member(group, user.name)
+                changes.append(Change(Change.MODIFIED, 'group', name, group))
+        for name in groups:
+            group = self.groups[name]
+            if user.name not in group.members:
+                changes.append(Change(Change.MODIFIED, 'group', name, group))
+            self.add_member(group, user)
+        user.groups = groups
+        return changes
             
     def get_valid_shells(self):
         try:
@@ -398,19 +1661,13 @@ class System(Set):
         return gid >= FIRST_SYSTEM_GID and gid <= LAST_GID
     
     def uid_is_free(self, uid):
-        return self.uid_is_valid(uid) and uid not in [user.uid for user in self.users.values()]
+        return self.uid_is_valid(uid) and self.uids.is_free(uid)
     
     def gid_is_free(self, gid):
-        return self.gid_is_valid(gid) and gid not in [group.gid for group in self.groups.values()]
+        return self.gid_is_valid(gid) and self.gids.is_free(gid)
     
     def get_free_uids(self, starting=FIRST_UID, ending=LAST_UID):
-        used_uids = [user.uid for user in self.users.values()]
-        
-        free_uids = list(range(FIRST_UID, LAST_UID+1))
-        for uid in used_uids:
-            free_uids.remove(uid)
-        
-        return free_uids
+        return [uid for uid in range(starting, ending+1) if self.uids.is_free(uid)]
     
     def name_is_valid(self, name):
         return re.match(NAME_REGEX, name)
@@ -426,10 +1683,14 @@ class System(Set):
         """
         Converts a plain text password to a sha-512 encrypted one.
         """
-        alphabet='0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        salt=''.join([ random.choice(alphabet) for i in range(8) ])
+        return encrypt_password(plainpw, self.hasher.rounds)
 
-        return crypt.crypt(plainpw, "$6$%s$" % salt)
+    def encrypt_many(self, passwords):
+        """
+        Converts many plain text passwords to sha-512 encrypted ones,
+        in parallel. See also self.hasher.submit().
+        """
+        return self.hasher.encrypt_many(passwords)
 
     # Event functions
     def connect_event(self, func):
@@ -437,20 +1698,21 @@ class System(Set):
 
     # Event callback
     def on_system_changed(self, event):
-        self.reload()
+        self.update()
 
     # INotifier callback
     def on_fd_changed(self, ignored, filename, mask):
         # For debugging use _watchpoint & _watchpaths
-        self.notifier.ignore(filename)
-        self.notifier._addWatch(filename, self.mask, False, [self.on_fd_changed])
-        self.system_event.notify(filename.path)
+        if filename.basename() in WATCHED_FILES:
+            self.system_event.notify(filename.path)
 
 _system_ = None
-def get_system():
+def get_system(backend=None, watch=True, cache=True):
+    """Return the global System, creating it with these arguments if it
+    doesn't exist yet."""
     global _system_
     if not _system_:
-        _system_ = System()
+        _system_ = System(backend, watch, cache)
     return _system_
 
 if __name__ == '__main__':
@@ -7,66 +7,88 @@
 # Licensed under GNU General Public License 3.0 or later.
 # Some rights reserved. See COPYING, AUTHORS.
 
+import time
+# --startup-time measures the startup phases from here
+START_TIME = time.perf_counter()
 import getpass
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gio
+from gi.repository import Gtk, Gio, GLib
 import glob
 import locale
 import os
 import socket
 import subprocess
 import sys
-from dbus.mainloop.glib import DBusGMainLoop
-DBusGMainLoop(set_as_default=True)
 from twisted.internet import gireactor
 gireactor.install()
 from twisted.internet import reactor, defer
 
-import about_dialog
+# The dialogs are imported when they're first used, to start faster
+import account_models
 import common
 import config
-import create_users
 import dialogs
-import export_dialog
-import group_form
-import import_dialog
-#import ip_dialog
 import libuser
-import ltsp_info
-import parsers
 import ltsp_shared_folders
-import user_form
+import search_index
 import version
 import paths
 
+class StartupTimer:
+    """Print how long each startup phase took, for --startup-time."""
+    def __init__(self, start):
+        self.start = self.last = start
+
+    def phase(self, name):
+        now = time.perf_counter()
+        sys.stderr.write("%-24s %8.3fs %8.3fs\n" % (name, now - self.last, now - self.start))
+        self.last = now
+
 class Gui:
-    def __init__(self):
-        self.system = libuser.get_system()
-        self.sf=ltsp_shared_folders.SharedFolders(self.system)
+    def __init__(self, timer=None):
+        self.timer = timer
+        self.startup_phase("imports")
+        # The accounts are loaded after the main window is shown
+        self.system = None
+        self.sf = None
         self.conf = config.get_config()
 
         resource = Gio.resource_load(os.path.join(paths.pkgdatadir, 'ltsp-manager.gresource'))
         Gio.Resource._register(resource)
+        self.startup_phase("gresource")
 
         self.builder = Gtk.Builder()
         self.builder.add_from_resource('/org/ltsp/ltsp-manager/ui/ltsp-manager.ui')
         self.builder.connect_signals(self)
+        self.startup_phase("builder")
 
         self.icontheme = Gtk.IconTheme.get_default()
 
         self.main_window = self.builder.get_object('main_window')
         self.users_tree = self.builder.get_object('users_treeview')
         self.groups_tree = self.builder.get_object('groups_treeview')
-        self.users_sort = self.builder.get_object('users_sort')
         self.groups_sort = self.builder.get_object('groups_sort')
-        self.users_filter = self.builder.get_object('users_filter')
         self.groups_filter = self.builder.get_object('groups_filter')
-        self.users_model = self.builder.get_object('users_store')
         self.groups_model = self.builder.get_object('groups_store')
+        # The users columns are computed when they're shown, for large
+        # databases; the filter and sort models are created after filling it
+        self.users_model = account_models.LazyAccountsModel(
+            'user', account_models.USER_COLUMNS)
+        # The model that the users view shows, users_model or search results
+        self.users_view_model = self.users_model
+        self.users_filter = None
+        self.users_sort = None
+        # The search index is built on the first search
+        self.search_index = None
+        self.search_text = ''
+        self.groups_sync = account_models.ListStoreSync(
+            self.groups_model, 'group', account_models.group_row)
 
         self.show_private_groups = False
         self.show_system_groups = False
+        # The names of the members of the selected groups, or None
+        self.selected_members = None
         self.builder.get_object('mi_show_private_groups').set_active(self.conf.parser.getboolean('GUI', 'show_private_groups'))
         self.builder.get_object('mi_show_system_groups').set_active(self.conf.parser.getboolean('GUI', 'show_system_groups'))
         if locale.getdefaultlocale()[0] != "el_GR":
@@ -74,7 +96,6 @@ class Gui:
             self.builder.get_object("mn_help").remove(self.builder.get_object('mi_helpdesk_ticket'))
             self.builder.get_object("mn_help").remove(self.builder.get_object('mi_forum'))
 
-        self.users_filter.set_visible_func(self.set_user_visibility)
         self.groups_filter.set_visible_func(self.set_group_visibility)
 
         # Fill the View -> Columns menu with all the columns of the treeview
@@ -92,13 +113,36 @@ class Gui:
             menuitem.connect('toggled', self.on_mi_view_column_toggled, column)
             menuitem.set_active(title in visible)
             mn_view_columns.append(menuitem)
-        self.populate_treeviews()
+        self.startup_phase("main window")
 
         self.queue = []
-        self.system.connect_event(self.on_libuser_changed)
+        # Nothing can be edited until the accounts are loaded
+        self.builder.get_object('box1').set_sensitive(False)
+        self.map_handler = self.main_window.connect('map-event', self.on_main_window_map_event)
         self.main_window.show_all()
         #self.check_initial_setup()
 
+    def startup_phase(self, name):
+        if self.timer:
+            self.timer.phase(name)
+
+    def on_main_window_map_event(self, widget, event):
+        self.main_window.disconnect(self.map_handler)
+        self.startup_phase("window mapped")
+        # The idle priority is lower than redrawing, so the window is drawn first
+        GLib.idle_add(self.load_accounts)
+
+    def load_accounts(self):
+        self.system = libuser.get_system()
+        self.sf = ltsp_shared_folders.SharedFolders(self.system)
+        self.startup_phase("accounts loaded from the cache"
+                           if self.system.loaded_from_cache else "accounts loaded")
+        self.populate_treeviews()
+        self.system.connect_event(self.on_libuser_changed)
+        self.builder.get_object('box1').set_sensitive(True)
+        self.startup_phase("treeviews populated")
+        return False
+
 ## General helper functions
 
     def edit_file(self, filename):
@@ -127,61 +171,156 @@ class Gui:
 
 ## INotify
 
-    def on_libuser_changed(self, event):
-        self.queue.append(event)
+    def on_libuser_changed(self, changes):
+        self.queue.append(changes)
         d = defer.Deferred()
         reactor.callLater(1, d.callback, len(self.queue))
         d.addCallback(self.check_libuser_events)
 
     def check_libuser_events(self, len_queue):
         if len_queue == len(self.queue):
+            changes = libuser.coalesce_changes(
+                [change for changes in self.queue for change in changes])
             self.queue = []
-            self.repopulate_treeviews()
+            self.update_treeviews(changes)
 
 ## Groups and users treeviews
 
     def populate_treeviews(self):
         """Fill the users and groups treeviews from the system"""
-        for user in self.system.users.values():
-            self.users_model.append([user, user.uid, user.name, user.primary_group, user.rname, user.office, user.wphone, user.hphone, user.other, user.directory, user.shell, user.lstchg, user.min, user.max, user.warn, user.inact, user.expire])
-        for group in self.system.groups.values():
-            self.groups_model.append([group, group.gid, group.name])
+        self.users_tree.set_model(None)
+        self.users_model.fill(self.system.users.values())
+        if self.search_index:
+            self.search_index.fill(self.system.users.values())
+        self.show_users()
+        self.groups_sync.fill(self.system.groups.values())
+
+    def show_users(self):
+        """Show all the users, or only the search results if there's a
+        search text, in the users view."""
+        if self.search_text:
+            names = sorted(self.search_index.search(self.search_text))
+            model = account_models.LazyAccountsModel('user', account_models.USER_COLUMNS)
+            model.fill(self.system.users[name] for name in names)
+        else:
+            model = self.users_model
+        # Keep the sort order of the users view
+        column, order = None, None
+        if self.users_sort:
+            column, order = self.users_sort.get_sort_column_id()
+        self.users_tree.set_model(None)
+        self.users_view_model = model
+        self.users_filter = model.filter_new()
+        self.users_filter.set_visible_func(self.set_user_visibility)
+        self.users_sort = Gtk.TreeModelSort(model=self.users_filter)
+        if column is not None and column >= 0:
+            self.users_sort.set_sort_column_id(column, order)
+        self.users_tree.set_model(self.users_sort)
+
+    def search_changes(self, changes):
+        """Convert the user changes to the changes of the search results."""
+        matches = self.search_index.search(self.search_text)
+        result = []
+        for change in changes:
+            if change.kind != 'user':
+                continue
+            if change.action == libuser.Change.REMOVED or change.name not in matches:
+                result.append(libuser.Change(libuser.Change.REMOVED, 'user', change.name, change.obj))
+            else:
+                # A user that now matches is added by apply()
+                result.append(change)
+        return result
+
+    def update_treeviews(self, changes):
+        """Update only the rows of the changed users and groups."""
+        if any(change.action == libuser.Change.RELOADED for change in changes):
+            self.repopulate_treeviews()
+            return
+        self.users_model.apply(changes)
+        if self.search_index:
+            self.search_index.apply(changes)
+        if self.search_text:
+            self.users_view_model.apply(self.search_changes(changes))
+        changed_groups = self.groups_sync.apply(changes)
+        # The users of the selected groups may have changed, including the
+        # users that have them as their primary groups
+        selected = self.get_selected_groups()
+        if not selected:
+            return
+        selected_gids = set(g.gid for g in selected)
+        if changed_groups & set(g.name for g in selected) or any(
+                change.kind == 'user' and (change.name in (self.selected_members or ())
+                    or change.action != libuser.Change.REMOVED
+                    and change.obj.gid in selected_gids)
+                for change in changes):
+            self.selected_members = account_models.group_members(selected)
+            self.users_filter.refilter()
 
     def repopulate_treeviews(self):
-        # Preserve the selected groups and users
+        # Preserve the selected groups and users and the scroll positions
         groups_selection = self.groups_tree.get_selection()
         users_selection = self.users_tree.get_selection()
         selected_groups = [i.name for i in self.get_selected_groups()]
         selected_users = [i.name for i in self.get_selected_users()]
+        groups_scroll = self.groups_tree.get_vadjustment().get_value()
+        users_scroll = self.users_tree.get_vadjustment().get_value()
 
         # Clear and refill the treeviews
-        self.users_model.clear()
-        self.groups_model.clear()
         self.populate_treeviews()
 
         # Reselect the previously selected groups and users, if possible
-        groups_iters = dict((row[0].name, row.iter) for row in self.groups_sort)
         for gname in selected_groups:
-            if gname in groups_iters:
-                groups_selection.select_iter(groups_iters[gname])
-        users_iters = dict((row[0].name, row.iter) for row in self.users_sort)
+            path = self.get_sort_path(self.groups_sync, self.groups_filter, self.groups_sort, gname)
+            if path is not None:
+                groups_selection.select_path(path)
         for uname in selected_users:
-            if uname in users_iters:
-                users_selection.select_iter(users_iters[uname])
+            path = self.get_sort_path(self.users_view_model, self.users_filter, self.users_sort, uname)
+            if path is not None:
+                users_selection.select_path(path)
+        # After the views have resized to the new rows
+        GLib.idle_add(self.restore_scroll, groups_scroll, users_scroll)
+
+    def restore_scroll(self, groups_scroll, users_scroll):
+        self.groups_tree.get_vadjustment().set_value(groups_scroll)
+        self.users_tree.get_vadjustment().set_value(users_scroll)
+        return False
+
+    def get_sort_path(self, sync, filter_model, sort_model, name):
+        """Return the path of name in the sorted view, or None if it's not
+        visible."""
+        path = sync.get_name_path(name)
+        if path is not None:
+            path = filter_model.convert_child_path_to_path(path)
+        if path is None:
+            return None
+        return sort_model.convert_child_path_to_path(path)
+
+    def on_users_search_changed(self, entry):
+        text = entry.get_text().strip()
+        if text == self.search_text:
+            return
+        if text and not self.search_index:
+            self.search_index = search_index.SearchIndex()
+            self.search_index.fill(self.system.users.values())
+        self.search_text = text
+        self.show_users()
+
+    def on_users_search_stopped(self, entry):
+        entry.set_text('')
 
     def set_user_visibility(self, model, rowiter, options):
-        user = model[rowiter][0]
-        selected = self.get_selected_groups()
-        # FIXME: The list comprehension here costs
-        return (len(selected) == 0 and (self.show_system_groups or not user.is_system_user())) \
-                or user in [u for g in selected for u in g.members.values()]
+        # This runs for every row on refilter, so the members are precomputed
+        return account_models.user_is_visible(model.get_value(rowiter, 0),
+            self.selected_members, self.show_system_groups)
 
     def set_group_visibility(self, model, rowiter, options):
         group = model[rowiter][0]
         return (self.show_private_groups or not group.is_private()) and (self.show_system_groups or group.is_user_group())
 
     def on_groups_selection_changed(self, selection):
-        self.users_filter.refilter()
+        self.selected_members = account_models.group_members(self.get_selected_groups())
+        if self.users_filter:
+            self.users_filter.refilter()
         mi_edit_group = self.builder.get_object('mi_edit_group')
         mi_delete_group = self.builder.get_object('mi_delete_group')
         rows = selection.count_selected_rows()
@@ -257,9 +396,11 @@ class Gui:
             return True
 
     def on_users_treeview_row_activated(self, widget, path, column):
+        import user_form
         user_form.EditUserDialog(self.system, widget.get_model()[path][0], parent=self.main_window)
 
     def on_groups_treeview_row_activated(self, widget, path, column):
+        import group_form
         group_form.EditGroupDialog(self.system, self.sf, widget.get_model()[path][0], parent=self.main_window)
 
     def on_unselect_all_groups_clicked(self, widget):
@@ -272,6 +413,8 @@ class Gui:
         # TODO: restore this when LP: #1710416 is fixed
         self.conf.parser.set('GUI', 'visible_user_columns', 'all')
         self.conf.save()
+        if self.system:
+            self.system.save_cache()
         exit()
 
 ## File menu
@@ -282,6 +425,7 @@ class Gui:
     #FIXME: Maybe use notify /etc/group then self.populate_treeviews not need to
     #update user groups for shared folder library
     def on_mi_new_users_activate(self, widget):
+        import create_users
         create_users.NewUsersDialog(self.system, self.sf, self.main_window)
 
     def on_mi_import_passwd_activate(self, widget):
@@ -304,6 +448,8 @@ class Gui:
                 shadow = None
             if not os.path.isfile(group):
                 group = None
+            import import_dialog
+            import parsers
             new_users = parsers.passwd().parse(passwd, shadow, group)
             if len(new_users.users) == 0:
                 text = _("The file \"%s\" contains no data.") % passwd
@@ -327,17 +473,23 @@ class Gui:
         resp = chooser.run()
         if resp == Gtk.ResponseType.OK:
             fname = chooser.get_filename()
-            new_users = parsers.CSV().parse(fname)
+            import import_dialog
+            import parsers
+            new_users = libuser.Set()
+            # Parse the first chunk now, the rest while the dialog is shown
+            chunks = parsers.CSV().iter_parse(fname, new_users)
+            next(chunks, None)
             if len(new_users.users) == 0:
                 text = _("The file \"%s\" contains no data.") % fname
                 dialogs.ErrorDialog(text, _("Error")).showup()
                 return False
             chooser.destroy()
-            import_dialog.ImportDialog(new_users, parent=self.main_window)
+            import_dialog.ImportDialog(new_users, parent=self.main_window, chunks=chunks)
         else:
             chooser.destroy()
 
     def on_mi_export_csv_activate(self, widget):
+        import export_dialog
         users = self.get_selected_users()
         if len(users) == 0:
             if self.show_system_groups:
@@ -367,6 +519,10 @@ class Gui:
                           os.path.join(paths.pkgdatadir, 'scripts', 'initial-setup.sh')])
 
     def on_mi_configuration_network_activate(self, widget):
+        # ip_dialog connects to the system bus when it's imported
+        from dbus.mainloop.glib import DBusGMainLoop
+        DBusGMainLoop(set_as_default=True)
+        import ip_dialog
         ip_dialog.Ip_Dialog(self.main_window)
 
     def on_mi_ltsp_update_image_activate(self, widget):
@@ -409,7 +565,9 @@ class Gui:
     def on_mi_show_system_groups_toggled(self, widget):
         self.show_system_groups = not self.show_system_groups
         self.groups_filter.refilter()
-        self.users_filter.refilter()
+        # The users filter is created when the accounts are loaded
+        if self.users_filter:
+            self.users_filter.refilter()
 
     def on_mi_show_private_groups_toggled(self, widget):
         self.show_private_groups = not self.show_private_groups
@@ -421,9 +579,11 @@ class Gui:
 ## Users menu
 
     def on_mi_new_user_activate(self, widget):
+        import user_form
         user_form.NewUserDialog(self.system, parent=self.main_window)
 
     def on_mi_edit_user_activate(self, widget):
+        import user_form
         user_form.EditUserDialog(self.system, self.get_selected_users()[0], parent=self.main_window)
 
     def on_mi_delete_user_activate(self, widget):
@@ -450,12 +610,12 @@ class Gui:
         if response == Gtk.ResponseType.YES:
             rm_homes = rm_homes_check.get_active()
             if users_n > 1:
+                import jobs
                 progress = dialogs.ProgressDialog("Deleting Users", users_n, self.main_window)
-                for user in self.get_selected_users():
-                    dialogs.wait_gtk()
-                    progress.set_message("Delete user: {user}".format(user=user.name))
-                    self.system.delete_user(user, rm_homes)
-                    progress.inc()
+                job = jobs.Job(users, lambda user: self.system.delete_user(user, rm_homes),
+                               describe=lambda user: "Delete user: {user}".format(user=user.name),
+                               system=self.system)
+                job.start(progress)
             else:
                 self.system.delete_user(users[0],rm_homes)
 
@@ -474,20 +634,23 @@ class Gui:
         if response == Gtk.ResponseType.YES:
             if users_n > 1:
                 progress = dialogs.ProgressDialog("Remove users from groups", users_n, self.main_window)
-                for user in self.get_selected_users():
-                    dialogs.wait_gtk()
-                    progress.set_message("remove user {user} from groups {groups}".format(user=user.name, groups=', '.join([g.name for g in groups])))
-                    self.system.remove_user_from_groups(user, groups)
-                    progress.inc()
+                with self.system.batch():
+                    for user in self.get_selected_users():
+                        dialogs.wait_gtk()
+                        progress.set_message("remove user {user} from groups {groups}".format(user=user.name, groups=', '.join([g.name for g in groups])))
+                        self.system.remove_user_from_groups(user, groups)
+                        progress.inc()
             else:
                 self.system.remove_user_from_groups(users[0], groups)
 
 ## Groups menu
 
     def on_mi_new_group_activate(self, widget):
+        import group_form
         group_form.NewGroupDialog(self.system, self.sf, parent=self.main_window)
 
     def on_mi_edit_group_activate(self, widget):
+        import group_form
         group_form.EditGroupDialog(self.system, self.sf, self.get_selected_groups()[0], parent=self.main_window)
 
     def on_mi_delete_group_activate(self, widget):
@@ -503,11 +666,12 @@ class Gui:
         if response == Gtk.ResponseType.YES:
             self.sf.remove(groups)
             progress = dialogs.ProgressDialog("Deleting Groups", len(groups), self.main_window)
-            for group in groups:
-                dialogs.wait_gtk()
-                progress.set_message("Deleting group {group}".format(group=group.name))
-                self.system.delete_group(group)
-                progress.inc()
+            with self.system.batch():
+                for group in groups:
+                    dialogs.wait_gtk()
+                    progress.set_message("Deleting group {group}".format(group=group.name))
+                    self.system.delete_group(group)
+                    progress.inc()
 
 ## Help menu
 
@@ -552,9 +716,11 @@ class Gui:
         self.open_link('http://manpages.ubuntu.com/lts.conf')
 
     def on_mi_ltsp_info_activate(self, widget):
+        import ltsp_info
         ltsp_info.LtspInfo(self.main_window)
 
     def on_mi_about_activate(self, widget):
+        import about_dialog
         about_dialog.AboutDialog(self.main_window)
 
 
@@ -568,8 +734,9 @@ computer labs, and it provides a GUI for managing user accounts, running
 maintenance tasks etc.
 
 Options:
-    -h, --help     Display this help and exit.
-    -v, --version  Output version information and exit.
+    -h, --help          Display this help and exit.
+    -t, --startup-time  Print how long each startup phase takes.
+    -v, --version       Output version information and exit.
 
 Bug reports can be filed at https://bugs.launchpad.net/ltsp-manager."""))
 
@@ -588,8 +755,11 @@ if __name__ == '__main__':
     elif len(sys.argv) == 2 and (sys.argv[1] == '-h' or sys.argv[1] == '--help'):
         usage()
         sys.exit(0)
+    timer = None
+    if len(sys.argv) == 2 and (sys.argv[1] == '-t' or sys.argv[1] == '--startup-time'):
+        timer = StartupTimer(START_TIME)
     elif len(sys.argv) >= 2:
         usage()
         sys.exit(1)
-    Gui()
+    Gui(timer)
     reactor.run()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# This File is part of the ltsp-manager.
+#
+# Copyright 2012-2018 by it's authors.
+#
+# Licensed under GNU General Public License 3.0 or later.
+# Some rights reserved. See COPYING, AUTHORS.
+
+"""
+Manage users and groups from the command line, e.g. for roster syncs from cron.
+It uses the same libuser engine as ltsp-manager, without loading GTK.
+"""
+import argparse
+import csv
+import sys
+
+import common
+import libuser
+import parsers
+import version
+
+
+class CLI:
+    def __init__(self, backend=None):
+        # The account files aren't watched, the commands update the system
+        # themselves after they change it
+        self.system = libuser.get_system(backend, watch=False)
+        self.reserved_uids = []
+        self.reserved_gids = []
+
+    def error(self, message):
+        sys.stderr.write(_("Error: %s\n") % message.strip())
+
+    def allocate_uid(self):
+        uid = self.system.allocate_uids()[0]
+        self.reserved_uids.append(uid)
+        return uid
+
+    def allocate_gid(self):
+        gid = self.system.allocate_gids()[0]
+        self.reserved_gids.append(gid)
+        return gid
+
+    def release_ids(self):
+        self.system.release_uids(self.reserved_uids)
+        self.system.release_gids(self.reserved_gids)
+        self.reserved_uids = []
+        self.reserved_gids = []
+
+    def get_users(self, names):
+        """Return the users with these names, or None if some don't exist."""
+        missing = [name for name in names if name not in self.system.users]
+        if missing:
+            self.error(_("No such users: %s") % ', '.join(missing))
+            return None
+        return [self.system.users[name] for name in names]
+
+    def save(self, users, groups, passwords, dry_run):
+        """Encrypt the passwords, of the first len(passwords) users, and
+        create the accounts."""
+        for user in users:
+            print(_("%(user)s: UID %(uid)s, GID %(gid)s, home %(home)s") % {
+                "user": user.name, "uid": user.uid, "gid": user.gid,
+                "home": user.directory})
+        if dry_run:
+            return 0
+        hashes = self.system.encrypt_many(passwords)
+        for user, password in zip(users, hashes):
+            user.password = password
+        success, error = self.system.apply_batch(users, groups)
+        if not success:
+            self.error(error)
+            return 1
+        self.system.update()
+        print(_("Created %(users)d users and %(groups)d groups.") % {
+            "users": len(users), "groups": len(groups)})
+        return 0
+
+    def create_batch(self, args):
+        if args.count < 1:
+            self.error(_("The number of users must be positive"))
+            return 1
+        try:
+            users, groups, passwords = self.system.prepare_batch(
+                args.classes, args.count, args.username, args.name,
+                args.password, args.home, args.teachers)
+        except ValueError as e:
+            self.error(str(e))
+            return 1
+        try:
+            # prepare_batch already refused the existing and repeated names
+            invalid = [u.name for u in users if not self.system.name_is_valid(u.name)]
+            if invalid:
+                self.error(_("Invalid usernames: %s") % ', '.join(invalid))
+                return 1
+            result = self.save(users, groups, passwords, args.dry_run)
+        finally:
+            self.system.release_uids([u.uid for u in users])
+            self.system.release_gids([g.gid for g in groups])
+        if result == 0 and args.shared and not args.dry_run:
+            import ltsp_shared_folders
+            sf = ltsp_shared_folders.SharedFolders(self.system)
+            sf.add([c for c in args.classes if c])
+        return result
+
+    def is_imported(self, user):
+        """Return True if user already exists with the same IDs and home."""
+        old = self.system.users.get(user.name)
+        return old is not None and (old.uid, old.gid, old.directory) == \
+            (user.uid, user.gid, user.directory)
+
+    def find_conflicts(self, user, renumber):
+        """Return the problems of importing user, after renumbering its IDs
+        if they're used by other accounts and renumber is set."""
+        system = self.system
+        problems = []
+        if user.name in system.users:
+            problems.append(_("the username is used"))
+        if not system.name_is_valid(user.name):
+            problems.append(_("invalid username"))
+        if system.get_users_by_uid(user.uid):
+            if renumber:
+                user.uid = self.allocate_uid()
+            else:
+                problems.append(_("UID %d is used") % user.uid)
+        if user.primary_group in system.groups:
+            if system.groups[user.primary_group].gid != user.gid:
+                problems.append(_("group %s exists with another GID") % user.primary_group)
+        elif system.get_groups_by_gid(user.gid):
+            if renumber:
+                user.gid = self.allocate_gid()
+            else:
+                problems.append(_("GID %d is used") % user.gid)
+        if system.get_users_by_directory(user.directory):
+            problems.append(_("the home directory %s is used") % user.directory)
+        if user.shell not in self.valid_shells:
+            problems.append(_("invalid shell %s") % user.shell)
+        return problems
+
+    def import_csv(self, args):
+        new_set = libuser.Set()
+        parser = parsers.CSV()
+        try:
+            for users in parser.iter_parse(args.file, new_set):
+                pass
+        except (OSError, csv.Error) as e:
+            self.error(str(e))
+            return 1
+        users = []
+        failed = False
+        for name in parser.duplicates:
+            print(_("%s: repeated in the file, only the first row is used") % name)
+            failed = True
+        self.valid_shells = set(self.system.get_valid_shells())
+        try:
+            for user in list(new_set.users.values()):
+                self.system.complete_user(user, self.allocate_uid,
+                                          self.allocate_gid, new_set)
+                if self.is_imported(user):
+                    print(_("%s: already exists") % user.name)
+                    continue
+                problems = self.find_conflicts(user, args.renumber)
+                if problems:
+                    print(_("%(user)s: %(problems)s") % {
+                        "user": user.name, "problems": ', '.join(problems)})
+                    failed = True
+                else:
+                    users.append(user)
+            if failed and not args.skip_conflicts:
+                self.error(_("Nothing was imported because of the conflicts above"))
+                return 1
+            groups = self.system.import_groups(users, new_set, self.allocate_gid)
+            # Users without a plain text password keep the encrypted one
+            hashed = [u for u in users if u.plainpw]
+            result = self.save(hashed + [u for u in users if not u.plainpw], groups,
+                               [u.plainpw for u in hashed], args.dry_run)
+        finally:
+            self.release_ids()
+        return 1 if result == 0 and failed else result
+
+    def export_csv(self, args):
+        if args.users:
+            users = self.get_users(args.users)
+            if users is None:
+                return 1
+        else:
+            users = [u for u in self.system.users.values()
+                     if args.all or not u.is_system_user()]
+        if args.group:
+            members = set()
+            for group in args.group:
+                if group not in self.system.groups:
+                    self.error(_("No such group: %s") % group)
+                    return 1
+                members.update(self.system.groups[group].members)
+                members.update(u.name for u in self.system.get_users_by_gid(
+                    self.system.groups[group].gid))
+            users = [u for u in users if u.name in members]
+        try:
+            parsers.CSV().write(args.file, self.system, users)
+        except OSError as e:
+            self.error(str(e))
+            return 1
+        print(_("Exported %d users.") % len(users))
+        return 0
+
+    def delete(self, args):
+        users = self.get_users(args.users)
+        if users is None:
+            return 1
+        result = 0
+        with self.system.batch():
+            for user in users:
+                success, error = self.system.delete_user(user, args.remove_home)
+                if success:
+                    print(_("Deleted %s") % user.name)
+                else:
+                    self.error(error)
+                    result = 1
+        return result
+
+    def members(self, args):
+        if args.group not in self.system.groups:
+            self.error(_("No such group: %s") % args.group)
+            return 1
+        users = self.get_users(args.users)
+        if users is None:
+            return 1
+        group = self.system.groups[args.group]
+        result = 0
+        with self.system.batch():
+            for user in users:
+                if args.action == 'add':
+                    success, error = self.system.add_user_to_groups(user, [group])
+                else:
+                    success, error = self.system.remove_user_from_groups(user, [group])
+                if not success:
+                    self.error(error)
+                    result = 1
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("-v", "--version", action='version',
+                        version='%(prog)s ' + version.__version__)
+    parser.add_argument("--backend", choices=libuser.LOAD_BACKENDS,
+                        help="how to read the accounts, default: %s" % libuser.DEFAULT_BACKEND)
+    subparsers = parser.add_subparsers(title="commands")
+
+    p_create = subparsers.add_parser("create-batch",
+        help="Create a number of users for each class, like the \"Create many users\" dialog.",
+        epilog="In the templates, {c} is replaced by the class name, {i} by the user number and {0i} by the user number with two digits.")
+    p_create.add_argument("classes", nargs="*", default=[''],
+                          help="the class groups, which are created if they don't exist")
+    p_create.add_argument("-n", "--count", type=int, required=True,
+                          help="the number of users per class")
+    p_create.add_argument("--username", default="{c}{0i}", help="default: %(default)s")
+    p_create.add_argument("--name", default="{c}{0i}", help="the real name template, default: %(default)s")
+    p_create.add_argument("--password", default="{c}{0i}", help="default: %(default)s")
+    p_create.add_argument("--home", default=libuser.HOME_PREFIX,
+                          help="the directory of the homes, default: %(default)s")
+    p_create.add_argument("--teachers", action='store_true',
+                          help="add the teachers to the class groups")
+    p_create.add_argument("--shared", action='store_true',
+                          help="create shared folders for the class groups")
+    p_create.add_argument("--dry-run", action='store_true')
+    p_create.set_defaults(func=CLI.create_batch, changes_accounts=True)
+
+    p_import = subparsers.add_parser("import", help="Create the users of a CSV file.")
+    p_import.add_argument("file")
+    p_import.add_argument("--renumber", action='store_true',
+                          help="use new UIDs and GIDs where they conflict with existing ones")
+    p_import.add_argument("--skip-conflicts", action='store_true',
+                          help="import the rest of the users, instead of none, if some have conflicts")
+    p_import.add_argument("--dry-run", action='store_true')
+    p_import.set_defaults(func=CLI.import_csv, changes_accounts=True)
+
+    p_export = subparsers.add_parser("export", help="Export users to a CSV file.")
+    p_export.add_argument("file")
+    p_export.add_argument("users", nargs="*", help="default: all the non system users")
+    p_export.add_argument("-g", "--group", action='append',
+                          help="only export the members of this group")
+    p_export.add_argument("-a", "--all", action='store_true',
+                          help="include the system users")
+    p_export.set_defaults(func=CLI.export_csv)
+
+    p_delete = subparsers.add_parser("delete", help="Delete users.")
+    p_delete.add_argument("users", nargs="+")
+    p_delete.add_argument("-r", "--remove-home", action='store_true',
+                          help="also remove the home directories")
+    p_delete.set_defaults(func=CLI.delete, changes_accounts=True)
+
+    p_members = subparsers.add_parser("members", help="Add users to a group or remove them from it.")
+    p_members.add_argument("action", choices=['add', 'remove'])
+    p_members.add_argument("group")
+    p_members.add_argument("users", nargs="+")
+    p_members.set_defaults(func=CLI.members, changes_accounts=True)
+
+    parser.set_defaults(changes_accounts=False, dry_run=False)
+    args = parser.parse_args(argv)
+    if not 'func' in args:
+        parser.error("a command has to be specified")
+    cli = CLI(args.backend)
+    result = args.func(cli, args)
+    # Keep the accounts cache up to date for the next run, but don't write
+    # to the system for dry runs and exports
+    if args.changes_accounts and not args.dry_run:
+        cli.system.save_cache()
+    return result
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,11 +7,13 @@
 # Licensed under GNU General Public License 3.0 or later.
 # Some rights reserved. See COPYING, AUTHORS.
 
+import concurrent.futures
 import os
 import shlex
 import stat
 import sys
-import subprocess
+import time
+import common
 import libuser
 import version
 import paths
@@ -22,6 +24,24 @@ import argparse
 # Unrelated, we might also want a "restrict_dirs" function that
 # chrgrp's the user dirs to "teachers".
 
+# How many bindfs mounts or unmounts run at the same time
+MAX_PARALLEL_MOUNTS = 8
+
+
+class MountAction():
+    """A planned mount, remount or unmount of a group folder, and its
+    result after SharedFolders.execute()."""
+    def __init__(self, action, group, point):
+        self.action=action
+        self.group=group
+        self.point=point
+        self.seconds=None
+        self.error=None
+
+    def __str__(self):
+        result="failed: %s" % self.error.strip() if self.error else "%.2fs" % self.seconds
+        return "%s %s: %s" % (self.action, self.group, result)
+
 class SharedFolders():
     def __init__(self, system=None):
         """Initialization."""
@@ -32,11 +52,13 @@ class SharedFolders():
         self.load_config()
 
     def add(self, groups):
-        """Add the specified groups to share_groups, and mount them."""
+        """Add the specified groups to share_groups, and mount them, all
+        in one plan."""
         groups=self.valid(groups)
         self.system.share_groups=list(set(self.system.share_groups + groups))
-        self.mount(groups)
+        results=self.mount(groups)
         self.save_config()
+        return results
 
     def ensure_dir(self, dir, mode, uid=-1, gid=-1):
         """Ensures that dir exists with the specified mode, uid and gid."""
@@ -85,51 +107,111 @@ class SharedFolders():
         self.system.share_groups=self.config["SHARE_GROUPS"].split(" ")
 
     def mount(self, groups=None):
-        """Mount or remount the folders for the specified groups."""
+        """Mount or remount the folders for the specified groups, in
+        parallel, and return the executed MountActions."""
         groups=self.valid(groups)
-        # Remove from groups the ones that don't need to be (re)mounted.
-        # Unmount the ones that need remounting, without removing them.
-        for mount in self.parse_mounts():
-            group=mount["group"]
-            if group not in groups:
-                continue
-            if self.system.groups[group].gid == mount["gid"]:
-                groups.remove(group)
-            else:
-                self.unmount(group)
-        # Then mount what's left.
-        # This might actually be the first time to mount anything,
-        # so ensure that all the dirs/symlinks are there.
+        plan=self.plan(mount=groups)
+        if plan:
+            # This might actually be the first time to mount anything,
+            # so ensure that the parent dirs are there.
+            adm_uid=int(self.config["ADM_UID"])
+            self.ensure_dir(self.config["SHARE_DIR"], 0o711,
+                adm_uid, int(self.config["ADM_GID"]))
+            self.ensure_dir(self.config["SHARE_DIR/"] + ".symlinks", 0o731,
+                adm_uid, self.system.groups[self.config["TEACHERS"]].gid)
+        return self.execute(plan)
+
+    def plan(self, mount=(), unmount=()):
+        """Compare the wanted state of the groups with /proc/mounts, and
+        return the MountActions that are needed to reach it.
+        Groups in mount that are mounted with the right GID are skipped."""
+        mounted={m["group"]: m for m in self.parse_mounts()}
+        plan=[]
+        for group in sorted(mount):
+            point=self.config["SHARE_DIR/"] + group
+            if group not in mounted:
+                plan.append(MountAction("mount", group, point))
+            elif self.system.groups[group].gid != mounted[group]["gid"]:
+                plan.append(MountAction("remount", group, point))
+        for group in sorted(unmount):
+            if group in mounted:
+                plan.append(MountAction("unmount", group, mounted[group]["point"]))
+        return plan
+
+    def execute(self, plan):
+        """Run the MountActions of plan with a bounded pool of workers, as
+        each bindfs mount waits for FUSE, and return them."""
+        if not plan:
+            return plan
+        workers=min(MAX_PARALLEL_MOUNTS, len(plan))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(self.run_action, plan))
+        return plan
+
+    def run_action(self, action):
+        start=time.perf_counter()
+        error=None
+        if action.action in ("unmount", "remount"):
+            error=self.unmount_point(action.point)
+        if action.action in ("mount", "remount") and error is None:
+            error=self.mount_point(action.group, action.point)
+        action.error=error
+        action.seconds=time.perf_counter() - start
+        return action
+
+    def mount_point(self, group, dir):
+        """Mount the folder of group with bindfs, and return None, or the
+        error message if it failed."""
         adm_uid=int(self.config["ADM_UID"])
-        self.ensure_dir(self.config["SHARE_DIR"], 0o711,
-            adm_uid, int(self.config["ADM_GID"]))
-        self.ensure_dir(self.config["SHARE_DIR/"] + ".symlinks", 0o731,
-            adm_uid, self.system.groups[self.config["TEACHERS"]].gid)
-        for group in groups:
-            dir=self.config["SHARE_DIR/"] + group
-            group_gid=self.system.groups[group].gid
+        group_gid=self.system.groups[group].gid
+        try:
             self.ensure_dir(dir, 0o770, adm_uid, group_gid)
-            subprocess.call(["bindfs",
-                "-u", str(adm_uid),
-                "--create-for-user=%s" % adm_uid,
-                "-g", str(group_gid),
-                "--create-for-group=%s" % group_gid,
-                "-p", "770,af-x", "--chown-deny", "--chgrp-deny",
-                "--chmod-deny", dir, dir])
+        except OSError as e:
+            return str(e)
+        success, output=common.run_command(["bindfs",
+            "-u", adm_uid,
+            "--create-for-user=%s" % adm_uid,
+            "-g", group_gid,
+            "--create-for-group=%s" % group_gid,
+            "-p", "770,af-x", "--chown-deny", "--chgrp-deny",
+            "--chmod-deny", dir, dir])
+        return None if success else output
+
+    def unmount_point(self, point):
+        if common.run_command(["umount", point])[0]:
+            return None
+        sys.stderr.write("Cannot unmount %s, forcing unmount...\n" % point)
+        success, output=common.run_command(["umount", "-l", point])
+        return None if success else output
+
+    def summary(self, results):
+        """Return a one line summary of the executed MountActions."""
+        counts={}
+        for action in results:
+            key="failed" if action.error else action.action
+            counts[key]=counts.get(key, 0) + 1
+        if not counts:
+            return "Nothing to do."
+        # The actions run in parallel, so the slowest one is the wall time
+        return "%s, the slowest in %.2fs." % (", ".join(
+            "%s %d" % (key, counts[key]) for key in sorted(counts)),
+            max(action.seconds for action in results))
 
     def rename(self, old_group, new_group):
-        """Rename folder src to group dst.
+        """Rename the folder of old_group to new_group.
            Call groupmod to rename the group before calling this function."""
-        if dst not in self.system.groups:
-            sys.stderr.write("%s is not a valid group.\n" % dst)
+        if new_group not in self.system.groups:
+            sys.stderr.write("%s is not a valid group.\n" % new_group)
             return
-        mounted=self.unmount(src)
-        # TODO: check if dst exists etc
-        os.rename(src, dst)
+        mounted=self.unmount([old_group])
+        # TODO: check if new_group exists etc
+        old_dir=self.config["SHARE_DIR/"] + old_group
+        if os.path.isdir(old_dir):
+            os.rename(old_dir, self.config["SHARE_DIR/"] + new_group)
         self.system.share_groups=list(
-            (set(self.system.share_groups) - set([src])) | set([dst]))
-        if mounted is not None:
-            self.mount(dst)
+            (set(self.system.share_groups) - set([old_group])) | set([new_group]))
+        if mounted:
+            self.mount([new_group])
         self.save_config()
 
     def parse_mounts(self):
@@ -174,18 +256,8 @@ SHARE_GROUPS="%s"
         """Return the folders that were actually unmounted."""
         if groups is None or groups == []:
             groups=self.system.share_groups
-        ret=[]
-        for mount in self.parse_mounts():
-            group=mount["group"]
-            if group not in groups:
-                continue
-            ret.append(group)
-            point=mount["point"]
-            if subprocess.call(["umount", point]) == 0:
-                continue
-            sys.stderr.write("Cannot unmount %s, forcing unmount..." % point)
-            subprocess.call(["umount", "-l", point])
-        return ret
+        results=self.execute(self.plan(unmount=groups))
+        return [action.group for action in results if not action.error]
 
     def valid(self, groups=None):
         """Return which of the specified groups are defined in /etc/group."""
@@ -212,6 +284,7 @@ if __name__ == '__main__':
                         action='store_true')
     subparsers = parser.add_subparsers(dest='cmd')
 
+    parent_parser.add_argument("-t", "--timing", action='store_true', help="show the time of each mount")
     p_add=subparsers.add_parser("add", help="Create folders for the specified groups, if they don't already exist, and mount them using bindfs.", parents=[parent_parser])
     p_add.set_defaults(func=sf.add)
     p_list_shared=subparsers.add_parser("list-shared", help="List which of the specified groups have mounted folders.", parents=[parent_parser])
@@ -237,5 +310,14 @@ if __name__ == '__main__':
     if not 'func' in args:
         print("Error: A command has to be specified.\n")
         parser.print_help()
+    elif args.cmd == "rename":
+        args.func(args.old_group[0], args.new_group[0])
     else:
-        args.func(vars(args))
+        result=args.func(args.groups)
+        if args.cmd in ("list-shared", "list-mounted"):
+            print("\n".join(sorted(result)))
+        elif args.cmd in ("add", "mount"):
+            for action in result:
+                if args.timing or action.error:
+                    print(action)
+            print(sf.summary(result))
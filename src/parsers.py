@@ -8,6 +8,7 @@
 import csv
 import libuser
 import os
+import sys
 import configparser
 from io import StringIO, BytesIO
 
@@ -18,20 +19,39 @@ FIELDS_MAP = {'Username': 'name', 'UID': 'uid', 'GID': 'gid', 'Primary group' :
 class CSV:
     def __init__(self):
         self.fields_map = FIELDS_MAP
+        # The usernames of the skipped repeated rows
+        self.duplicates = []
     
     def parse(self, fname):
+        """Parse the whole CSV file and return a libuser.Set with its users."""
+        new_set = libuser.Set()
+        for users in self.iter_parse(fname, new_set):
+            pass
+        # If plainpw is set, override and update password
+        users = [u for u in new_set.users.values() if u.plainpw]
+        passwords = libuser.get_system().encrypt_many(u.plainpw for u in users)
+        for user, password in zip(users, passwords):
+            user.password = password
+        return new_set
+
+    def iter_parse(self, fname, new_set, chunk_size=500):
+        """Parse the CSV file incrementally, adding its users and groups to
+        new_set and yielding the new users in lists of up to chunk_size.
+        Rows without a username are skipped, and so are the rows of users
+        that were already added, as their first rows were already yielded;
+        their names are appended to self.duplicates. The passwords aren't
+        encrypted here, User.plainpw is left for the caller to encrypt."""
         # Open the CSV as dictionary
         with open(fname) as f:
             users_dict = csv.DictReader(f)
-            users = {}
-            groups = {}
+            users = []
             for user_d in users_dict:
 
                 # convert the user dictionary to a user object.
                 user = libuser.User()
                 for key, value in user_d.items():
                     try:
-                        user.__dict__[self.fields_map[key]] = value # FIXME: Here we lose the datatype
+                        setattr(user, self.fields_map[key], value) # FIXME: Here we lose the datatype
                     except:
                         pass
 
@@ -39,42 +59,50 @@ class CSV:
                 int_attributes = ['lstchg', 'gid', 'uid', 'expire', 'max', 'warn', 'min', 'inact']
                 for attr in int_attributes:
                     try:
-                        user.__dict__[attr] = int(user.__dict__[attr])
-                    except ValueError:
-                        user.__dict__[attr] = None
-
-                # If plainpw is set, override and update password
-                if user.plainpw:
-                    user.password = libuser.get_system().encrypt(user.plainpw)
+                        setattr(user, attr, int(getattr(user, attr)))
+                    except (TypeError, ValueError):
+                        setattr(user, attr, None)
+
+                if not user.name:
+                    continue
+                if user.name in new_set.users:
+                    sys.stderr.write("Skipping the repeated user %s in %s\n"
+                                     % (user.name, fname))
+                    self.duplicates.append(user.name)
+                    continue
 
                 # Convert groups string to groups object
-                if user.name:
-                    users[user.name] = user
-                    user_groups_string = user.groups
-                    user.groups = []
-                    for g in user_groups_string.split(','):
-                        pair = g.split(':')
-                        if len(pair) == 2:
-                            gname, gid = pair
-                            try:
-                                gid = int(gid)
-                            except ValueError:
-                                gid = None
-                        else: # There is no GID specified for this group
-                            gname = g
+                user_groups_string = user.groups if isinstance(user.groups, str) else ''
+                user.groups = []
+                new_set.users[user.name] = user
+                new_set.index_user(user)
+                for g in user_groups_string.split(','):
+                    pair = g.split(':')
+                    if len(pair) == 2:
+                        gname, gid = pair
+                        try:
+                            gid = int(gid)
+                        except ValueError:
                             gid = None
-                        if gname != '':
-                            user.groups.append(gname)
-                        
-                        # Create Group instances from memberships
-                        if gname not in groups:
-                            groups[gname] = libuser.Group(gname, gid)
-                        groups[gname].members[user.name] = user
-
-                    if user.groups == '':
-                        user.groups = None
-        
-        return libuser.Set(users, groups)
+                    else: # There is no GID specified for this group
+                        gname = g
+                        gid = None
+                    if gname == '':
+                        continue
+                    user.groups.append(gname)
+
+                    # Create Group instances from memberships
+                    if gname not in new_set.groups:
+                        new_set.groups[gname] = libuser.Group(gname, gid)
+                        new_set.index_group(new_set.groups[gname])
+                    new_set.add_member(new_set.groups[gname], user)
+
+                users.append(user)
+                if len(users) >= chunk_size:
+                    yield users
+                    users = []
+            if users:
+                yield users
             
 
     def write(self, fname, system, users):
@@ -82,7 +110,7 @@ class CSV:
         writer = csv.DictWriter(f, fieldnames=libuser.CSV_USER_FIELDS)
         writer.writerow(dict((n,n) for n in libuser.CSV_USER_FIELDS))
         for user in users:
-            u_dict = dict( (key, user.__dict__[o_key] if user.__dict__[o_key] is not None else '') for key, o_key in self.fields_map.items())
+            u_dict = dict( (key, getattr(user, o_key) if getattr(user, o_key) is not None else '') for key, o_key in self.fields_map.items())
             u_dict['Password'] = '' # We don't have the plain password
             u_dict['Groups'] = list(u_dict['Groups'])
             # Convert the groups value to a proper gname:gid pairs formatted string
@@ -133,7 +161,7 @@ class passwd():
                     nums = ['lstchg', 'min', 'max', 'warn', 'inact', 'expire']
                     for i, att in enumerate(nums, 2):
                         try:
-                            u.__dict__[att] = int(row[i])
+                            setattr(u, att, int(row[i]))
                         except:
                             pass
         
@@ -7,4 +7,6 @@ pkgdatadir = "@pkgdatadir@/"
 bindir = "@bindir@/"
 sbindir = "@sbindir@/"
 scriptsdir = "@scriptsdir@/"
-sysconfdir = "@sysconfdir@/"
\ No newline at end of file
+sysconfdir = "@sysconfdir@/"
+cachedir = "@cachedir@/"
+statedir = "@statedir@/"
\ No newline at end of file
@@ -0,0 +1,114 @@
+# This File is part of the ltsp-manager.
+#
+# Copyright 2012-2018 by it's authors.
+#
+# Licensed under GNU General Public License 3.0 or later.
+# Some rights reserved. See COPYING, AUTHORS.
+
+"""
+A prefix index of the users, for the search bar of the main window.
+"""
+import bisect
+import re
+import unicodedata
+
+import iso843
+import libuser
+
+# Real names, paths etc are split to words on anything but letters and digits
+_WORD_SPLIT = re.compile(r'[\W_]+')
+
+
+def is_ascii(text):
+    # str.isascii() needs Python 3.7
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def normalize(text):
+    """Lowercase text and remove its accents, so that e.g. "Γιώργος"
+    is found when searching for "γιωργ"."""
+    if is_ascii(text):
+        return text.lower()
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def user_words(user):
+    """Return the set of the normalized words that find user: its name,
+    the words of its real name, also in Latin, and of its home directory."""
+    words = {normalize(user.name)}
+    texts = [user.rname or '', user.directory or '']
+    # The transcription is slow, and only changes Greek names
+    if user.rname and not is_ascii(user.rname):
+        texts.append(iso843.transcript(user.rname, False))
+    for text in texts:
+        words.update(w for w in _WORD_SPLIT.split(normalize(text)) if w)
+    return words
+
+
+class SearchIndex:
+    """A sorted list of (word, username) pairs, where bisect finds the users
+    with words that start with a prefix in O(log n + matches).
+
+    It's updated incrementally with the libuser.Change lists of the System.
+    """
+    def __init__(self):
+        self.entries = []
+        # The words of each username, to remove its entries
+        self.words = {}
+
+    def fill(self, users):
+        self.words = {user.name: user_words(user) for user in users}
+        self.entries = sorted((word, name) for name, words in self.words.items()
+                              for word in words)
+
+    def add(self, user):
+        self.remove(user.name)
+        words = user_words(user)
+        self.words[user.name] = words
+        for word in words:
+            bisect.insort(self.entries, (word, user.name))
+
+    def remove(self, name):
+        for word in self.words.pop(name, ()):
+            i = bisect.bisect_left(self.entries, (word, name))
+            if i < len(self.entries) and self.entries[i] == (word, name):
+                del self.entries[i]
+
+    def apply(self, changes):
+        """Apply the user changes of a libuser.Change list."""
+        for change in changes:
+            if change.kind != 'user':
+                continue
+            if change.action == libuser.Change.REMOVED:
+                self.remove(change.name)
+            else:
+                self.add(change.obj)
+
+    def find_prefix(self, prefix):
+        """Return the set of the usernames with a word starting with prefix."""
+        names = set()
+        i = bisect.bisect_left(self.entries, (prefix,))
+        while i < len(self.entries) and self.entries[i][0].startswith(prefix):
+            names.add(self.entries[i][1])
+            i += 1
+        return names
+
+    def search(self, text):
+        """Return the set of the usernames that have words starting with
+        all the words of text."""
+        prefixes = [w for w in _WORD_SPLIT.split(normalize(text)) if w]
+        if not prefixes:
+            return set(self.words)
+        # Start from the longest prefix, which usually has the fewest matches
+        prefixes.sort(key=len, reverse=True)
+        names = self.find_prefix(prefixes[0])
+        for prefix in prefixes[1:]:
+            if not names:
+                break
+            names &= self.find_prefix(prefix)
+        return names
@@ -12,6 +12,7 @@ Client side signup logic and form.
 """
 
 import crypt
+import errno
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, Gio
@@ -20,51 +21,150 @@ import random
 import re
 import socket
 import sys
+import time
 
 import common
 import iso843
 import paths
 
+# The preferred signup protocol version, see signup_daemon
+PROTOCOL_VERSION = 2
+# How long to remember if a username exists, in seconds
+EXISTS_CACHE_TIME = 30
+
 class Connection:
     def __init__(self, host, port):
-        # Create a new socket and connect to the server
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((host, port))
-        
-        # 'Identify' to the server
-        host = socket.gethostname()
-        self._send('ID %s' % host)
-        
+        self.host = host
+        self.port = port
+        self.version = 1
+        self.next_id = 0
+        self.roles = None
+        self.groups = None
         self.p_reg = None
         self.u_reg = None
         self.n_reg = None
-    
-    # TODO: Review the recv call, there should be a better way
+        # The user_exists() replies, {username: (time, exists)}
+        self.exists = {}
+
+        self.connect()
+
+    def connect(self):
+        """Connect and 'identify' to the server. Version 1 servers close the
+        connection on HELLO, then reconnect and use ID."""
+        host = socket.gethostname()
+        self.open_socket()
+        try:
+            self.version = 1
+            self.hello(self._query(['HELLO %d %s' % (PROTOCOL_VERSION, host)], False)[0])
+        except ConnectionError:
+            self.sock.close()
+            self.open_socket()
+            self._query(['ID %s' % host], False)
+
+    def open_socket(self):
+        self.sock = socket.create_connection((self.host, self.port))
+        # Read the replies line by line, however they were received
+        self.reader = self.sock.makefile('rb')
+
+    def hello(self, reply):
+        """Parse the HELLO reply, which contains all the form settings."""
+        fields = reply.split('\t')
+        self.version = int(fields[0].split()[1])
+        roles, groups, self.n_reg, self.u_reg, self.p_reg = fields[1:6]
+        self.roles = roles.split(',') if roles else []
+        self.groups = groups.split(',') if groups else []
+
+    def _readline(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\n'):
+            raise ConnectionError(errno.ECONNRESET,
+                                  "The signup server closed the connection")
+        return line.rstrip(b'\r\n').decode("utf-8")
+
     # TODO: Show exceptions in a graphical message
+    def _query(self, commands, reconnect=True):
+        """Send all the commands at once, and return their replies.
+        If the server closed the connection, e.g. after a long idle time,
+        reconnect and send them again, unless reconnect is False, as only
+        the idempotent commands can be sent again."""
+        try:
+            return self._send_commands(commands)
+        except ConnectionError:
+            if not reconnect:
+                raise
+        self.close()
+        self.connect()
+        return self._send_commands(commands)
+
+    def _send_commands(self, commands):
+        ids = []
+        lines = []
+        for command in commands:
+            if self.version >= 2:
+                self.next_id += 1
+                ids.append(str(self.next_id))
+                command = '%d %s' % (self.next_id, command)
+            lines.append(command + '\r\n')
+        self.sock.sendall(''.join(lines).encode("utf-8"))
+        if self.version < 2:
+            # Version 1 servers reply in order
+            return [self._readline() for line in lines]
+        replies = {}
+        while len(replies) < len(ids):
+            reply_id, sep, reply = self._readline().partition(' ')
+            replies[reply_id] = reply
+        return [replies.get(i, '') for i in ids]
+
     def _send(self, data):
-        if not data.endswith('\r\n'):
-            data += '\r\n'
-        self.sock.send(data.encode("utf-8"))
-        return self.sock.recv(4096).strip().decode("utf-8")
-    
+        return self._query([data.rstrip('\r\n')])[0]
+
     def close(self):
-        self._send("BYE")
+        # The server doesn't reply to BYE, it just closes the connection
+        try:
+            self.sock.sendall(b"BYE\r\n" if self.version < 2 else
+                              ("%d BYE\r\n" % (self.next_id + 1)).encode("utf-8"))
+        except OSError:
+            pass
+        self.reader.close()
         self.sock.close()
-    
+
     def get_groups(self):
-        groups = self._send("GET_GROUPS")
-        if groups != '':
-            return groups.split(',')
-        return []
-    
+        if self.groups is None:
+            groups = self._send("GET_GROUPS")
+            self.groups = groups.split(',') if groups != '' else []
+        return list(self.groups)
+
     def get_roles(self):
-        roles = self._send("GET_ROLES")
-        if roles != '':
-            return roles.split(',')
-        return []
-    
+        if self.roles is None:
+            roles = self._send("GET_ROLES")
+            self.roles = roles.split(',') if roles != '' else []
+        return list(self.roles)
+
     def user_exists(self, username):
-        return self._send("USER_EXISTS %s" % username) == "YES"
+        return self.users_exist([username])[0]
+
+    def users_exist(self, usernames):
+        """Return if each of the usernames exists, or is requested, asking
+        the server about all the ones that aren't cached at once."""
+        now = time.monotonic()
+        ask = []
+        for name in usernames:
+            cached = self.exists.get(name)
+            if (cached is None or now - cached[0] > EXISTS_CACHE_TIME) \
+                    and name not in ask:
+                # Names with separators are invalid, they can't exist
+                if not name or ',' in name or name.split() != [name]:
+                    self.exists[name] = (now, False)
+                else:
+                    ask.append(name)
+        if ask:
+            if self.version >= 2:
+                replies = self._send("USERS_EXIST %s" % ','.join(ask)).split(',')
+            else:
+                replies = self._query(["USER_EXISTS %s" % name for name in ask])
+            for name, reply in zip(ask, replies):
+                self.exists[name] = (now, reply == "YES")
+        return [self.exists[name][1] for name in usernames]
     
     def realname_regex(self):
         if self.n_reg is None:
@@ -84,7 +184,14 @@ class Connection:
     def send_data(self, realname, username='', password='', role='', groups=''):
         groups = ','.join(groups)
         data = '\t'.join([realname, username, password, role, groups])
-        return self._send("SEND_DATA %s" % data) == "YES"
+        # The server may have stored the request before the connection was
+        # lost, so it's not sent again; but first check that the connection
+        # is still alive, with a query that's safe to send again
+        self._send("PASS_REGEX")
+        try:
+            return self._query(["SEND_DATA %s" % data], False)[0] == "YES"
+        except ConnectionError:
+            return False
 
 
 class UserForm(object):
@@ -185,7 +292,8 @@ class UserForm(object):
         sug = self.get_suggestions(name)
         print(sug)
         print(self.connection.username_regex())
-        sug = [s for s in sug if re.match(self.connection.username_regex(), s) and not self.connection.user_exists(s)]
+        sug = [s for s in sug if re.match(self.connection.username_regex(), s)]
+        sug = [s for s, exists in zip(sug, self.connection.users_exist(sug)) if not exists]
         if sug:
             self.username_entry.set_text(sug[0])
             for s in sug:
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+# This File is part of the ltsp-manager.
+#
+# Copyright 2012-2018 by it's authors.
+#
+# Licensed under GNU General Public License 3.0 or later.
+# Some rights reserved. See COPYING, AUTHORS.
+"""
+Receive and store the signup requests of the clients, without a window.
+They're reviewed later in the signup server window. This is the signup server
+core, that doesn't use GTK, so it can also run headless, as a daemon.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+from time import localtime, mktime, monotonic, strftime
+
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+from twisted.protocols.policies import TimeoutMixin
+
+import common
+import config
+import libuser
+import paths
+import version
+
+# The TCP port of the signup protocol
+PORT = 790
+# Version 1 clients start with "ID <hostname>" and send one command per reply.
+# Version 2 clients start with "HELLO 2 <hostname>", which replies with all
+# the form settings, and prefix their commands with request ids, which are
+# also prefixed to the replies, so they may send many commands at once.
+PROTOCOL_VERSION = 2
+# The regular expressions of the form fields
+REALNAME_REGEX = ".+"
+PASS_REGEX = ".+"
+# The pending requests database, which contains password hashes
+STORE_FILE = "signup.sqlite"
+
+# The limits that keep the server responsive when clients misbehave.
+# Each client may send RATE_LIMIT commands per second, or RATE_BURST at once;
+# faster clients aren't read from until they're within the limit again.
+# The thin clients all connect from the server IP, so the clients are told
+# apart by their IP and the hostname they identify with.
+RATE_LIMIT = 20
+RATE_BURST = 60
+# The longest command, a SEND_DATA with long names and many groups
+MAX_LINE_LENGTH = 4096
+MAX_CONNECTIONS = 200
+# Seconds without commands before a connection is closed; the client
+# reconnects if the student continues typing later
+IDLE_TIMEOUT = 600
+# New requests are refused while this many are pending
+MAX_PENDING_REQUESTS = 1000
+# Seconds before USER_EXISTS rereads the requested usernames from the store,
+# as a signup server window of another process may have removed requests
+USERNAMES_TTL = 5
+
+
+class TokenBucket:
+    """Allow rate events per second on average, and up to burst at once."""
+    def __init__(self, rate, burst, clock=monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.time = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    def take(self):
+        """Take a token, and return the seconds to wait until the bucket
+        isn't in debt, 0 if it has tokens left."""
+        self.refill()
+        self.tokens -= 1
+        return max(0, -self.tokens / self.rate)
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+
+class Registrations(LineReceiver, TimeoutMixin):
+    MAX_LENGTH = MAX_LINE_LENGTH
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.system = factory.system
+        self.groups = factory.groups
+        self.roles = factory.roles
+        self.state = 'identify'
+        self.ip = None
+        self.port = None
+        self.id_hostname = None
+        self.version = 1
+        # The id of the version 2 request that's being answered
+        self.request_id = None
+
+    def send(self, line):
+        if self.request_id is not None:
+            line = '%s %s' % (self.request_id, line)
+        self.sendLine(line.encode("utf-8"))
+
+    def connectionMade(self):
+        self.ip = self.transport.getPeer().host
+        self.port = self.transport.getPeer().port
+        if len(self.factory.connections) >= MAX_CONNECTIONS:
+            print("Too many connections, refusing %s:%s" % (self.ip, self.port))
+            self.factory.dropped += 1
+            self.transport.loseConnection()
+            return
+        self.factory.connections.add(self)
+        self.setTimeout(IDLE_TIMEOUT)
+        print("New connection from %s:%s" % (self.ip, self.port))
+
+    def connectionLost(self, reason):
+        print("Connection with %s:%s was closed." % (self.ip, self.port))
+        self.setTimeout(None)
+        self.factory.connections.discard(self)
+
+    def dataReceived(self, data):
+        self.resetTimeout()
+        LineReceiver.dataReceived(self, data)
+
+    def lineLengthExceeded(self, line):
+        print("Too long line from %s:%s. Closing connection" % (self.ip, self.port))
+        self.factory.dropped += 1
+        self.transport.loseConnection()
+
+    def timeoutConnection(self):
+        print("Connection with %s:%s timed out." % (self.ip, self.port))
+        self.transport.loseConnection()
+
+    def throttle(self):
+        """Stop reading from a client that sends commands too fast, until
+        it's within the rate limit."""
+        wait = self.factory.take_token((self.ip, self.id_hostname))
+        if wait > 0:
+            from twisted.internet import reactor
+            self.factory.throttled += 1
+            self.pauseProducing()
+            reactor.callLater(wait, self.resume)
+
+    def resume(self):
+        if self in self.factory.connections:
+            self.resumeProducing()
+
+    def booltr(self, b):
+        if b:
+            return "YES"
+        return "NO"
+
+    def lineReceived(self, line):
+        #print line # DEBUGGING
+        self.throttle()
+        line = line.decode('utf-8')
+        if self.version >= 2:
+            self.request_id, sep, line = line.partition(' ')
+        cmd = line.split(None, 1)
+        if len(cmd) > 1:
+            cmd, data = cmd
+        elif cmd:
+            cmd = cmd[0]
+            data = None
+        else:
+            cmd = data = None
+
+        if self.state == 'identify':
+            if cmd == 'ID':
+                self.identify(data)
+            elif cmd == 'HELLO':
+                self.hello(data)
+            else:
+                print("Error: Expected ID command from %s:%s but instead got %s. Closing connection" % (self.ip, self.port, cmd))
+                self.transport.loseConnection()
+            return
+
+        if line == 'BYE':
+            print("%s:%s sent BYE." % (self.ip, self.port))
+            self.transport.loseConnection()
+        elif cmd == "USER_EXISTS":
+            self.send(self.booltr(self.factory.user_exists(data)))
+        elif cmd == "USERS_EXIST" and self.version >= 2:
+            names = data.split(',') if data else []
+            self.send(','.join(self.booltr(self.factory.user_exists(name))
+                               for name in names))
+        elif cmd == "REALNAME_REGEX":
+            self.send(REALNAME_REGEX)
+        elif cmd == "USER_REGEX":
+            self.send(libuser.NAME_REGEX)
+        elif cmd == "PASS_REGEX":
+            self.send(PASS_REGEX)
+        elif cmd == "GET_ROLES":
+            self.send(','.join(self.roles))
+        elif cmd == "GET_GROUPS":
+            self.send(','.join(self.groups))
+        elif cmd == "SEND_DATA":
+            try:
+                data = data.split('\t')
+                realname = data[0]
+                username = data[1]
+                password = data[2]
+                role = None
+                if self.roles:
+                    role = data[3]
+                groups = []
+                if self.groups:
+                    groups = data[4].split(',') if data[4] else []
+
+                if self.factory.is_full():
+                    print("Too many pending requests, refusing %s from %s:%s"
+                          % (username, self.ip, self.port))
+                    self.factory.dropped += 1
+                    self.send("NO")
+                    return
+
+                # Create a new request
+                applicant = Applicant(self.ip, self.id_hostname)
+                user = libuser.User(username, rname=realname, password=password, groups=groups)
+                #print user # DEBUGGING
+                req = Request(localtime(), applicant, user, role)
+                self.factory.add_request(req)
+                self.send("YES")
+            except Exception as e:
+                print(e)
+                self.send("NO")
+                print("Error receiving data.")
+        else:
+            print("Received invalid command %s from %s:%s" % (cmd, self.ip, self.port))
+            if self.version >= 2:
+                self.send("ERROR")
+
+    def identify(self, line):
+        self.id_hostname = line
+        self.state = 'listen'
+        self.send("YES")
+
+    def hello(self, data):
+        """Identify a version 2 client, with "HELLO <version> <hostname>".
+        Reply with the agreed version and the form settings, tab separated."""
+        try:
+            version, hostname = data.split(None, 1)
+            version = min(int(version), PROTOCOL_VERSION)
+        except (AttributeError, ValueError):
+            print("Error: Invalid HELLO from %s:%s. Closing connection" % (self.ip, self.port))
+            self.transport.loseConnection()
+            return
+        self.id_hostname = hostname
+        self.state = 'listen'
+        self.send('\t'.join(["HELLO %d" % version, ','.join(self.roles),
+                             ','.join(self.groups), REALNAME_REGEX,
+                             libuser.NAME_REGEX, PASS_REGEX]))
+        self.version = version
+
+
+class RegistrationsFactory(Factory):
+    """Accept the signup clients, and save their requests in store.
+    Functions in self.listeners are called with each new request, e.g. to
+    show it in the signup server window."""
+    def __init__(self, system, store, groups, roles):
+        self.connections = set()
+        self.system = system
+        self.store = store
+        self.groups = groups
+        self.roles = roles
+        self.listeners = []
+        # The TokenBucket of each (IP, hostname) client, for the rate limit
+        self.buckets = {}
+        # The refused connections and requests, and the throttled commands
+        self.dropped = 0
+        self.throttled = 0
+        self.usernames = set()
+        self.usernames_time = 0
+        self.refresh_usernames()
+        system.connect_event(self.on_libuser_changed)
+
+    def buildProtocol(self, addr):
+        return Registrations(self)
+
+    def refresh_usernames(self):
+        """Snapshot the existing and the requested usernames, so that
+        USER_EXISTS also rejects the names of the pending requests."""
+        self.usernames = set(self.system.users).union(self.store.usernames())
+        self.usernames_time = monotonic()
+
+    def on_libuser_changed(self, changes):
+        self.refresh_usernames()
+
+    def user_exists(self, name):
+        if monotonic() - self.usernames_time > USERNAMES_TTL:
+            self.refresh_usernames()
+        return name in self.usernames
+
+    def take_token(self, client):
+        """Return the seconds that client, an (IP, hostname) pair, has to
+        wait before its next command. The hostname is None until the client
+        identifies."""
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            if len(self.buckets) >= MAX_CONNECTIONS:
+                # Forget the clients that are within their limit
+                self.buckets = {c: b for c, b in self.buckets.items() if not b.is_full()}
+            bucket = self.buckets[client] = TokenBucket(RATE_LIMIT, RATE_BURST)
+        return bucket.take()
+
+    def is_full(self):
+        return self.store.count() >= MAX_PENDING_REQUESTS
+
+    def stats(self):
+        return "%d connections, %d dropped, %d throttled" % (
+            len(self.connections), self.dropped, self.throttled)
+
+    def add_request(self, request):
+        self.store.add(request)
+        self.usernames.add(request.user.name)
+        for listener in self.listeners:
+            listener(request)
+
+
+class Applicant(object):
+    def __init__(self, ip, hostname=None):
+        self.ip = ip
+        self.hostname = hostname
+
+    def __str__(self):
+        return '%s (%s)' % (self.hostname, self.ip)
+
+
+class Request(object):
+    def __init__(self, time=None, applicant=None, user=None, role=None, status='pending'):
+        self.time = localtime() if time is None else time
+        self.applicant = applicant
+        self.user = user
+        self.role = role
+        self.status = status
+        # The RequestStore row, once the request is stored
+        self.id = None
+
+
+class RequestStore:
+    """The pending signup requests, in an sqlite database, so that they
+    survive restarts, and can be shared by the daemon and the window.
+
+    Requests get an id when they're added, and only the fields that the
+    reviewer can change are updated later.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(paths.statedir, STORE_FILE)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Create it private, as it contains the password hashes
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self.db = sqlite3.connect(path)
+        # Durable commits without waiting for the journal on each one
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS requests (
+            id INTEGER PRIMARY KEY, time REAL, ip TEXT, hostname TEXT,
+            realname TEXT, username TEXT, password TEXT, role TEXT,
+            groups TEXT)""")
+        self.db.commit()
+
+    def add(self, request):
+        user = request.user
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO requests (time, ip, hostname, realname, username,"
+                " password, role, groups) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (mktime(request.time), request.applicant.ip,
+                 request.applicant.hostname, user.rname, user.name,
+                 user.password, request.role, ','.join(user.groups)))
+        request.id = cursor.lastrowid
+
+    def update(self, request, groups=None):
+        """Save the reviewed fields of request; groups defaults to the
+        user groups."""
+        user = request.user
+        if groups is None:
+            groups = user.groups
+        with self.db:
+            self.db.execute(
+                "UPDATE requests SET realname=?, username=?, role=?, groups=?"
+                " WHERE id=?", (user.rname, user.name, request.role,
+                                ','.join(groups), request.id))
+
+    def remove(self, requests):
+        with self.db:
+            self.db.executemany("DELETE FROM requests WHERE id=?",
+                                [(request.id,) for request in requests])
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM requests").fetchone()[0]
+
+    def usernames(self):
+        return [row[0] for row in self.db.execute("SELECT username FROM requests")]
+
+    def pending(self, after=0):
+        """Return the stored requests, or those with an id after after,
+        oldest first."""
+        requests = []
+        for row in self.db.execute(
+                "SELECT id, time, ip, hostname, realname, username, password,"
+                " role, groups FROM requests WHERE id > ? ORDER BY id", (after,)):
+            id, time, ip, hostname, realname, username, password, role, groups = row
+            user = libuser.User(username, rname=realname, password=password,
+                                groups=groups.split(',') if groups else [])
+            request = Request(localtime(time), Applicant(ip, hostname), user, role)
+            request.id = id
+            requests.append(request)
+        return requests
+
+    def close(self):
+        self.db.close()
+
+
+def listen(system, store, groups, roles, port=PORT):
+    """Start accepting signup requests, and return the factory."""
+    from twisted.internet import reactor
+    factory = RegistrationsFactory(system, store, groups, roles)
+    reactor.listenTCP(port, factory)
+    return factory
+
+
+def checked_options(option):
+    """Return the roles or groups that were checked in the signup server
+    settings dialog."""
+    return [value for value in config.get_config().parser.get('GUI', option).split(',')
+            if value]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("-v", "--version", action='version',
+                        version='%(prog)s ' + version.__version__)
+    parser.add_argument("-p", "--port", type=int, default=PORT,
+                        help="default: %(default)s")
+    parser.add_argument("-g", "--groups",
+                        help="the comma separated groups that the users may select, default: the groups of the last signup server session")
+    parser.add_argument("-r", "--roles",
+                        help="the comma separated roles that the users may select, default: the roles of the last signup server session")
+    parser.add_argument("-l", "--list", action='store_true',
+                        help="list the pending requests and exit")
+    args = parser.parse_args(argv)
+
+    store = RequestStore()
+    if args.list:
+        for request in store.pending():
+            print('\t'.join([strftime("%d/%m/%Y %T", request.time), str(request.applicant),
+                             request.user.rname, request.user.name, str(request.role),
+                             ','.join(request.user.groups)]))
+        return 0
+
+    from twisted.internet import reactor
+    from twisted.internet.error import CannotListenError
+    groups = args.groups.split(',') if args.groups is not None \
+        else checked_options('requests_checked_groups')
+    roles = args.roles.split(',') if args.roles is not None \
+        else checked_options('requests_checked_roles')
+    system = libuser.get_system()
+    groups = [group for group in groups if group in system.groups]
+    try:
+        factory = listen(system, store, groups, roles, args.port)
+    except CannotListenError as e:
+        sys.stderr.write(_("Error: %s\n") % e)
+        return 1
+    print(_("Starting Signup Server"))
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  lambda: print("Signup server: " + factory.stats()))
+    reactor.run()
+    store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
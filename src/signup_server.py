@@ -11,157 +11,77 @@ Signup server and form.
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gio
+from gi.repository import GLib, Gtk, Gio
 import os
 import time
-from twisted.internet.protocol import Factory
-from twisted.internet import gtk3reactor
-gtk3reactor.install()
-from twisted.internet import reactor
-from twisted.protocols.basic import LineReceiver
 
 import common
 import config
 import dialogs
+import libuser
+import signup_daemon
 import user_form
 import paths
 
-class Registrations(LineReceiver):
-    def __init__(self, connections, requests, gui, system, groups, roles):
-        self.connections = connections
-        self.requests = requests
-        self.gui = gui
-        self.system = system
-        self.groups = groups
-        self.roles = roles
-        self.state = 'identify'
-        self.ip = None
-        self.port = None
-        self.id_hostname = None
-    
-    def send(self, line):
-        self.sendLine(line.encode("utf-8"))
+# How often to look for the requests of a separate signup daemon, in seconds
+STORE_POLL_INTERVAL = 2
 
-    def connectionMade(self):
-        self.ip = self.transport.getPeer().host
-        self.port = self.transport.getPeer().port
-        self.connections.append(self)
-        print("New connection from %s:%s" % (self.ip, self.port))
-        
-    def connectionLost(self, reason):
-        print("Connection with %s:%s was closed." % (self.ip, self.port))
-        if self in self.connections:
-            del self.connections[self.connections.index(self)]
-    
-    def booltr(self, b):
-        if b:
-            return "YES"
-        return "NO"
-    
-    def lineReceived(self, line):
-        #print line # DEBUGGING
-        line = line.decode('utf-8')
-        cmd = line.split(None, 1)
-        if len(cmd) > 1:
-            cmd, data = cmd
-        else:
-            cmd = cmd[0]
-            data = None
-        
-        if self.state == 'identify':
-            if cmd == 'ID':
-                self.identify(data)
-            else:
-                print("Error: Expected ID command from %s:%s but instead got %s. Closing connection" % (self.ip, self.port, cmd))
-                self.transport.loseConnection()
-            return
-            
-        if line == 'BYE':
-            print("%s:%s sent BYE." % (self.ip, self.port))
-            self.transport.loseConnection()
-        elif cmd == "USER_EXISTS":
-            self.send(self.booltr(data in self.system.users))
-        elif cmd == "REALNAME_REGEX":
-            self.send(".+")
-        elif cmd == "USER_REGEX":
-            self.send(libuser.NAME_REGEX)
-        elif cmd == "PASS_REGEX":
-            self.send(".+")
-        elif cmd == "GET_ROLES":
-            self.send(','.join(self.roles))
-        elif cmd == "GET_GROUPS":
-            self.send(','.join(self.groups))
-        elif cmd == "SEND_DATA":
-            try:
-                data = data.split('\t')
-                realname = data[0]
-                username = data[1]
-                password = data[2]
-                role = None
-                if self.roles:
-                    role = data[3]
-                groups = []
-                if self.groups:
-                    groups = data[4].split(',') if data[4] else []
-                
-                # Create a new request
-                applicant = Applicant(self.ip, self.id_hostname)
-                user = libuser.User(username, rname=realname, password=password, groups=groups)
-                #print user # DEBUGGING
-                req = Request(time.localtime(), applicant, user, role)
-                self.gui.add_request(req)
-                
-                self.requests.append(req)
-                self.send("YES")
-            except Exception as e:
-                print(e)
-                self.send("NO")
-                print("Error receiving data.")
-        else:
-            print("Received invalid command %s from %s:%s" % (cmd, self.ip, self.port))
-            
-    def identify(self, line):
-        self.id_hostname = line
-        self.state = 'listen'
-        self.send("YES")
+class PendingRequests:
+    """The requests of the window by username, with their requests_list
+    iters and reserved IDs, so that they're found and removed without
+    scanning the list. ListStore iters stay valid until their rows are
+    removed."""
+    def __init__(self, liststore):
+        self.liststore = liststore
+        self.requests = {}
+        self.iters = {}
+        # The (uid, gid) that were allocated for each username
+        self.reserved = {}
 
+    def __len__(self):
+        return len(self.requests)
 
-class RegistrationsFactory(Factory):
-    def __init__(self, gui, groups, roles):
-        self.connections = []
-        self.requests = []
-        self.gui = gui
-        self.groups = groups
-        self.roles = roles
+    def get(self, name):
+        return self.requests.get(name)
 
-    def buildProtocol(self, addr):
-        return Registrations(self.connections, self.requests, self.gui, self.gui.system, self.groups, self.roles)
+    def values(self):
+        return list(self.requests.values())
 
+    def add(self, request, treeiter, reserved):
+        name = request.user.name
+        self.requests[name] = request
+        self.iters[name] = treeiter
+        self.reserved[name] = reserved
 
-class Applicant(object):
-    def __init__(self, ip, hostname=None):
-        self.ip = ip
-        self.hostname = hostname
-        
-    def __str__(self):
-        return '%s (%s)' % (self.hostname, self.ip)
-
-
-class Request(object):
-    def __init__(self, time=None, applicant=None, user=None, role=None, status='pending'):
-        if time is None:
-            time.localtime()
+    def rename(self, request):
+        """Index request by its username again, after a review."""
+        for name, other in self.requests.items():
+            if other is request:
+                break
         else:
-            self.time = time
-        self.applicant = applicant
-        self.user = user
-        self.role = role
-        self.status = status
+            return
+        if name != request.user.name:
+            self.add(request, self.iters.pop(name), self.reserved.pop(name))
+            del self.requests[name]
+
+    def remove(self, requests):
+        """Remove requests and their rows, and return their reserved IDs."""
+        reserved = []
+        for request in requests:
+            name = request.user.name
+            del self.requests[name]
+            self.liststore.remove(self.iters.pop(name))
+            reserved.append(self.reserved.pop(name))
+        return reserved
 
 
 class SignupServerWindow:
-    def __init__(self, system):
+    def __init__(self, system, store):
         self.system = system
+        self.store = store
+        self.last_id = 0
+        # The RegistrationsFactory, unless a separate signup daemon is running
+        self.factory = None
 
         resource = Gio.resource_load(os.path.join(paths.pkgdatadir, 'ltsp-manager.gresource'))
         Gio.Resource._register(resource)
@@ -170,26 +90,31 @@ class SignupServerWindow:
         self.builder.add_from_resource('/org/ltsp/ltsp-manager/ui/signup_server.ui')
         self.builder.connect_signals(self)
         self.requests_list = self.builder.get_object('requests_list')
+        self.pending = PendingRequests(self.requests_list)
         self.window = self.builder.get_object('requests_window')
         self.reject_tb = self.builder.get_object('reject_tb')
         self.review_tb = self.builder.get_object('review_tb')
         self.selection = self.builder.get_object('treeview-selection')
         self.roles = {i : config.get_config().parser.get('roles', i).replace('$$teachers', self.system.teachers) for i in config.get_config().parser.options('roles')}
         self.window.show()
+        # Show the requests that were pending when the server last stopped
+        self.add_stored_requests()
         self.setup = SettingsDialog(system, self)
     
     def strtime(self, t):
         return time.strftime("%d/%m/%Y %T", t)
     
     def user_autocomplete(self, user):
+        """Fill in the unset fields of user, and return the (uid, gid) that
+        were reserved for it, which are None if they were set."""
+        reserved = [None, None]
         if user.directory in [None, '']:
             user.directory = os.path.join(libuser.HOME_PREFIX, user.name)
+        # The IDs stay reserved until the request is applied or rejected
         if user.uid in [None, '']:
-            set_uids = [r[0].user.uid for r in self.requests_list]
-            user.uid = libuser.get_system().get_free_uid(exclude=set_uids)
+            user.uid = reserved[0] = self.system.allocate_uids()[0]
         if user.gid in [None, '']:
-            set_gids = [r[0].user.gid for r in self.requests_list]
-            user.gid = libuser.get_system().get_free_gid(exclude=set_gids)
+            user.gid = reserved[1] = self.system.allocate_gids()[0]
         if user.primary_group in [None, '']:
             user.primary_group = user.name
         if user.shell in [None, '']:
@@ -208,21 +133,46 @@ class SignupServerWindow:
             user.expire = -1
         if user.password in [None, '']:
             user.password = '!'
+        return tuple(reserved)
+
+    def remove_requests(self, requests):
+        """Remove requests from the window and the store, and release their
+        reserved IDs."""
+        reserved = self.pending.remove(requests)
+        self.store.remove(requests)
+        self.system.release_uids([uid for uid, gid in reserved if uid is not None])
+        self.system.release_gids([gid for uid, gid in reserved if gid is not None])
+        # Allow requesting the removed usernames again
+        if self.factory:
+            self.factory.refresh_usernames()
+        if len(self.pending) == 0:
+            self.builder.get_object('apply_button').set_sensitive(False)
     
+    def add_stored_requests(self):
+        """Add the requests that were stored after the last ones shown."""
+        for request in self.store.pending(self.last_id):
+            self.add_request(request)
+        return True
+
     def add_request(self, request):
+        self.last_id = max(self.last_id, request.id)
+        old = self.pending.get(request.user.name)
+        if old is not None:
+            # The student sent the form again, keep the newer request
+            self.remove_requests([old])
         #object time applicant realname username role groups
-        self.requests_list.append([request, self.strtime(request.time), 
-                                   str(request.applicant), request.user.rname,
-                                   request.user.name, str(request.role), 
-                                   ','.join(request.user.groups)])
-        self.user_autocomplete(request.user)
+        treeiter = self.requests_list.append([request, self.strtime(request.time),
+                                              str(request.applicant), request.user.rname,
+                                              request.user.name, str(request.role),
+                                              ','.join(request.user.groups)])
+        self.pending.add(request, treeiter, self.user_autocomplete(request.user))
         # Add the role groups to user.groups but don't show them in the treeview
         if request.role in self.roles:
             groups = self.roles[request.role].split(',')
         else:
             groups = []
         for gr in groups:
-            if gr and gr not in request.user.groups and gr in libuser.get_system().groups:
+            if gr and gr not in request.user.groups and gr in self.system.groups:
                 request.user.groups.append(gr)
         self.builder.get_object('apply_button').set_sensitive(True)
     
@@ -241,6 +191,14 @@ class SignupServerWindow:
         else:
             role_groups = []
         row[6] = ','.join([g for g in request.user.groups if g and g not in role_groups])
+        other = self.pending.get(request.user.name)
+        if other is not None and other is not request:
+            # The request was renamed to the username of another one
+            self.remove_requests([other])
+        self.pending.rename(request)
+        self.store.update(request, row[6].split(',') if row[6] else [])
+        if self.factory:
+            self.factory.refresh_usernames()
     
     def get_selected_rows(self):
         pathlist = self.selection.get_selected_rows()[1]
@@ -265,10 +223,7 @@ class SignupServerWindow:
             + "\n\n" + ', '.join([row[4] for row in selected])
         r = dialogs.AskDialog(msg, _("Reject requests"), parent=self.window).showup()
         if r == Gtk.ResponseType.YES:
-            for row in selected:
-                self.requests_list.remove(row.iter)
-            if len(self.requests_list) == 0:
-                self.builder.get_object('apply_button').set_sensitive(False)
+            self.remove_requests([row[0] for row in selected])
             
     def on_review_tb_clicked(self, widget):
         row = self.get_selected_rows()[0] # It should always be only one
@@ -277,40 +232,30 @@ class SignupServerWindow:
         user_form.ReviewUserDialog(self.system, request.user, request.role, cb, parent=self.window)
     
     def on_apply_button_clicked(self, widget):
-        requests = [row[0] for row in self.requests_list]
+        requests = self.pending.values()
         users = [req.user for req in requests]
         usernames = ', '.join([u.name for u in users])
         r=dialogs.AskDialog(_("The following user accounts will be created:") \
             + "\n%s\n\n" % usernames + _("Proceed?"),
             _("Create user accounts"), parent=self.window).showup()
         if r == Gtk.ResponseType.YES:
+            groups = {}
             for user in users:
                 if user.primary_group not in self.system.groups:
-                    self.system.add_group(libuser.Group(user.primary_group, user.gid, {}))
-                self.system.add_user(user)
-                libuser.get_system().reload()
-                # FIXME: ltsp-manager trees won't update
-                for counter, row in enumerate(self.requests_list):
-                    if row[0].user.name == user.name:
-                        self.requests_list.remove(self.requests_list.get_iter(counter))
-            if len(self.requests_list) == 0:
-                self.builder.get_object('apply_button').set_sensitive(False)
-    
-    def on_close_button_clicked(self, widget):    
-        if len(self.requests_list):
-            r=dialogs.AskDialog(_("Are you sure you want to close the sign up server? All pending requests will be lost."),
-                _("Confirmation"), parent=self.window).showup()
-            if r == Gtk.ResponseType.YES:
-                reactor.stop()
-            Gtk.main_quit()
-        else:
-            try:
-                reactor.stop()
-            except:
-                pass
-            Gtk.main_quit()
+                    groups[user.primary_group] = libuser.Group(user.primary_group, user.gid, {})
+            # A single transaction, which reloads the accounts once
+            success, error = self.system.apply_batch(users, groups.values())
+            if not success:
+                dialogs.ErrorDialog(error, _("Error"), parent=self.window).showup()
+                return
+            self.remove_requests(requests)
     
+    def on_close_button_clicked(self, widget):
+        # The pending requests are stored, and shown again on the next start
+        self.on_window_delete_event(widget, None)
+
     def on_window_delete_event(self, widget, event):
+        from twisted.internet import reactor
         try:
             reactor.stop()
         except:
@@ -318,7 +263,15 @@ class SignupServerWindow:
         Gtk.main_quit()
     
     def startServer(self, groups, roles):
-        reactor.listenTCP(790, RegistrationsFactory(self, groups, roles))
+        from twisted.internet import reactor
+        from twisted.internet.error import CannotListenError
+        try:
+            self.factory = signup_daemon.listen(self.system, self.store, groups, roles)
+            self.factory.listeners.append(self.add_request)
+        except CannotListenError:
+            # A signup daemon is running, show the requests that it stores
+            print("The signup port is in use, showing the signup daemon requests")
+            GLib.timeout_add_seconds(STORE_POLL_INTERVAL, self.add_stored_requests)
         reactor.run()
         Gtk.main()
         print("Stopping Signup Server")
@@ -418,7 +371,8 @@ class SettingsDialog:
 
     
 if __name__ == '__main__':
-    import libuser
+    from twisted.internet import gtk3reactor
+    gtk3reactor.install()
     print(_("Starting Signup Server"))
-    window = SignupServerWindow(libuser.get_system())
+    window = SignupServerWindow(libuser.get_system(), signup_daemon.RequestStore())
     
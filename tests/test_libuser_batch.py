@@ -0,0 +1,177 @@
+# This File is part of the ltsp-manager.
+#
+# Copyright 2012-2018 by it's authors.
+#
+# Licensed under GNU General Public License 3.0 or later.
+# Some rights reserved. See COPYING, AUTHORS.
+
+"""
+Tests of the batch account engine of libuser, against temporary account
+files. Run them with: python3 -m unittest discover tests
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import libuser
+import paths
+
+ACCOUNTS = {
+    'passwd': 'root:x:0:0:root:/root:/bin/bash\n'
+              'alice:x:1000:1000:Alice,,,:/home/alice:/bin/bash\n',
+    'shadow': 'root:*:17000:0:99999:7:::\n'
+              'alice:$6$salt$hash:17000:0:99999:7:::\n',
+    'group': 'root:x:0:\n'
+             'alice:x:1000:\n'
+             'teachers:x:1100:alice\n'
+             'lab1:x:1500:\n',
+    'gshadow': 'root:*::\n'
+               'alice:!::\n'
+               'teachers:!::alice\n'
+               'lab1:!::\n',
+}
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sysconfdir = self.tmp.name + '/'
+        for fname, contents in ACCOUNTS.items():
+            with open(self.path(fname), 'w') as f:
+                f.write(contents)
+        self.old_sysconfdir = paths.sysconfdir
+        paths.sysconfdir = self.sysconfdir
+        self.system = libuser.System(backend='files', watch=False)
+        self.home = os.path.join(self.tmp.name, 'home')
+        os.mkdir(self.home)
+
+    def tearDown(self):
+        paths.sysconfdir = self.old_sysconfdir
+        self.tmp.cleanup()
+
+    def path(self, fname):
+        return os.path.join(self.sysconfdir, fname)
+
+    def read(self, fname):
+        with open(self.path(fname)) as f:
+            return f.read()
+
+    def entries(self, fname):
+        return {line.split(':')[0]: line.split(':')
+                for line in self.read(fname).splitlines()}
+
+    def prepare(self, classes, count=2, username='{c}-{i}', **kwargs):
+        users, groups, passwords = self.system.prepare_batch(
+            classes, count, username, 'Student {i}', 'pass{i}', self.home, **kwargs)
+        for user in users:
+            user.password = '$6$salt$hash'
+        return users, groups, passwords
+
+    def test_add(self):
+        users, groups, passwords = self.prepare(['class1'])
+        self.assertEqual(passwords, ['pass1', 'pass2'])
+        self.assertEqual(self.system.apply_batch(users, groups), (True, ''))
+        passwd, group = self.entries('passwd'), self.entries('group')
+        shadow, gshadow = self.entries('shadow'), self.entries('gshadow')
+        for user in users:
+            self.assertEqual(passwd[user.name][2:4], [str(user.uid), str(user.gid)])
+            self.assertEqual(shadow[user.name][1], '$6$salt$hash')
+            # The private group exists, with the user's GID
+            self.assertEqual(group[user.name][2], str(user.gid))
+            self.assertIn(user.name, gshadow)
+            self.assertTrue(os.path.isdir(user.directory))
+        self.assertEqual(group['class1'][3], 'class1-1,class1-2')
+        self.assertEqual(gshadow['class1'][3], 'class1-1,class1-2')
+        # The previous contents are kept in <file>-
+        self.assertEqual(self.read('passwd-'), ACCOUNTS['passwd'])
+
+    def test_merge(self):
+        # lab1 exists, so it only gets the new members, and the teachers
+        users, groups, _ = self.prepare(['lab1'], teachers=True)
+        self.assertEqual(self.system.apply_batch(users, groups), (True, ''))
+        group = self.entries('group')
+        self.assertEqual(group['lab1'][2], '1500')
+        self.assertEqual(group['lab1'][3], 'lab1-1,lab1-2,alice')
+        self.assertEqual(list(group).count('lab1'), 1)
+
+    def test_existing_names(self):
+        # The private group of lab1 would point to a GID without a group
+        with self.assertRaises(ValueError):
+            self.prepare([''], 1, 'lab{i}')
+        with self.assertRaises(ValueError):
+            self.prepare([''], 1, 'alice')
+        with self.assertRaises(ValueError):
+            self.prepare(['class1'], 2, 'student')
+        # The IDs weren't reserved
+        self.assertEqual(self.system.allocate_uids(1), [1001])
+
+    def test_rollback(self):
+        users, groups, _ = self.prepare(['class1'])
+        users[1].rname = 'Invalid: name'
+        success, error = self.system.apply_batch(users, groups)
+        self.assertFalse(success)
+        self.assertIn('Invalid character', error)
+        for fname, contents in ACCOUNTS.items():
+            self.assertEqual(self.read(fname), contents)
+            self.assertFalse(os.path.exists(self.path(fname) + '+'))
+        self.assertFalse(os.listdir(self.home))
+
+    def test_home_error(self):
+        users, groups, _ = self.prepare(['class1'])
+        users[0].directory = os.path.join(self.home, 'missing', 'class1-1')
+        with open(os.path.join(self.home, 'missing'), 'w'):
+            pass
+        success, error = self.system.apply_batch(users, groups)
+        self.assertFalse(success)
+        self.assertIn('class1-1', error)
+        # The accounts and the other homes were created
+        self.assertIn('class1-1', self.entries('passwd'))
+        self.assertTrue(os.path.isdir(users[1].directory))
+
+    def test_other_lines(self):
+        # Blank lines, comments and NIS compat entries are kept as they are
+        extra = {'passwd': '\n# local users\n+::::::\n',
+                 'group': '\n# local groups\n+:::\n-lab2\n'}
+        for fname, lines in extra.items():
+            with open(self.path(fname), 'a') as f:
+                f.write(lines)
+        users, groups, _ = self.prepare(['class1'])
+        self.assertEqual(self.system.apply_batch(users, groups), (True, ''))
+        for fname, lines in extra.items():
+            self.assertIn(ACCOUNTS[fname] + lines, self.read(fname))
+        self.assertIn('class1', self.entries('group'))
+
+    def test_no_group_file(self):
+        os.remove(self.path('group'))
+        with libuser.AccountDB() as db:
+            self.assertEqual(db.gids, set())
+
+    def test_lock(self):
+        # lockf locks are per process, so hold the lock in another one
+        holder = subprocess.Popen([sys.executable, '-c', textwrap.dedent('''
+            import fcntl, os, sys
+            fd = os.open(sys.argv[1], os.O_WRONLY | os.O_CREAT, 0o600)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            print('locked', flush=True)
+            sys.stdin.read()
+            '''), self.path(libuser.PASSWD_LOCK)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            self.assertEqual(holder.stdout.readline(), 'locked\n')
+            db = libuser.AccountDB()
+            with self.assertRaises(OSError):
+                db.lock(timeout=0.3)
+            self.assertIsNone(db.lock_fd)
+        finally:
+            holder.communicate('')
+        db.lock(timeout=0.3)
+        db.unlock()
+
+
+if __name__ == '__main__':
+    unittest.main()